@@ -140,7 +140,7 @@ class ResultsExportAssetStore(BaseAssetStore):
     model = ExportFlowResultsTask
     directory = 'results_exports'
     permission = 'flows.flow_export_results'
-    extensions = ('xls',)
+    extensions = ('xls', 'zip')
 
 
 class MessageExportAssetStore(BaseAssetStore):
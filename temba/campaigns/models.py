@@ -1,7 +1,7 @@
 from __future__ import absolute_import, unicode_literals
 
 from datetime import timedelta
-from django.db import models
+from django.db import connection, models
 from django.db.models import Model
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
@@ -9,9 +9,13 @@ from smartmin.models import SmartModel
 from temba.contacts.models import ContactGroup, ContactField, Contact
 from temba.flows.models import Flow
 from temba.orgs.models import Org
+from temba.utils import chunk_list
 from temba.utils.models import generate_uuid
 from temba.values.models import Value
 
+# how many due fires for the same event we start at once
+EVENT_FIRE_BATCH_SIZE = 500
+
 
 class Campaign(SmartModel):
     name = models.CharField(max_length=255,
@@ -406,6 +410,38 @@ class EventFire(Model):
         self.event.flow.start([], [self.contact], restart_participants=True)
         self.save()
 
+    @classmethod
+    def batch_fire(cls, fires):
+        """
+        Fires a batch of fires for the same event, starting all their contacts in the event's flow at once. Fires are
+        first claimed by marking them fired in a single update, so that only fires nobody else has claimed are started,
+        and are released again if the flow start fails. Returns the fires which were claimed and started.
+        """
+        if not fires:
+            return []
+
+        fired = timezone.now()
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE campaigns_eventfire SET fired = %s WHERE id = ANY(%s) AND fired IS NULL RETURNING id',
+                           [fired, [fire.pk for fire in fires]])
+            claimed_ids = {row[0] for row in cursor.fetchall()}
+
+        fires = [fire for fire in fires if fire.pk in claimed_ids]
+        if not fires:
+            return fires
+
+        event = fires[0].event
+        try:
+            event.flow.start([], [fire.contact for fire in fires], restart_participants=True)
+        except Exception:
+            EventFire.objects.filter(pk__in=claimed_ids).update(fired=None)
+            raise
+
+        for fire in fires:
+            fire.fired = fired
+
+        return fires
+
     @classmethod
     def update_campaign_events(cls, campaign):
         """
@@ -417,8 +453,13 @@ class EventFire(Model):
 
     @classmethod
     def do_update_campaign_events(cls, campaign):
-        for contact in campaign.group.contacts.exclude(is_test=True):
-            cls.update_campaign_events_for_contact(campaign, contact)
+        fires = set()
+        if not campaign.is_archived:
+            now = timezone.now()
+            for event in campaign.get_events():
+                fires.update(cls.calculate_fires(event, now))
+
+        cls.sync_fires(EventFire.objects.filter(event__campaign=campaign, fired=None), fires)
 
     @classmethod
     def update_eventfires_for_event(cls, event):
@@ -427,65 +468,75 @@ class EventFire(Model):
 
     @classmethod
     def do_update_eventfires_for_event(cls, event):
-        # unschedule any fires
-        EventFire.objects.filter(event=event, fired=None).delete()
+        fires = set()
 
-        # add new ones if this event exists and the campaign is active
+        # only schedule fires if this event exists and the campaign is active
         if event.is_active and not event.campaign.is_archived:
+            fires = cls.calculate_fires(event, timezone.now())
 
-            contacts = event.campaign.group.contacts.filter(is_active=True, is_blocked=False).exclude(is_test=True)
-            values = Value.objects.filter(contact__in=contacts, contact_field__key__exact=event.relative_to.key)
-            values = values.select_related('contact').distinct('contact')
-
-            now = timezone.now()
-            events = []
-
-            org = event.campaign.org
-            for value in values:
-                formatted_date = org.format_date(value.datetime_value)
-                scheduled = event.calculate_scheduled_fire_for_value(formatted_date, now)
-
-                # and if we have a date, then schedule it
-                if scheduled:
-                    events.append(EventFire(event=event, contact=value.contact, scheduled=scheduled))
-
-            # bulk create our event fires
-            EventFire.objects.bulk_create(events)
+        cls.sync_fires(EventFire.objects.filter(event=event, fired=None), fires)
 
     @classmethod
     def update_field_events(cls, contact_field):
         """
-        Cancel any events for the passed in contact field
+        Reschedules any events for the passed in contact field
         """
-        if not contact_field.is_active:
-            # remove any scheduled fires for the passed in field
-            EventFire.objects.filter(event__relative_to=contact_field, fired=None).delete()
-        else:
-            # cancel existing events, we are going to recreate them all
-            EventFire.objects.filter(event__relative_to=contact_field, fired=None).delete()
+        fires = set()
 
+        # if the field has been removed then all its unfired events go away
+        if contact_field.is_active:
             now = timezone.now()
-            from temba.values.models import Value
-
-            org = contact_field.org
             for event in CampaignEvent.objects.filter(relative_to=contact_field,
                                                       campaign__is_active=True, campaign__is_archived=False, is_active=True):
+                fires.update(cls.calculate_fires(event, now))
+
+        cls.sync_fires(EventFire.objects.filter(event__relative_to=contact_field, fired=None), fires)
 
-                contacts = event.campaign.group.contacts.filter(is_active=True, is_blocked=False).exclude(is_test=True)
-                values = Value.objects.filter(contact__in=contacts, contact_field__key__exact=contact_field.key)
-                values = values.select_related('contact').distinct('contact')
+    @classmethod
+    def calculate_fires(cls, event, now):
+        """
+        Calculates when the passed in event should fire for every contact in its campaign's group, using the stored
+        date values of the field it is relative to. Returns a set of (event id, contact id, scheduled) tuples.
+        """
+        contacts = event.campaign.group.contacts.filter(is_active=True, is_blocked=False).exclude(is_test=True)
+        values = Value.objects.filter(contact__in=contacts, contact_field=event.relative_to).exclude(datetime_value=None)
 
-                events = []
-                for value in values:
-                    formatted_date = org.format_date(value.datetime_value)
-                    scheduled = event.calculate_scheduled_fire_for_value(formatted_date, now)
+        tz = event.campaign.org.get_tzinfo()
+        fires = set()
+        seen = set()
+        for contact_id, datetime_value in values.values_list('contact_id', 'datetime_value'):
+            if contact_id in seen:
+                continue
+            seen.add(contact_id)
 
-                    # and if we have a date, then schedule it
-                    if scheduled:
-                        events.append(EventFire(event=event, contact=value.contact, scheduled=scheduled))
+            # work from the date as the org sees it, same as if we had parsed the field's display value
+            scheduled = event.calculate_scheduled_fire_for_value(datetime_value.astimezone(tz), now)
+            if scheduled:
+                fires.add((event.id, contact_id, scheduled))
 
-                # bulk create our event fires
-                EventFire.objects.bulk_create(events)
+        return fires
+
+    @classmethod
+    def sync_fires(cls, unfired, fires):
+        """
+        Brings the passed in queryset of unfired fires in line with the passed in set of (event id, contact id,
+        scheduled) tuples, only deleting the fires which are no longer wanted and creating those which are new
+        """
+        to_create = set(fires)
+        to_delete = []
+
+        for fire_id, event_id, contact_id, scheduled in unfired.values_list('id', 'event_id', 'contact_id', 'scheduled'):
+            key = (event_id, contact_id, scheduled)
+            if key in to_create:
+                to_create.remove(key)
+            else:
+                to_delete.append(fire_id)
+
+        for batch in chunk_list(to_delete, 1000):
+            EventFire.objects.filter(pk__in=batch).delete()
+
+        EventFire.objects.bulk_create([EventFire(event_id=event_id, contact_id=contact_id, scheduled=scheduled)
+                                       for event_id, contact_id, scheduled in to_create], batch_size=1000)
 
     @classmethod
     def update_events_for_contact(cls, contact):
@@ -516,18 +567,18 @@ class EventFire(Model):
         groups = [_.id for _ in contact.user_groups.all()]
 
         # get all events which are in one of these groups and on this field
-        for event in CampaignEvent.objects.filter(campaign__group__in=groups, relative_to__key=key,
-                                                  campaign__is_archived=False, is_active=True):
+        events = list(CampaignEvent.objects.filter(campaign__group__in=groups, relative_to__key=key,
+                                                   campaign__is_archived=False, is_active=True))
 
-            # remove any unfired events, they will get recreated below
-            EventFire.objects.filter(event=event, contact=contact, fired=None).delete()
-
-            # calculate our scheduled date
-            scheduled = event.calculate_scheduled_fire(contact)
+        fires = set()
+        if not contact.is_test:
+            for event in events:
+                # calculate our scheduled date
+                scheduled = event.calculate_scheduled_fire(contact)
+                if scheduled:
+                    fires.add((event.id, contact.id, scheduled))
 
-            # and if we have a date, then schedule it
-            if scheduled and not contact.is_test:
-                EventFire.objects.create(event=event, contact=contact, scheduled=scheduled)
+        cls.sync_fires(EventFire.objects.filter(event__in=events, contact=contact, fired=None), fires)
 
     @classmethod
     def update_campaign_events_for_contact(cls, campaign, contact):
@@ -535,19 +586,17 @@ class EventFire(Model):
         Updates all the events for the passed in contact and campaign.
         Should be called anytime a contact field or contact group membership changes.
         """
-        # remove any unfired events, they will get recreated below
-        EventFire.objects.filter(event__campaign=campaign, contact=contact, fired=None).delete()
+        fires = set()
 
-        # if we aren't archived
-        if not campaign.is_archived:
-            # then scheduled all our events
+        # if we aren't archived, schedule all our events
+        if not campaign.is_archived and not contact.is_test:
             for event in campaign.get_events():
                 # calculate our scheduled date
                 scheduled = event.calculate_scheduled_fire(contact)
+                if scheduled:
+                    fires.add((event.id, contact.id, scheduled))
 
-                # and if we have a date, then schedule it
-                if scheduled and not contact.is_test:
-                    EventFire.objects.create(event=event, contact=contact, scheduled=scheduled)
+        cls.sync_fires(EventFire.objects.filter(event__campaign=campaign, contact=contact, fired=None), fires)
 
     def __unicode__(self):
         return "%s - %s" % (self.event, self.contact)
@@ -1,11 +1,13 @@
 from __future__ import unicode_literals
 
+from collections import OrderedDict
 from django.db import transaction
 from django.utils import timezone
 from djcelery_transactions import task
 from redis_cache import get_redis_connection
-from temba.campaigns.models import Campaign, CampaignEvent, EventFire
+from temba.campaigns.models import Campaign, CampaignEvent, EventFire, EVENT_FIRE_BATCH_SIZE
 from temba.msgs.models import HANDLER_QUEUE, HANDLE_EVENT_TASK, FIRE_EVENT
+from temba.utils import chunk_list
 from temba.utils.queues import push_task
 
 
@@ -24,14 +26,20 @@ def check_campaigns_task(sched_id=None):
     # only do this if we aren't already checking campaigns
     if not r.get(key):
         with r.lock(key, timeout=3600):
-            # for each that needs to be fired
-            for fire in EventFire.objects.filter(fired=None,
-                                                 scheduled__lte=timezone.now()).select_related('contact', 'contact__org'):
-                try:
-                    push_task(fire.contact.org, HANDLER_QUEUE, HANDLE_EVENT_TASK, dict(type=FIRE_EVENT, id=fire.id))
-
-                except Exception:  # pragma: no cover
-                    logger.error("Error running campaign event: %s" % fire.pk, exc_info=True)
+            # group everything that needs to be fired by event, so each event's contacts are started together
+            fires = EventFire.objects.filter(fired=None, scheduled__lte=timezone.now()).order_by('event', 'scheduled')
+            fires_by_event = OrderedDict()
+            for fire_id, event_id, org_id in fires.values_list('id', 'event_id', 'event__campaign__org_id'):
+                fires_by_event.setdefault((event_id, org_id), []).append(fire_id)
+
+            for (event_id, org_id), fire_ids in fires_by_event.iteritems():
+                for batch in chunk_list(fire_ids, EVENT_FIRE_BATCH_SIZE):
+                    try:
+                        push_task(org_id, HANDLER_QUEUE, HANDLE_EVENT_TASK,
+                                  dict(type=FIRE_EVENT, event=event_id, fires=list(batch)))
+
+                    except Exception:  # pragma: no cover
+                        logger.error("Error running campaign event: %s" % event_id, exc_info=True)
 
 
 @task(track_started=True, name='update_event_fires_task')  # pragma: no cover
@@ -2,9 +2,12 @@ from __future__ import unicode_literals
 
 from django.contrib.auth.models import Group
 from django.core.urlresolvers import reverse
+from mock import patch
 from temba.contacts.models import ContactField
 from temba.flows.models import FlowRun, Flow, RuleSet, ActionSet
+from temba.msgs.models import HANDLER_QUEUE, HANDLE_EVENT_TASK, FIRE_EVENT
 from temba.tests import TembaTest
+from temba.values.models import Value
 from temba.campaigns.tasks import check_campaigns_task
 from .models import Campaign, CampaignEvent, EventFire
 from django.utils import timezone
@@ -530,3 +533,83 @@ class CampaignTest(TembaTest):
         # should have one flow run now
         run = FlowRun.objects.get()
         self.assertEquals(event.contact, run.contact)
+
+    def test_batch_firing(self):
+        campaign = Campaign.create(self.org, self.admin, "Planting Reminders", self.farmers)
+        event = CampaignEvent.create_flow_event(self.org, self.admin, campaign, relative_to=self.planting_date,
+                                                offset=1, unit='D', flow=self.reminder_flow)
+
+        # schedule a fire for each farmer, both in the past
+        fires = [EventFire.objects.create(event=event, contact=self.farmer1, scheduled=timezone.now() - timedelta(hours=2)),
+                 EventFire.objects.create(event=event, contact=self.farmer2, scheduled=timezone.now() - timedelta(hours=1))]
+
+        # both are queued together
+        with patch('temba.campaigns.tasks.push_task') as mock_push_task:
+            check_campaigns_task()
+
+            mock_push_task.assert_called_once_with(self.org.id, HANDLER_QUEUE, HANDLE_EVENT_TASK,
+                                                   dict(type=FIRE_EVENT, event=event.id, fires=[f.id for f in fires]))
+
+        # and started in one go
+        check_campaigns_task()
+
+        self.assertEqual({self.farmer1, self.farmer2}, {run.contact for run in FlowRun.objects.filter(flow=self.reminder_flow)})
+        self.assertFalse(EventFire.objects.filter(fired=None))
+
+        # firing again does nothing
+        check_campaigns_task()
+        self.assertEqual(2, FlowRun.objects.filter(flow=self.reminder_flow).count())
+
+        # a stale copy of an already claimed fire in an overlapping batch isn't started again
+        fire3 = EventFire.objects.create(event=event, contact=self.farmer1, scheduled=timezone.now())
+        stale = list(EventFire.objects.filter(pk__in=[fires[0].pk, fire3.pk]).select_related('event', 'contact'))
+        for fire in stale:
+            fire.fired = None
+
+        self.assertEqual([fire3], EventFire.batch_fire(stale))
+        self.assertEqual(3, FlowRun.objects.filter(flow=self.reminder_flow).count())
+
+        # fires are released if the flow fails to start
+        fire4 = EventFire.objects.create(event=event, contact=self.farmer2, scheduled=timezone.now())
+        with patch('temba.flows.models.Flow.start') as mock_start:
+            mock_start.side_effect = ValueError("boom")
+            self.assertRaises(ValueError, EventFire.batch_fire, [fire4])
+
+        self.assertIsNone(EventFire.objects.get(pk=fire4.pk).fired)
+
+    def test_rescheduling(self):
+        campaign = Campaign.create(self.org, self.admin, "Planting Reminders", self.farmers)
+        event = CampaignEvent.create_flow_event(self.org, self.admin, campaign, relative_to=self.planting_date,
+                                                offset=2, unit='D', flow=self.reminder_flow, delivery_hour=9)
+
+        self.farmer1.set_field(self.user, 'planting_date', "05-10-2020 12:30:10")
+        self.farmer2.set_field(self.user, 'planting_date', "07-10-2020 08:00")
+
+        EventFire.do_update_campaign_events(campaign)
+        fire1 = EventFire.objects.get(contact=self.farmer1)
+        fire2 = EventFire.objects.get(contact=self.farmer2)
+
+        # same result as scheduling contact by contact, org is in UTC+2
+        self.assertEqual(event.calculate_scheduled_fire(self.farmer1), fire1.scheduled)
+        self.assertEqual((7, 9 - 2), (fire1.scheduled.day, fire1.scheduled.hour))
+        self.assertEqual((9, 9 - 2), (fire2.scheduled.day, fire2.scheduled.hour))
+
+        # rescheduling without changes leaves our fires alone
+        EventFire.do_update_campaign_events(campaign)
+        self.assertEqual({fire1.pk, fire2.pk}, set(EventFire.objects.values_list('pk', flat=True)))
+
+        # change one contact's date behind the scenes, only their fire is replaced
+        Value.objects.filter(contact=self.farmer2, contact_field=self.planting_date).update(
+            datetime_value=fire2.scheduled + timedelta(days=1))
+
+        EventFire.do_update_campaign_events(campaign)
+        self.assertTrue(EventFire.objects.filter(pk=fire1.pk).exists())
+        self.assertFalse(EventFire.objects.filter(pk=fire2.pk).exists())
+        self.assertEqual(12, EventFire.objects.get(contact=self.farmer2).scheduled.day)
+
+        # archiving our campaign removes them all
+        campaign.is_archived = True
+        campaign.save()
+
+        EventFire.do_update_campaign_events(campaign)
+        self.assertFalse(EventFire.objects.all())
@@ -21,7 +21,7 @@ from temba.channels.models import Channel, PLIVO, SHAQODOON, YO, TWILIO_MESSAGIN
 from temba.contacts.models import Contact, URN
 from temba.flows.models import Flow, FlowRun
 from temba.orgs.models import NEXMO_UUID
-from temba.msgs.models import Msg, HANDLE_EVENT_TASK, HANDLER_QUEUE, MSG_EVENT
+from temba.msgs.models import Msg, HANDLE_EVENT_TASK, HANDLER_QUEUE, MSG_EVENT, SENT, DELIVERED, FAILED
 from temba.triggers.models import Trigger
 from temba.utils import json_date_to_datetime
 from temba.utils.middleware import disable_middleware
@@ -126,6 +126,11 @@ class TwilioHandler(View):
                 # raise an exception that things weren't properly signed
                 raise ValidationError("Invalid request signature")
 
+            # when staging statuses, they're applied in bulk later
+            staged_status = {'sent': SENT, 'delivered': DELIVERED, 'failed': FAILED}.get(status)
+            if staged_status and Msg.stage_status(sms.channel, staged_status, msg_id=sms.id):
+                return HttpResponse("", status=200)
+
             # queued, sending, sent, failed, or received.
             if status == 'sent':
                 sms.status_sent()
@@ -238,7 +243,7 @@ class AfricasTalkingHandler(View):
             external_id = request.POST['id']
 
             # look up the message
-            sms = Msg.current_messages.filter(channel=channel, external_id=external_id).select_related('channel').first()
+            sms = Msg.get_by_external_id(channel, external_id).select_related('channel').first()
             if not sms:
                 return HttpResponse("No SMS message with id: %s" % external_id, status=404)
 
@@ -370,6 +375,11 @@ class ExternalHandler(View):
 
             sms_pk = request.REQUEST['id']
 
+            # when staging statuses, they're applied in bulk later so we don't need to look up the message
+            status = {'delivered': DELIVERED, 'sent': SENT, 'failed': FAILED}[action]
+            if sms_pk.isdigit() and Msg.stage_status(channel, status, msg_id=int(sms_pk)):
+                return HttpResponse("SMS Status Updated")
+
             # look up the message
             sms = Msg.current_messages.filter(channel=channel, pk=sms_pk).select_related('channel').first()
             if not sms:
@@ -402,9 +412,9 @@ class ExternalHandler(View):
                 date = json_date_to_datetime(date)
 
             urn = URN.from_parts(channel.scheme, sender)
-            sms = Msg.create_incoming(channel, urn, text, date=date)
+            sms = Msg.stage_incoming(channel, urn, text, date=date)
 
-            return HttpResponse("SMS Accepted: %d" % sms.id)
+            return HttpResponse(("SMS Accepted: %d" % sms.id) if sms else "SMS Accepted")
 
         else:
             return HttpResponse("Not handled", status=400)
@@ -492,8 +502,8 @@ class TelegramHandler(View):
         def create_media_message(file_id):
             media_url = TelegramHandler.download_file(channel, file_id)
             url = media_url.partition(':')[2]
-            msg = Msg.create_incoming(channel, urn, url, date=msg_date, media=media_url)
-            return HttpResponse("Message Accepted: %d" % msg.id)
+            msg = Msg.stage_incoming(channel, urn, url, date=msg_date, media=media_url)
+            return HttpResponse(("Message Accepted: %d" % msg.id) if msg else "Message Accepted")
 
         if 'sticker' in body['message']:
             return create_media_message(body['message']['sticker']['file_id'])
@@ -516,8 +526,8 @@ class TelegramHandler(View):
                 if 'title' in body['message']['venue']:
                     msg_text = '%s (%s)' % (msg_text, body['message']['venue']['title'])
             media_url = 'geo:%s' % location
-            msg = Msg.create_incoming(channel, urn, msg_text, date=msg_date, media=media_url)
-            return HttpResponse("Message Accepted: %d" % msg.id)
+            msg = Msg.stage_incoming(channel, urn, msg_text, date=msg_date, media=media_url)
+            return HttpResponse(("Message Accepted: %d" % msg.id) if msg else "Message Accepted")
 
         if 'photo' in body['message']:
             photos = body['message']['photo']
@@ -539,12 +549,18 @@ class TelegramHandler(View):
 
         # skip if there is no message block (could be a sticker or voice)
         if 'text' in body['message']:
-            msg = Msg.create_incoming(channel, urn, body['message']['text'], date=msg_date)
-            return HttpResponse("Message Accepted: %d" % msg.id)
+            msg = Msg.stage_incoming(channel, urn, body['message']['text'], date=msg_date)
+            return HttpResponse(("Message Accepted: %d" % msg.id) if msg else "Message Accepted")
 
         return HttpResponse("No message, ignored.")
 
 
+INFOBIP_STATUSES = {'DELIVERED': DELIVERED, 'SENT': SENT, 'NOT_SENT': FAILED, 'NOT_ALLOWED': FAILED,
+                    'INVALID_DESTINATION_ADDRESS': FAILED, 'INVALID_SOURCE_ADDRESS': FAILED,
+                    'ROUTE_NOT_AVAILABLE': FAILED, 'NOT_ENOUGH_CREDITS': FAILED, 'REJECTED': FAILED,
+                    'INVALID_MESSAGE_FORMAT': FAILED}
+
+
 class InfobipHandler(View):
 
     @disable_middleware
@@ -576,8 +592,12 @@ class InfobipHandler(View):
         external_id = message.get('id')
         status = message.get('status')
 
+        # when staging statuses, they're applied in bulk later so we don't need to look up the message
+        if status in INFOBIP_STATUSES and Msg.stage_status(channel, INFOBIP_STATUSES[status], external_id=external_id):
+            return HttpResponse("SMS Status Updated")
+
         # look up the message
-        sms = Msg.current_messages.filter(channel=channel, external_id=external_id).select_related('channel').first()
+        sms = Msg.get_by_external_id(channel, external_id).select_related('channel').first()
         if not sms:
             return HttpResponse("No SMS message with external id: %s" % external_id, status=404)
 
@@ -767,7 +787,7 @@ class BlackmynaHandler(View):
             status = int(request.REQUEST.get('status', 0))
 
             # look up the message
-            sms = Msg.current_messages.filter(channel=channel, external_id=msg_id).select_related('channel').first()
+            sms = Msg.get_by_external_id(channel, msg_id).select_related('channel').first()
             if not sms:
                 return HttpResponse("No SMS message with id: %s" % msg_id, status=400)
 
@@ -883,8 +903,14 @@ class NexmoHandler(View):
         if action == 'status':
             external_id = request.REQUEST['messageId']
 
+            # when staging statuses, they're applied in bulk later so we don't need to look up the message
+            staged_status = {'delivered': DELIVERED, 'accepted': SENT, 'buffered': SENT,
+                             'expired': FAILED, 'failed': FAILED}.get(request.REQUEST.get('status'))
+            if staged_status and Msg.stage_status(channel, staged_status, external_id=external_id):
+                return HttpResponse("SMS Status Updated")
+
             # look up the message
-            sms = Msg.current_messages.filter(channel=channel, external_id=external_id).select_related('channel').first()
+            sms = Msg.get_by_external_id(channel, external_id).select_related('channel').first()
             if not sms:
                 return HttpResponse("No SMS message with external id: %s" % external_id, status=200)
 
@@ -987,7 +1013,7 @@ class VumiHandler(View):
             status = body['event_type']
 
             # look up the message
-            sms = Msg.current_messages.filter(channel=channel, external_id=external_id).select_related('channel')
+            sms = Msg.get_by_external_id(channel, external_id).select_related('channel')
 
             if not sms:
                 return HttpResponse("Message with external id of '%s' not found" % external_id, status=404)
@@ -1067,11 +1093,6 @@ class KannelHandler(View):
 
             sms_id = self.request.REQUEST['id']
 
-            # look up the message
-            sms = Msg.current_messages.filter(channel=channel, id=sms_id).select_related('channel')
-            if not sms:
-                return HttpResponse("Message with external id of '%s' not found" % sms_id, status=400)
-
             # possible status codes kannel will send us
             STATUS_CHOICES = {'1': DELIVERED,
                               '2': FAILED,
@@ -1087,6 +1108,15 @@ class KannelHandler(View):
             if not status:
                 return HttpResponse("Unrecognized status code: '%s', ignoring message." % status_code, status=401)
 
+            # when staging statuses, they're applied in bulk later so we don't need to look up the message
+            if sms_id.isdigit() and Msg.stage_status(channel, status, msg_id=int(sms_id)):
+                return HttpResponse("SMS Status Updated")
+
+            # look up the message
+            sms = Msg.current_messages.filter(channel=channel, id=sms_id).select_related('channel')
+            if not sms:
+                return HttpResponse("Message with external id of '%s' not found" % sms_id, status=400)
+
             # only update to SENT status if still in WIRED state
             if status == SENT:
                 for sms_obj in sms.filter(status__in=[PENDING, QUEUED, WIRED]):
@@ -1113,10 +1143,10 @@ class KannelHandler(View):
             gmt_date = pytz.timezone('GMT').localize(sms_date)
 
             urn = URN.from_tel(request.REQUEST['sender'])
-            sms = Msg.create_incoming(channel, urn, request.REQUEST['message'], date=gmt_date)
+            sms = Msg.stage_incoming(channel, urn, request.REQUEST['message'], date=gmt_date,
+                                     external_id=request.REQUEST['id'])
 
-            Msg.all_messages.filter(pk=sms.id).update(external_id=request.REQUEST['id'])
-            return HttpResponse("SMS Accepted: %d" % sms.id)
+            return HttpResponse(("SMS Accepted: %d" % sms.id) if sms else "SMS Accepted")
 
         else:
             return HttpResponse("Not handled", status=400)
@@ -1156,7 +1186,7 @@ class ClickatellHandler(View):
             sms_id = self.request.REQUEST['apiMsgId']
 
             # look up the message
-            sms = Msg.current_messages.filter(channel=channel, external_id=sms_id).select_related('channel')
+            sms = Msg.get_by_external_id(channel, sms_id).select_related('channel')
             if not sms:
                 return HttpResponse("Message with external id of '%s' not found" % sms_id, status=400)
 
@@ -1284,7 +1314,7 @@ class PlivoHandler(View):
                 sms_id = request.REQUEST['ParentMessageUUID']
 
             # look up the message
-            sms = Msg.current_messages.filter(channel=channel, external_id=sms_id).select_related('channel')
+            sms = Msg.get_by_external_id(channel, sms_id).select_related('channel')
             if not sms:
                 return HttpResponse("Message with external id of '%s' not found" % sms_id, status=400)
 
@@ -1547,7 +1577,7 @@ class JasminHandler(View):
             err = request.POST['err']
 
             # look up the message
-            sms = Msg.current_messages.filter(channel=channel, external_id=sms_id).select_related('channel')
+            sms = Msg.get_by_external_id(channel, sms_id).select_related('channel')
             if not sms:
                 return HttpResponse("Message with external id of '%s' not found" % sms_id, status=400)
 
@@ -1619,7 +1649,7 @@ class MbloxHandler(View):
             status = body['status']
 
             # look up the message
-            msgs = Msg.current_messages.filter(channel=channel, external_id=msg_id).select_related('channel')
+            msgs = Msg.get_by_external_id(channel, msg_id).select_related('channel')
             if not msgs:
                 return HttpResponse("Message with external id of '%s' not found" % msg_id, status=400)
 
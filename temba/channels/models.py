@@ -30,7 +30,7 @@ from phonenumbers import NumberParseException
 from redis_cache import get_redis_connection
 from smartmin.models import SmartModel
 from temba.nexmo import NexmoClient
-from temba.orgs.models import Org, OrgLock, APPLICATION_SID, NEXMO_UUID
+from temba.orgs.models import Org, OrgLock, APPLICATION_SID, NEXMO_UUID, ORG_MAX_TPS
 from temba.utils.email import send_template_email
 from temba.utils import analytics, random_string, dict_to_struct, dict_to_json
 from time import sleep
@@ -38,6 +38,7 @@ from twilio.rest import TwilioRestClient
 from twython import Twython
 from temba.utils.gsm7 import is_gsm7, replace_non_gsm7_accents
 from temba.utils.models import TembaModel, generate_uuid
+from temba.utils.throttle import take_token
 from urllib import quote_plus
 from xml.sax.saxutils import quoteattr, escape
 
@@ -79,6 +80,7 @@ VERIFY_SSL = 'verify_ssl'
 USE_NATIONAL = 'use_national'
 ENCODING = 'encoding'
 PAGE_NAME = 'page_name'
+MAX_TPS = 'max_tps'
 
 DEFAULT_ENCODING = 'D'  # we just pass the text down to the endpoint
 SMART_ENCODING = 'S'    # we try simple substitutions to GSM7 then go to unicode if it still isn't GSM7
@@ -99,6 +101,9 @@ SEND_QUEUE_DEPTH = 500
 # how big each batch of outgoing messages can be
 SEND_BATCH_SIZE = 100
 
+# how many contacts we will send to at once through a single channel, unless its type settings say otherwise
+DEFAULT_SEND_CONCURRENCY = 5
+
 # various hard coded settings for the channel types
 CHANNEL_SETTINGS = {
     AFRICAS_TALKING: dict(scheme='tel', max_length=160),
@@ -2341,6 +2346,50 @@ class Channel(TembaModel):
         pending = pending.order_by('-priority', 'created_on')
         return pending
 
+    @classmethod
+    def get_send_concurrency(cls, channel):
+        """
+        Gets how many contacts can be sent to at once through the passed in cached channel. Channels never get more
+        senders than their effective max TPS, and removed channels only need one as their msgs are just failed.
+        """
+        if not channel:
+            return 1
+
+        concurrency = CHANNEL_SETTINGS.get(channel.channel_type, {}).get('max_concurrency', DEFAULT_SEND_CONCURRENCY)
+        limits = [max_tps for key, max_tps in cls.get_send_limits(channel)]
+
+        return max(1, int(min([concurrency] + limits)))
+
+    @classmethod
+    def get_send_limits(cls, channel):
+        """
+        Gets the (key, max TPS) limits which apply to sending through the passed in cached channel. The channel's own
+        max TPS can be set in its config and otherwise comes from its type settings, org wide limits are set in the
+        org config.
+        """
+        limits = []
+
+        max_tps = channel.config.get(MAX_TPS) or CHANNEL_SETTINGS.get(channel.channel_type, {}).get('max_tps', 0)
+        if max_tps:
+            limits.append(('channel_tps_%d' % channel.id, max_tps))
+
+        org_max_tps = channel.org_config.get(ORG_MAX_TPS) if channel.org_config else None
+        if org_max_tps:
+            limits.append(('org_tps_%d' % channel.org, org_max_tps))
+
+        return limits
+
+    @classmethod
+    def get_send_delay(cls, channel, r=None):
+        """
+        Takes a send token for the passed in cached channel, returning 0 if we can send through it now, or how many
+        seconds we should wait if it or its org is currently sending as fast as it is allowed to.
+        """
+        if not channel:
+            return 0
+
+        return take_token([(key, max_tps, max_tps) for key, max_tps in cls.get_send_limits(channel)], r=r)
+
     @classmethod
     def send_message(cls, msg):  # pragma: no cover
         from temba.msgs.models import Msg, QUEUED, WIRED, MSG_SENT_KEY
@@ -2396,35 +2445,6 @@ class Channel(TembaModel):
                       YO: Channel.send_yo_message,
                       ZENVIA: Channel.send_zenvia_message}
 
-        # Check whether we need to throttle ourselves
-        # This isn't an ideal implementation, in that if there is only one Channel with tons of messages
-        # and a low throttle rate, we will have lots of threads waiting, but since throttling is currently
-        # a rare event, this is an ok stopgap.
-        max_tps = type_settings.get('max_tps', 0)
-        if max_tps:
-            tps_set_name = 'channel_tps_%d' % channel.id
-            lock_name = '%s_lock' % tps_set_name
-
-            while True:
-                # only one thread should be messing with the map at once
-                with r.lock(lock_name, timeout=5):
-                    # check how many were sent in the last second
-                    now = time.time()
-                    last_second = time.time() - 1
-
-                    # how many have been sent in the past second?
-                    count = r.zcount(tps_set_name, last_second, now)
-
-                    # we're within our tps, add ourselves to the list and go on our way
-                    if count < max_tps:
-                        r.zadd(tps_set_name, now, now)
-                        r.zremrangebyscore(tps_set_name, "-inf", last_second)
-                        r.expire(tps_set_name, 5)
-                        break
-
-                # too many sent in the last second, sleep a bit and try again
-                time.sleep(1 / float(max_tps))
-
         sent_count = 0
         parts = Msg.get_text_parts(msg.text, type_settings['max_length'])
         for part in parts:
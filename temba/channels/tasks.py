@@ -2,17 +2,22 @@ from __future__ import unicode_literals
 
 import requests
 import logging
+import threading
 import time
 
+from collections import OrderedDict
 from datetime import timedelta
 from django.conf import settings
+from django.db import connection
 from django.utils import timezone
 from djcelery_transactions import task
 from enum import Enum
+from multiprocessing.pool import ThreadPool
 from redis_cache import get_redis_connection
-from temba.msgs.models import SEND_MSG_TASK, MSG_QUEUE
+from temba.msgs.models import SEND_MSG_TASK, SEND_MSG_BATCH_SIZE, SEND_MSG_BATCH_ORGS, MSG_QUEUE
 from temba.utils import dict_to_struct
-from temba.utils.queues import pop_task, push_task
+from temba.utils.cache import redis_batch
+from temba.utils.queues import pop_tasks, push_task
 from temba.utils.mage import MageClient
 from .models import Channel, Alert, ChannelLog, ChannelCount, AUTH_TOKEN
 
@@ -35,18 +40,71 @@ def sync_channel_task(gcm_id, channel_id=None):  # pragma: no cover
 @task(track_started=True, name='send_msg_task')
 def send_msg_task():
     """
-    Pops the next message off of our msg queue to send.
+    Pops the next batch of messages off of our msg queue to send.
     """
-    # pop off the next task
-    msg_tasks = pop_task(SEND_MSG_TASK)
+    # pop off the next batch of tasks, these may be for several contacts across several orgs
+    batch = pop_tasks(SEND_MSG_TASK, max_items=SEND_MSG_BATCH_SIZE, max_orgs=SEND_MSG_BATCH_ORGS)
 
-    # it is possible we have no message to send, if so, just return
-    if not msg_tasks:
-        return
+    # group our msgs by contact, keeping the order they were popped in, our batch may well be empty if another
+    # worker got there first
+    contact_tasks = OrderedDict()
+    for msg_tasks in batch:
+        if not isinstance(msg_tasks, list):
+            msg_tasks = [msg_tasks]
 
-    if not isinstance(msg_tasks, list):
-        msg_tasks = [msg_tasks]
+        contact_tasks.setdefault(msg_tasks[0]['contact'], []).extend(msg_tasks)
 
+    contact_tasks = contact_tasks.values()
+
+    # only one contact to send to, or we are running eagerly, just send inline
+    if len(contact_tasks) < 2 or getattr(settings, 'CELERY_ALWAYS_EAGER', False):
+        try:
+            while contact_tasks:
+                send_contact_msgs(contact_tasks.pop(0))
+
+        finally:  # pragma: no cover
+            # if we didn't get to some contacts, requeue their msgs for later sending
+            for msg_tasks in contact_tasks:
+                push_task(msg_tasks[0]['org'], MSG_QUEUE, SEND_MSG_TASK, msg_tasks)
+
+    else:  # pragma: no cover
+        send_concurrently(contact_tasks)
+
+
+def send_concurrently(contact_tasks):  # pragma: no cover
+    """
+    Sends the msgs for several contacts at once, each contact's msgs are still sent in order by a single thread, but
+    different contacts are sent to in parallel, up to the send concurrency of each channel
+    """
+    # build a semaphore for each channel so we never go above its concurrency
+    limits = dict()
+    for msg_tasks in contact_tasks:
+        channel_id = msg_tasks[0]['channel']
+        if channel_id not in limits:
+            channel = Channel.get_cached_channel(channel_id) if channel_id else None
+            limits[channel_id] = threading.BoundedSemaphore(Channel.get_send_concurrency(channel))
+
+    def send(msg_tasks):
+        try:
+            with limits[msg_tasks[0]['channel']]:
+                send_contact_msgs(msg_tasks)
+        finally:
+            # each thread gets its own db connection, make sure it doesn't linger
+            connection.close()
+
+    pool = ThreadPool(len(contact_tasks))
+    try:
+        # any unsent msgs are requeued by each thread, so this only raises once every contact has been attempted
+        pool.map(send, contact_tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def send_contact_msgs(msg_tasks):
+    """
+    Sends the passed in list of message tasks, which all belong to the same contact, in order
+    """
     r = get_redis_connection()
 
     # acquire a lock on our contact to make sure two sets of msgs aren't being sent at the same time
@@ -54,14 +112,26 @@ def send_msg_task():
         with r.lock('send_contact_%d' % msg_tasks[0]['contact'], timeout=300):
             # send each of our msgs
             while msg_tasks:
+                # if our channel is sending as fast as it is allowed to, try these msgs again once it can send
+                channel_id = msg_tasks[0]['channel']
+                delay = Channel.get_send_delay(Channel.get_cached_channel(channel_id), r=r) if channel_id else 0
+                if delay:
+                    # we can't schedule anything when running eagerly so just wait
+                    if getattr(settings, 'CELERY_ALWAYS_EAGER', False):
+                        time.sleep(delay)
+                        continue
+
+                    requeue_msgs_task.apply_async(args=[msg_tasks], countdown=delay)
+                    msg_tasks = []
+                    break
+
                 msg_task = msg_tasks.pop(0)
                 msg = dict_to_struct('MockMsg', msg_task,
                                      datetime_fields=['modified_on', 'sent_on', 'created_on', 'queued_on', 'next_attempt'])
-                Channel.send_message(msg)
 
-                # if there are more messages to send for this contact, sleep a second before moving on
-                if msg_tasks:
-                    time.sleep(1)
+                # the redis writes for sending this message go in a single round trip
+                with redis_batch(r):
+                    Channel.send_message(msg)
 
     finally:  # pragma: no cover
         # if some msgs weren't sent for some reason, then requeue them for later sending
@@ -70,6 +140,14 @@ def send_msg_task():
             push_task(msg_tasks[0]['org'], MSG_QUEUE, SEND_MSG_TASK, msg_tasks)
 
 
+@task(track_started=True, name='requeue_msgs_task')
+def requeue_msgs_task(msg_tasks):
+    """
+    Puts msgs which were throttled back on our send queue, this is scheduled for when their channel can send again
+    """
+    push_task(msg_tasks[0]['org'], MSG_QUEUE, SEND_MSG_TASK, msg_tasks)
+
+
 @task(track_started=True, name='check_channels_task')
 def check_channels_task():
     """
@@ -33,6 +33,7 @@ from temba.middleware import BrandingMiddleware
 from temba.msgs.models import Broadcast, Msg, IVR, WIRED, FAILED, SENT, DELIVERED, ERRORED, INCOMING
 from temba.msgs.models import MSG_SENT_KEY, SystemLabel
 from temba.orgs.models import Org, ALL_EVENTS, ACCOUNT_SID, ACCOUNT_TOKEN, APPLICATION_SID, NEXMO_KEY, NEXMO_SECRET, FREE_PLAN
+from temba.orgs.models import ORG_MAX_TPS
 from temba.tests import TembaTest, MockResponse, MockTwilioClient, MockRequestValidator
 from temba.triggers.models import Trigger
 from temba.utils import dict_to_struct
@@ -45,6 +46,7 @@ from .models import Channel, ChannelCount, ChannelEvent, SyncEvent, Alert, Chann
 from .models import PLIVO_AUTH_ID, PLIVO_AUTH_TOKEN, PLIVO_APP_ID, TEMBA_HEADERS
 from .models import TWILIO, ANDROID, TWITTER, API_ID, USERNAME, PASSWORD, PAGE_NAME, AUTH_TOKEN
 from .models import ENCODING, SMART_ENCODING, SEND_URL, SEND_METHOD, NEXMO_UUID, UNICODE_ENCODING, NEXMO
+from .models import DEFAULT_SEND_CONCURRENCY, MAX_TPS
 from .tasks import check_channels_task, squash_channelcounts
 from .views import TWILIO_SUPPORTED_COUNTRIES
 
@@ -253,6 +255,66 @@ class ChannelTest(TembaTest):
         self.assertEqual(self.tel_channel, Msg.all_messages.get(pk=msg.id).channel)
         self.assertEqual(1, Msg.all_messages.get(pk=msg.id).msg_count)
 
+    def test_send_concurrency(self):
+        # removed channels only need a single sender
+        self.assertEqual(1, Channel.get_send_concurrency(None))
+
+        # otherwise we use our default
+        channel = Channel.get_cached_channel(self.tel_channel.id)
+        self.assertEqual(DEFAULT_SEND_CONCURRENCY, Channel.get_send_concurrency(channel))
+
+        # unless the channel type is throttled
+        self.tel_channel.channel_type = NEXMO
+        self.tel_channel.save()
+        Channel.clear_cached_channel(self.tel_channel.id)
+
+        channel = Channel.get_cached_channel(self.tel_channel.id)
+        self.assertEqual(1, Channel.get_send_concurrency(channel))
+
+        # channel and org max tps settings are honored too
+        self.twitter_channel.config = json.dumps({MAX_TPS: 3})
+        self.twitter_channel.save()
+        Channel.clear_cached_channel(self.twitter_channel.id)
+
+        channel = Channel.get_cached_channel(self.twitter_channel.id)
+        self.assertEqual(3, Channel.get_send_concurrency(channel))
+
+        self.org.config = json.dumps({ORG_MAX_TPS: 2})
+        self.org.save()
+        Channel.clear_cached_channel(self.twitter_channel.id)
+
+        channel = Channel.get_cached_channel(self.twitter_channel.id)
+        self.assertEqual(2, Channel.get_send_concurrency(channel))
+
+    def test_send_delay(self):
+        # removed channels are never throttled
+        self.assertEqual(0, Channel.get_send_delay(None))
+
+        # nor are channels without a max tps
+        channel = Channel.get_cached_channel(self.tel_channel.id)
+        for i in range(5):
+            self.assertEqual(0, Channel.get_send_delay(channel))
+
+        # give our channel its own max tps
+        self.tel_channel.config = json.dumps({MAX_TPS: 2})
+        self.tel_channel.save()
+        Channel.clear_cached_channel(self.tel_channel.id)
+
+        channel = Channel.get_cached_channel(self.tel_channel.id)
+        self.assertEqual(0, Channel.get_send_delay(channel))
+        self.assertEqual(0, Channel.get_send_delay(channel))
+        self.assertTrue(Channel.get_send_delay(channel) > 0)
+
+        # org wide limits also apply
+        self.org.config = json.dumps({ORG_MAX_TPS: 1})
+        self.org.save()
+        self.twitter_channel.config = json.dumps({})
+        self.twitter_channel.save()
+
+        channel = Channel.get_cached_channel(self.twitter_channel.id)
+        self.assertEqual(0, Channel.get_send_delay(channel))
+        self.assertTrue(Channel.get_send_delay(channel) > 0)
+
     def test_ensure_normalization(self):
         self.tel_channel.country = 'RW'
         self.tel_channel.save()
@@ -3416,6 +3478,16 @@ class KannelTest(TembaTest):
         assertStatus(sms, '1', DELIVERED)
         assertStatus(sms, '16', FAILED)
 
+        # when staging statuses, they are only applied later
+        with override_settings(STAGE_MSG_STATUSES=True):
+            data['status'] = '1'
+            response = self.client.post(delivery_url, data)
+            self.assertEquals(200, response.status_code)
+            self.assertEquals(FAILED, Msg.all_messages.get(pk=sms.id).status)
+
+        Msg.apply_staged_statuses()
+        self.assertEquals(DELIVERED, Msg.all_messages.get(pk=sms.id).status)
+
     def test_receive(self):
         data = {
             'sender': '0788383383',
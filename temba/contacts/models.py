@@ -11,8 +11,10 @@ from collections import defaultdict
 from django.core.exceptions import ValidationError
 from django.core.files import File
 from django.core.validators import validate_email
-from django.db import models, connection
+from django.db import models, connection, transaction, IntegrityError
 from django.db.models import Count, Max, Q, Sum
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import ugettext, ugettext_lazy as _
 from guardian.utils import get_anonymous_user
@@ -22,7 +24,7 @@ from smartmin.csv_imports.models import ImportTask
 from temba.channels.models import Channel
 from temba.orgs.models import Org, OrgLock
 from temba.utils.email import send_template_email
-from temba.utils import analytics, format_decimal, truncate, datetime_to_str, chunk_list
+from temba.utils import analytics, format_decimal, truncate, datetime_to_str, chunk_list, get_datetime_format
 from temba.utils.models import TembaModel
 from temba.utils.exporter import TableExporter
 from temba.utils.profiler import SegmentProfiler
@@ -39,6 +41,9 @@ END_TEST_CONTACT_PATH = 12065550199
 # how many sequential contacts on import triggers suspension
 SEQUENTIAL_CONTACTS_THRESHOLD = 250
 
+# how many imported rows we buffer before creating their contacts in bulk
+IMPORT_CHUNK_SIZE = 500
+
 TEL_SCHEME = 'tel'
 TWITTER_SCHEME = 'twitter'
 TWILIO_SCHEME = 'twilio'
@@ -350,6 +355,16 @@ class ContactField(SmartModel):
         return "%s" % self.label
 
 
+@receiver(post_save, sender=ContactField)
+@receiver(post_delete, sender=ContactField)
+def invalidate_compiled_queries(sender, instance, **kwargs):
+    """
+    Compiled dynamic group queries resolve fields when they are compiled, so need recompiling when fields change
+    """
+    from .search import bump_fields_version
+    bump_fields_version(instance.org_id)
+
+
 NEW_CONTACT_VARIABLE = "@new_contact"
 
 
@@ -578,6 +593,7 @@ class Contact(TembaModel):
 
         # cache
         self.set_cached_field_value(key, existing)
+        self.clear_message_context_cache()
 
         self.modified_by = user
         self.modified_on = timezone.now()
@@ -592,6 +608,15 @@ class Contact(TembaModel):
     def set_cached_field_value(self, key, value):
         setattr(self, '__field__%s' % key, value)
 
+    def clear_message_context_cache(self):
+        """
+        Clears the groups and fields cached by bulk_cache_initialize for building message contexts, so that changes to
+        them are seen by the next context built for this contact
+        """
+        for attr in ('__active_fields', '__group_names'):
+            if hasattr(self, attr):
+                delattr(self, attr)
+
     def handle_update(self, attrs=(), urns=(), field=None, group=None):
         """
         Handles an update to a contact which can be one of
@@ -654,21 +679,12 @@ class Contact(TembaModel):
 
         contact = None
 
-        # optimize the single URN contact lookup case with an existing contact, this doesn't need a lock as
-        # it is read only from a contacts perspective, but it is by far the most common case
-        if not uuid and not name and urns and len(urns) == 1:
-            existing_urn = ContactURN.lookup(org, urns[0], country)
-
-            if existing_urn and existing_urn.contact:
-                contact = existing_urn.contact
-
-                # update the channel on this URN if this is an incoming message
-                if incoming_channel and incoming_channel != existing_urn.channel:
-                    existing_urn.channel = incoming_channel
-                    existing_urn.save(update_fields=['channel'])
-
-                # return our contact, mapping our existing urn appropriately
-                contact.urn_objects = {urns[0]: existing_urn}
+        # optimize the single URN case, by far the most common, this doesn't need the org lock as we rely on the
+        # unique constraint on URNs to stop two instances creating the same contact
+        if not uuid and not force_urn_update and urns and len(urns) == 1:
+            contact = cls.get_or_create_by_urn(org, user, urns[0], country, name=name, language=language,
+                                               incoming_channel=incoming_channel, is_test=is_test)
+            if contact:
                 return contact
 
         # if we were passed in a UUID, look it up by that
@@ -799,6 +815,74 @@ class Contact(TembaModel):
         contact.handle_update(attrs=updated_attrs, urns=updated_urns)
         return contact
 
+    @classmethod
+    def get_or_create_by_urn(cls, org, user, urn, country, name=None, language=None, incoming_channel=None,
+                             is_test=False):
+        """
+        Gets or creates the contact with the given single URN without taking the org contacts lock. New contacts are
+        created along with their URN in a savepoint, so if another instance creates the same URN before us, we roll
+        back our contact and use theirs instead. Returns None if the URN exists without a contact, which needs to be
+        handled by get_or_create under the lock.
+        """
+        normalized = URN.normalize(urn, country)
+
+        # we only ever need to retry once, after a conflict the URN exists
+        for attempt in range(2):
+            existing_urn = ContactURN.lookup(org, normalized, normalize=False)
+
+            if existing_urn:
+                contact = existing_urn.contact
+                if not contact:
+                    return None
+
+                # update the channel on this URN if this is an incoming message
+                if incoming_channel and incoming_channel != existing_urn.channel:
+                    existing_urn.channel = incoming_channel
+                    existing_urn.save(update_fields=['channel'])
+
+                # update contact name and language if provided
+                updated_attrs = []
+                if name:
+                    contact.name = name
+                    updated_attrs.append(Contact.NAME)
+                if language:
+                    contact.language = language
+                    updated_attrs.append(Contact.LANGUAGE)
+
+                # return our contact, mapping our existing urn appropriately
+                contact.urn_objects = {urn: existing_urn}
+
+                if updated_attrs:
+                    contact.modified_by = user
+                    contact.modified_on = timezone.now()
+                    contact.save(update_fields=updated_attrs + ['modified_by', 'modified_on'])
+
+                    # handle group and campaign updates
+                    contact.handle_update(attrs=updated_attrs, urns=[])
+
+                return contact
+
+            kwargs = dict(org=org, name=name, language=language, is_test=is_test, created_by=user, modified_by=user)
+            try:
+                with transaction.atomic():
+                    contact = Contact.objects.create(**kwargs)
+                    contact_urn = ContactURN.create(org, contact, normalized, channel=incoming_channel)
+            except IntegrityError:
+                # somebody else created this URN first, go back and use their contact
+                continue
+
+            # add attribute which allows import process to track new vs existing
+            contact.is_new = True
+            contact.urn_objects = {urn: contact_urn}
+
+            analytics.gauge('temba.contact_created')
+
+            # handle group and campaign updates
+            contact.handle_update(attrs=kwargs.keys(), urns=[urn])
+            return contact
+
+        return None  # pragma: no cover
+
     @classmethod
     def get_test_contact(cls, user):
         """
@@ -855,7 +939,8 @@ class Contact(TembaModel):
 
         org = field_dict.pop('org')
         user = field_dict.pop('created_by')
-        is_admin = org.administrators.filter(id=user.id).exists()
+        importer = field_dict.pop('importer', None)
+        is_admin = importer.is_admin if importer else org.administrators.filter(id=user.id).exists()
         uuid = field_dict.pop('uuid', None)
 
         country = org.get_country_code()
@@ -901,10 +986,9 @@ class Contact(TembaModel):
                     raise SmartImportRowError("Ignored test contact")
 
             urn = URN.from_parts(urn_scheme, value)
-            search_contact = Contact.from_urn(org, urn, country)
 
             # if this is an anonymous org, don't allow updating
-            if org.is_anon and search_contact and not is_admin:
+            if org.is_anon and not is_admin and Contact.from_urn(org, urn, country):
                 raise SmartImportRowError("Other existing contact on anonymous organization")
 
             urns.append(urn)
@@ -924,24 +1008,37 @@ class Contact(TembaModel):
         if language is not None and len(language) != 3:
             language = None  # ignore anything that's not a 3-letter code
 
-        # create new contact or fetch existing one
-        contact = Contact.get_or_create(org, user, name, uuid=uuid, urns=urns, language=language, force_urn_update=True)
-
-        # if they exist and are blocked, unblock them
-        if contact.is_blocked:
-            contact.unblock(user)
-
-        for key in field_dict.keys():
+        fields = {}
+        for key, value in field_dict.items():
             # ignore any reserved fields
             if key in Contact.RESERVED_FIELDS:
                 continue
 
-            value = field_dict[key]
-
             # date values need converted to localized strings
             if isinstance(value, datetime.date):
                 value = org.format_date(value, True)
 
+            fields[key] = value
+
+        # when part of a full import, the importer creates or updates the contact later with the rest of its chunk
+        if importer:
+            return importer.add(name, uuid, urns, language, fields)
+
+        return cls.import_contact(org, user, name, uuid, urns, language, fields)
+
+    @classmethod
+    def import_contact(cls, org, user, name, uuid, urns, language, fields):
+        """
+        Creates or updates a single imported contact
+        """
+        # create new contact or fetch existing one
+        contact = Contact.get_or_create(org, user, name, uuid=uuid, urns=urns, language=language, force_urn_update=True)
+
+        # if they exist and are blocked, unblock them
+        if contact.is_blocked:
+            contact.unblock(user)
+
+        for key, value in fields.items():
             contact.set_field(user, key, value)
 
         return contact
@@ -979,6 +1076,9 @@ class Contact(TembaModel):
             if key not in Contact.RESERVED_FIELDS and key not in extra_fields and key not in active_scheme:
                 del field_dict[key]
 
+        if import_params.get('importer'):
+            field_dict['importer'] = import_params['importer']
+
         return field_dict
 
     @classmethod
@@ -1064,6 +1164,21 @@ class Contact(TembaModel):
 
         import_results = dict()
 
+        # we always create a group after a successful import (strip off 8 character uniquifier by django)
+        group_name = None
+        if import_params and import_params.get('original_filename'):
+            group_name = os.path.splitext(os.path.split(import_params.get('original_filename'))[-1])[0]
+            group_name = group_name.replace('_', ' ').replace('-', ' ').title()
+
+        # rows are buffered by the importer and their contacts created or updated and added to our group a chunk at
+        # a time. The upload is still copied whole to disk and smartmin keeps a placeholder for every row it reads,
+        # so those parts of an import still grow with the size of the file.
+        importer = None
+        if import_params and 'org_id' in import_params:
+            importer = ContactImporter(Org.objects.get(pk=import_params['org_id']), user, log, group_name=group_name,
+                                       task=task)
+            import_params['importer'] = importer
+
         try:
             contacts = cls.import_xls(open(tmp_file), user, import_params, log, import_results)
         except XLRDError:
@@ -1071,48 +1186,31 @@ class Contact(TembaModel):
         finally:
             os.remove(tmp_file)
 
-        # don't create a group if there are no contacts
-        if not contacts:
-            return contacts
-
-        # we always create a group after a successful import (strip off 8 character uniquifier by django)
-        group_name = os.path.splitext(os.path.split(import_params.get('original_filename'))[-1])[0]
-        group_name = group_name.replace('_', ' ').replace('-', ' ').title()
+        if importer:
+            importer.flush()
+            contacts = importer.contact_ids
+            group = importer.group
+            num_creates = importer.num_creates
+        else:
+            # don't create a group if there are no contacts
+            if not contacts:
+                return contacts
 
-        # group org is same as org of any contact in that group
-        group_org = contacts[0].org
-        group = ContactGroup.create(group_org, user, group_name, task)
+            # group org is same as org of any contact in that group
+            group = ContactGroup.create(contacts[0].org, user, group_name, task)
 
-        num_creates = 0
-        for contact in contacts:
             # if contact has is_new attribute, then we have created a new contact rather than updated an existing one
-            if getattr(contact, 'is_new', False):
-                num_creates += 1
+            num_creates = len([c for c in contacts if getattr(c, 'is_new', False)])
+
+            for batch in chunk_list(contacts, IMPORT_CHUNK_SIZE):
+                group.contacts.add(*batch)
 
-            group.contacts.add(contact)
+        if not contacts:
+            return contacts
 
         # if we aren't whitelisted, check for sequential phone numbers
-        if not group_org.is_whitelisted():
-            try:
-                # get all of our phone numbers for the imported contacts
-                paths = [int(u.path) for u in ContactURN.objects.filter(scheme=TEL_SCHEME, contact__in=[c.pk for c in contacts])]
-                paths = sorted(paths)
-
-                last_path = None
-                sequential = 0
-                for path in paths:
-                    if last_path:
-                        if path - last_path == 1:
-                            sequential += 1
-                    last_path = path
-
-                    if sequential > SEQUENTIAL_CONTACTS_THRESHOLD:
-                        group_org.set_suspended()
-                        break
-
-            except Exception:  # pragma: no-cover
-                # if we fail to parse phone numbers for any reason just punt
-                pass
+        if not group.org.is_whitelisted() and cls.count_sequential_numbers(group) > SEQUENTIAL_CONTACTS_THRESHOLD:
+            group.org.set_suspended()
 
         import_results['creates'] = num_creates
         import_results['updates'] = len(contacts) - num_creates
@@ -1120,6 +1218,22 @@ class Contact(TembaModel):
 
         return contacts
 
+    @classmethod
+    def count_sequential_numbers(cls, group):
+        """
+        Counts how many of the numeric phone numbers of the contacts in the given group directly follow another of
+        them, in the database rather than loading every number
+        """
+        members_table = ContactGroup.contacts.through._meta.db_table
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM ('
+                           '  SELECT u.path::bigint - LAG(u.path::bigint) OVER (ORDER BY u.path::bigint) AS diff'
+                           '  FROM contacts_contacturn u INNER JOIN %s m ON m.contact_id = u.contact_id'
+                           '  WHERE m.contactgroup_id = %%s AND u.scheme = %%s AND u.path ~ %%s'
+                           ') d WHERE d.diff = 1' % members_table, [group.pk, TEL_SCHEME, r'^\+?[0-9]{1,18}$'])
+            return cursor.fetchone()[0]
+
     @classmethod
     def apply_action_label(cls, user, contacts, group, add):
         return group.update_contacts(user, contacts, add)
@@ -1264,6 +1378,35 @@ class Contact(TembaModel):
             contact = contact_map[urn.contact_id]
             getattr(contact, '__urns').append(urn)
 
+        # when we've loaded every field, also cache what we need to build message contexts without further queries
+        if not for_show_only:
+            active_fields = [f for f in fields if f.is_active]
+            for field in active_fields:
+                field.org = org
+
+            group_names = {contact_id: [] for contact_id in contact_map.keys()}
+            memberships = ContactGroup.contacts.through.objects.filter(contact_id__in=contact_map.keys())
+            memberships = memberships.filter(contactgroup__group_type=ContactGroup.TYPE_USER_DEFINED)
+            for contact_id, group_name in memberships.values_list('contact_id', 'contactgroup__name'):
+                group_names[contact_id].append(group_name)
+
+            for contact in contacts:
+                setattr(contact, '__active_fields', active_fields)
+                setattr(contact, '__group_names', group_names[contact.id])
+
+                if contact.org_id == org.id:
+                    contact.org = org
+
+    @classmethod
+    def bulk_build_message_context(cls, org, contacts):
+        """
+        Builds the message contexts for the passed in contacts, loading their fields, values, groups and URNs in a
+        constant number of queries. Returns a dict of contact id to message context.
+        """
+        cls.bulk_cache_initialize(org, contacts)
+
+        return {contact.id: contact.build_message_context() for contact in contacts}
+
     def build_message_context(self):
         """
         Builds a dictionary suitable for use in variable substitution in messages.
@@ -1273,7 +1416,6 @@ class Contact(TembaModel):
         contact_dict[Contact.NAME] = self.name if self.name else ''
         contact_dict[Contact.FIRST_NAME] = self.first_name(org)
         contact_dict['tel_e164'] = self.get_urn_display(scheme=TEL_SCHEME, org=org, full=True)
-        contact_dict['groups'] = ",".join([_.name for _ in self.user_groups.all()])
         contact_dict['uuid'] = self.uuid
         contact_dict[Contact.LANGUAGE] = self.language
 
@@ -1282,15 +1424,26 @@ class Contact(TembaModel):
             urn_value = self.get_urn_display(scheme=scheme, org=org)
             contact_dict[scheme] = urn_value if urn_value is not None else ''
 
-        field_values = Value.objects.filter(contact=self).exclude(contact_field=None)\
-                                                         .exclude(contact_field__is_active=False)\
-                                                         .select_related('contact_field')
+        # use our groups, fields and values if they've been loaded by bulk_cache_initialize, otherwise fetch them
+        if hasattr(self, '__active_fields'):
+            group_names = getattr(self, '__group_names')
+            active_fields = getattr(self, '__active_fields')
+            contact_values = {f.key: getattr(self, '__field__%s' % f.key) for f in active_fields}
+        else:
+            group_names = [g.name for g in self.user_groups.all()]
+            active_fields = ContactField.objects.filter(org_id=self.org_id, is_active=True).select_related('org')
+
+            field_values = Value.objects.filter(contact=self).exclude(contact_field=None)\
+                                                             .exclude(contact_field__is_active=False)\
+                                                             .select_related('contact_field')
 
-        # get all the values for this contact
-        contact_values = {v.contact_field.key: v for v in field_values}
+            # get all the values for this contact
+            contact_values = {v.contact_field.key: v for v in field_values}
+
+        contact_dict['groups'] = ",".join(group_names)
 
         # add all active fields to our context
-        for field in ContactField.objects.filter(org_id=self.org_id, is_active=True).select_related('org'):
+        for field in active_fields:
             field_value = Contact.get_field_display_for_value(field, contact_values.get(field.key, None))
             contact_dict[field.key] = field_value if field_value is not None else ''
 
@@ -1424,6 +1577,8 @@ class Contact(TembaModel):
         for group in add_groups:
             group.update_contacts(user, [self], True)
 
+        self.clear_message_context_cache()
+
     def get_display(self, org=None, full=False, short=False):
         """
         Gets a displayable name or URN for the contact. If available, org can be provided to avoid having to fetch it
@@ -1474,6 +1629,205 @@ class Contact(TembaModel):
         return self.get_display()
 
 
+class ContactImporter(object):
+    """
+    Buffers the rows of a contact import so that they can be processed a chunk at a time. URNs for each chunk are
+    looked up with a single query, contacts which don't exist yet are created in bulk, and rows which match existing
+    contacts are updated one by one. If given a group name, each chunk's contacts are added to a group of that name,
+    which is created with the first chunk. Only the ids of imported contacts are kept once their chunk is done.
+    """
+    def __init__(self, org, user, log=None, chunk_size=IMPORT_CHUNK_SIZE, group_name=None, task=None):
+        self.org = org
+        self.user = user
+        self.log = log
+        self.chunk_size = chunk_size
+        self.group_name = group_name
+        self.task = task
+        self.country = org.get_country_code()
+        self.is_admin = org.administrators.filter(id=user.id).exists()
+
+        self.pending = []
+        self.contact_ids = []
+        self.num_creates = 0
+        self.num_rows = 0
+        self.group = None
+        self.locations = dict()
+
+    def add(self, name, uuid, urns, language, fields):
+        """
+        Adds a row to be imported, returning an unsaved contact as a placeholder for it
+        """
+        normalized = []
+        for urn in urns:
+            urn = URN.normalize(urn, self.country)
+            if urn not in normalized:
+                normalized.append(urn)
+
+        contact = Contact(org=self.org, name=name, language=language, created_by=self.user, modified_by=self.user)
+
+        self.pending.append(dict(contact=contact, uuid=uuid, urns=urns, normalized=normalized, fields=fields))
+
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+
+        return contact
+
+    def flush(self):
+        """
+        Creates or updates the contacts for all pending rows
+        """
+        if not self.pending:
+            return
+
+        rows, self.pending = self.pending, []
+
+        keys = set([key for row in rows for key in row['fields'].keys()])
+        fields = {f.key: f for f in ContactField.objects.filter(org=self.org, key__in=keys, is_active=True)}
+        for key in keys:
+            if key not in fields:
+                fields[key] = ContactField.get_or_create(self.org, self.user, key)
+
+        # rows are new if they aren't updating by UUID and none of their URNs exist already or appear in an earlier
+        # row. Rows with district or ward values depend on their other values so are also imported one at a time.
+        existing = self.get_existing_urns(rows)
+        claimed = set()
+        new_rows = []
+        for row in rows:
+            if not row['uuid'] and not self.has_dependent_values(row, fields):
+                if not [urn for urn in row['normalized'] if urn in existing or urn in claimed]:
+                    new_rows.append(row)
+
+            claimed.update(row['normalized'])
+
+        if new_rows:
+            with self.org.lock_on(OrgLock.contacts):
+                # check again now that we have the lock that nobody else has created these URNs
+                existing = self.get_existing_urns(new_rows)
+                new_rows = [row for row in new_rows if not [urn for urn in row['normalized'] if urn in existing]]
+
+                try:
+                    with transaction.atomic():
+                        self.create_contacts(new_rows, fields)
+                except IntegrityError:
+                    # URNs were created by something that doesn't take the lock, so import these one at a time
+                    new_rows = []
+
+            self.handle_created(new_rows)
+
+        contacts = []
+        for row in rows:
+            if row.get('is_new'):
+                contacts.append(row['contact'])
+                self.num_creates += 1
+            else:
+                contact = row['contact']
+                contacts.append(Contact.import_contact(self.org, self.user, contact.name, row['uuid'],
+                                                       row['urns'], contact.language, row['fields']))
+
+        if self.group_name and contacts:
+            if not self.group:
+                self.group = ContactGroup.create(self.org, self.user, self.group_name, self.task)
+            self.group.contacts.add(*contacts)
+
+        self.contact_ids += [c.pk for c in contacts]
+        self.num_rows += len(rows)
+        if self.log:
+            self.log.write("Imported %d rows\n" % self.num_rows)
+
+    def get_existing_urns(self, rows):
+        urns = [urn for row in rows for urn in row['normalized']]
+        if not urns:
+            return set()
+
+        return set(ContactURN.objects.filter(org=self.org, urn__in=urns).values_list('urn', flat=True))
+
+    def has_dependent_values(self, row, fields):
+        dependent_types = (Value.TYPE_DISTRICT, Value.TYPE_WARD)
+
+        for key, value in row['fields'].items():
+            if fields[key].value_type in dependent_types and value is not None and value != '':
+                return True
+        return False
+
+    def create_contacts(self, rows, fields):
+        """
+        Bulk creates the contacts, URNs and values for the given rows
+        """
+        contacts = [row['contact'] for row in rows]
+        Contact.objects.bulk_create(contacts)
+
+        # bulk_create doesn't give us ids so look them up by UUID
+        ids = dict(Contact.objects.filter(org=self.org, uuid__in=[c.uuid for c in contacts]).values_list('uuid', 'id'))
+        for contact in contacts:
+            contact.id = ids[contact.uuid]
+
+        urns = []
+        values = []
+        for row in rows:
+            contact = row['contact']
+
+            for urn in row['normalized']:
+                scheme, path = URN.to_parts(urn)
+                priority = ContactURN.PRIORITY_DEFAULTS.get(scheme, ContactURN.PRIORITY_STANDARD)
+                urns.append(ContactURN(org=self.org, contact=contact, priority=priority,
+                                       scheme=scheme, path=path, urn=urn))
+
+            row['values'] = []
+            for key, value in row['fields'].items():
+                if value is not None and value != '':
+                    row['values'].append(self.build_value(contact, fields[key], value))
+
+            values += row['values']
+
+        ContactURN.objects.bulk_create(urns)
+        Value.objects.bulk_create(values)
+
+        # invalidate our value cache for each contact field
+        for field in set([v.contact_field for v in values]):
+            Value.invalidate_cache(contact_field=field)
+
+    def build_value(self, contact, field, value):
+        """
+        Builds an unsaved value for a contact field in the same way as Contact.set_field
+        """
+        if value not in self.locations:
+            loc_value = self.org.parse_location(value, STATE_LEVEL)
+            self.locations[value] = loc_value[0] if loc_value is not None and len(loc_value) > 0 else None
+
+        loc_value = self.locations[value]
+
+        return Value(contact=contact, contact_field=field, org=self.org, string_value=unicode(value),
+                     decimal_value=self.org.parse_decimal(value), datetime_value=self.org.parse_date(value),
+                     location_value=loc_value, category=loc_value.name if loc_value else None)
+
+    def handle_created(self, rows):
+        """
+        Handles group updates for newly created contacts, which can only be in dynamic groups
+        """
+        if not rows:
+            return
+
+        has_dynamic_groups = ContactGroup.user_groups.filter(org=self.org, is_active=True).exclude(query=None).exists()
+        field_keys = ContactField.objects.filter(org=self.org, is_active=True).values_list('key', flat=True)
+        field_keys = list(field_keys) if has_dynamic_groups else []
+
+        for row in rows:
+            contact = row['contact']
+            contact.is_new = True
+            row['is_new'] = True
+
+            analytics.gauge('temba.contact_created')
+
+            if has_dynamic_groups:
+                # cache all field values so that groups can be evaluated without fetching them
+                for key in field_keys:
+                    contact.set_cached_field_value(key, None)
+                for value in row['values']:
+                    contact.set_cached_field_value(value.contact_field.key, value)
+
+                ContactGroup.reevaluate_dynamic_groups(contact)
+
+
 class ContactURN(models.Model):
     """
     A Universal Resource Name used to uniquely identify contacts, e.g. tel:+1234567890 or twitter:example
@@ -1751,6 +2105,7 @@ class ContactGroup(TembaModel):
 
             if contact_changed:
                 changed.add(contact.pk)
+                contact.clear_message_context_cache()
                 contact.handle_update(group=self)
 
         # invalidate our result cache for anybody depending on this group if it changed
@@ -1794,18 +2149,33 @@ class ContactGroup(TembaModel):
         if field:
             qs_args['query_fields__pk'] = field.id
 
+        affected_dynamic_groups = list(cls.user_groups.filter(**qs_args).exclude(query=None))
+        if not affected_dynamic_groups:
+            return False
+
+        from .search import compile_predicate
+
+        # fetch current membership of all affected groups at once
+        group_ids = [g.pk for g in affected_dynamic_groups]
+        member_of = set(contact.all_groups.filter(pk__in=group_ids).values_list('pk', flat=True))
+
+        # same restrictions as the base queryset used by Contact.search
+        searchable = contact.is_active and not contact.is_blocked and not contact.is_test
+
         group_change = False
         user = get_anonymous_user()
-        affected_dynamic_groups = cls.user_groups.filter(**qs_args).exclude(query=None)
 
         for group in affected_dynamic_groups:
-            qs, is_complex = Contact.search(group.org, group.query)  # generate group query
-            qualifies = qs.filter(pk=contact.id).count() == 1        # should contact now be in group?
-            changed = group._update_contacts(user, [contact], qualifies)
+            # evaluate the group query against this contact in memory rather than re-running it against every contact
+            qualifies = searchable and compile_predicate(contact.org, group.query)(contact)
 
-            if changed:
+            if qualifies != (group.pk in member_of):
+                group._update_contacts(user, [contact], qualifies)
                 group_change = True
 
+        if group_change:
+            contact.clear_message_context_cache()
+
         return group_change
 
     @classmethod
@@ -1982,6 +2352,75 @@ class ExportContactsTask(SmartModel):
 
         return fields, scheme_counts
 
+    def get_field_values(self, contact_fields, contact_ids):
+        """
+        Gets the display values of the given contact fields for the given contacts, as a map of contact id to a map of
+        contact field id to display value. Values are pivoted into a column per field so this is a single query.
+        """
+        if not contact_fields or not contact_ids:
+            return {}
+
+        columns = []
+        for field in contact_fields:
+            if field.value_type == Value.TYPE_DATETIME:
+                value = "v.datetime_value"
+            elif field.value_type == Value.TYPE_DECIMAL:
+                value = "v.decimal_value"
+            elif field.value_type in [Value.TYPE_STATE, Value.TYPE_DISTRICT, Value.TYPE_WARD]:
+                value = "COALESCE(l.name, NULLIF(v.category, ''), v.string_value)"
+            else:
+                value = "COALESCE(NULLIF(v.category, ''), v.string_value)"
+
+            columns.append("MAX(CASE WHEN v.contact_field_id = %d THEN %s END)" % (field.id, value))
+
+        sql = "SELECT v.contact_id, %s FROM values_value v " \
+              "LEFT OUTER JOIN locations_adminboundary l ON l.id = v.location_value_id " \
+              "WHERE v.contact_id = ANY(%%s) AND v.contact_field_id = ANY(%%s) " \
+              "GROUP BY v.contact_id" % ", ".join(columns)
+
+        date_format = get_datetime_format(self.org.get_dayfirst())[1]
+        tz = self.org.get_tzinfo()
+
+        values_by_id = {}
+        with connection.cursor() as c:
+            c.execute(sql, [list(contact_ids), [f.id for f in contact_fields]])
+
+            for row in c.fetchall():
+                field_values = {}
+                for field, value in zip(contact_fields, row[1:]):
+                    if value is None:
+                        continue
+                    if field.value_type == Value.TYPE_DATETIME:
+                        value = datetime_to_str(value, date_format, False, tz)
+                    elif field.value_type == Value.TYPE_DECIMAL:
+                        value = format_decimal(value)
+
+                    field_values[field.id] = value
+
+                values_by_id[row[0]] = field_values
+
+        return values_by_id
+
+    def get_urn_paths(self, schemes, contact_ids):
+        """
+        Gets the URN paths of the given schemes for the given contacts, as a map of contact id to a map of scheme to
+        paths in priority order, aggregated into a row per contact and scheme by a single query.
+        """
+        if not schemes or not contact_ids:
+            return {}
+
+        sql = "SELECT contact_id, scheme, array_agg(path ORDER BY priority DESC, id) FROM contacts_contacturn " \
+              "WHERE contact_id = ANY(%s) AND scheme = ANY(%s) GROUP BY contact_id, scheme"
+
+        urns_by_id = defaultdict(dict)
+        with connection.cursor() as c:
+            c.execute(sql, [list(contact_ids), list(set(schemes))])
+
+            for contact_id, scheme, paths in c.fetchall():
+                urns_by_id[contact_id][scheme] = paths
+
+        return urns_by_id
+
     def do_export(self):
         fields, scheme_counts = self.get_export_fields_and_schemes()
 
@@ -1995,6 +2434,9 @@ class ExportContactsTask(SmartModel):
         # create our exporter
         exporter = TableExporter("Contact", [c['label'] for c in fields])
 
+        contact_fields = [f['field'] for f in fields if f['field']]
+        urn_schemes = [f['urn_scheme'] for f in fields if f['urn_scheme']]
+
         current_contact = 0
         start = time.time()
 
@@ -2003,41 +2445,32 @@ class ExportContactsTask(SmartModel):
             with SegmentProfiler("output 500 contacts"):
                 batch_ids = list(batch_ids)
 
-                # fetch all the contacts for our batch
-                batch_contacts = Contact.objects.filter(id__in=batch_ids).select_related('org')
-
                 # to maintain our sort, we need to lookup by id, create a map of our id->contact to aid in that
-                contact_by_id = {c.id: c for c in batch_contacts}
+                contact_by_id = {c[0]: c for c in Contact.objects.filter(id__in=batch_ids).values_list('id', 'uuid', 'name')}
 
-                # bulk initialize them
-                Contact.bulk_cache_initialize(self.org, batch_contacts)
+                # fetch the field values and URNs of the whole batch at once
+                values_by_id = self.get_field_values(contact_fields, batch_ids)
+                urns_by_id = self.get_urn_paths(urn_schemes, batch_ids)
 
                 for contact_id in batch_ids:
-                    contact = contact_by_id[contact_id]
+                    contact_id, contact_uuid, contact_name = contact_by_id[contact_id]
+                    field_values = values_by_id.get(contact_id, {})
+                    urn_paths = urns_by_id.get(contact_id, {})
 
                     values = []
                     for col in range(len(fields)):
                         field = fields[col]
 
                         if field['key'] == Contact.NAME:
-                            field_value = contact.name
+                            field_value = contact_name
                         elif field['key'] == Contact.UUID:
-                            field_value = contact.uuid
+                            field_value = contact_uuid
                         elif field['urn_scheme'] is not None:
-                            contact_urns = contact.get_urns()
-                            scheme_urns = []
-                            for urn in contact_urns:
-                                if urn.scheme == field['urn_scheme']:
-                                    scheme_urns.append(urn)
+                            scheme_paths = urn_paths.get(field['urn_scheme'], [])
                             position = field['position']
-                            if len(scheme_urns) > position:
-                                urn_obj = scheme_urns[position]
-                                field_value = urn_obj.get_display(org=self.org, full=True) if urn_obj else ''
-                            else:
-                                field_value = ''
+                            field_value = scheme_paths[position] if len(scheme_paths) > position else ''
                         else:
-                            value = contact.get_field(field['key'])
-                            field_value = Contact.get_field_display_for_value(field['field'], value)
+                            field_value = field_values.get(field['id'])
 
                         if field_value is None:
                             field_value = ''
@@ -1,19 +1,24 @@
 from __future__ import unicode_literals
 
+import operator
 import ply.lex as lex
 import pytz
+import threading
 
+from collections import OrderedDict
 from datetime import timedelta
 from decimal import Decimal
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.models import Q
 from ply import yacc
+from redis_cache import get_redis_connection
 from temba.utils import str_to_datetime
 from temba.values.models import Value
 
 # Originally based on this DSL for Django ORM: http://www.matthieuamiguet.ch/blog/my-djangocon-eu-slides-are-online
-# Changed to produce querysets rather than Q queries, as Q queries that reference different objects can't be properly
-# combined in AND expressions.
+# Changed to produce a tree of comparisons which can be compiled into a single Q query (each comparison on a contact
+# field is a subquery on values so they can be properly combined in AND expressions without duplicate producing joins),
+# or into predicates which test a single contact in memory.
 
 PROPERTY_ALIASES = None  # initialised in contact_search to avoid circular import
 
@@ -44,6 +49,23 @@ DATETIME_LOOKUP_ALIASES = {
     '<=': 'lte'
 }
 
+LOOKUP_OPERATORS = {
+    'exact': operator.eq,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le
+}
+
+CONTACT_FIELDS_VERSION_KEY = 'org:%d:contact_fields_version'  # incremented whenever an org's contact fields change
+
+COMPILED_QUERY_CACHE_SIZE = 1000  # how many parsed and compiled queries we keep in memory
+
+compiled_queries = OrderedDict()
+compiled_queries_lock = threading.Lock()
+
+search_parser_lock = threading.Lock()  # PLY parsers aren't re-entrant
+
 
 class SearchException(Exception):
     """
@@ -61,10 +83,7 @@ def contact_search(org, query, base_queryset):
     :param base_queryset: the base query set which queries operate on
     :return: a tuple of the contact query set, a boolean whether query was complex
     """
-    from .models import ContactURN
-    global PROPERTY_ALIASES
-    if not PROPERTY_ALIASES:
-        PROPERTY_ALIASES = {scheme: 'urns__path' for scheme, label in ContactURN.SCHEME_CHOICES}
+    init_property_aliases()
 
     try:
         return contact_search_complex(org, query, base_queryset), True
@@ -75,6 +94,13 @@ def contact_search(org, query, base_queryset):
     return contact_search_simple(org, query, base_queryset), False
 
 
+def init_property_aliases():
+    from .models import ContactURN
+    global PROPERTY_ALIASES
+    if not PROPERTY_ALIASES:
+        PROPERTY_ALIASES = {scheme: 'urns__path' for scheme, label in ContactURN.SCHEME_CHOICES}
+
+
 def contact_search_simple(org, query, base_queryset):
     """
     Performs a simple term based search, e.g. 'Bob' or '250783835665'
@@ -105,68 +131,161 @@ def contact_search_complex(org, query, base_queryset):
     """
     Performs a complex query based search, e.g. 'name = "Bob" AND age > 18'
     """
-    global search_lexer, search_parser
+    return base_queryset.filter(compile_query(org, query))
 
-    # attach context to the lexer
-    search_lexer.org = org
-    search_lexer.base_queryset = base_queryset
 
-    # combining results from multiple joins can lead to duplicates
-    return search_parser.parse(query, lexer=search_lexer).distinct()
+def get_cached(key, generate):
+    """
+    Gets a parsed or compiled query from our LRU cache, generating and caching it if it doesn't exist
+    """
+    with compiled_queries_lock:
+        if key in compiled_queries:
+            value = compiled_queries.pop(key)
+            compiled_queries[key] = value  # re-insert as most recently used
+            return value
 
+    value = generate()
 
-def generate_queryset(lexer, identifier, comparator, value):
+    with compiled_queries_lock:
+        compiled_queries[key] = value
+        while len(compiled_queries) > COMPILED_QUERY_CACHE_SIZE:
+            compiled_queries.popitem(last=False)
+
+    return value
+
+
+def get_org_cache_key(org, query):
     """
-    Generates a queryset from the base and given field condition
-    :param lexer: the lexer
-    :param identifier: the contact attribute or field name, e.g. name
-    :param comparator: the comparator, e.g. =
-    :param value: the literal value, e.g. "Bob"
-    :return: the query set
+    Gets the cache key for a query compiled for the given org. This includes everything about the org which affects
+    how a query is compiled, and the version of its contact fields so that changing a field invalidates its queries.
+    """
+    return org.id, org.timezone, org.date_format, org.is_anon, query, get_fields_version(org)
+
+
+def parse_query(query):
+    """
+    Parses a complex query into a tree of ('and' | 'or', left, right) and ('comparison', identifier, comparator, value)
+    nodes, raising a SearchException if it isn't a valid complex query. Trees don't depend on the org so are cached
+    by query alone.
+    """
+    def parse():
+        try:
+            with search_parser_lock:
+                return search_parser.parse(query, lexer=search_lexer.clone())
+        except SearchException as e:
+            return e
+
+    tree = get_cached(('tree', query), parse)
+    if isinstance(tree, SearchException):
+        raise tree
+
+    return tree
+
+
+def compile_query(org, query):
+    """
+    Compiles a complex query into a single Q object for the given org, raising a SearchException if it isn't a valid
+    complex query for that org. Compiled queries are cached until the org's contact fields change.
     """
-    # resolve identifier aliases, e.g. '>' -> 'gt'
+    init_property_aliases()
+
+    def generate():
+        try:
+            return generate_q(org, parse_query(query))
+        except SearchException as e:
+            return e
+
+    q = get_cached(('query',) + get_org_cache_key(org, query), generate)
+    if isinstance(q, SearchException):
+        raise q
+
+    return q
+
+
+def generate_q(org, node):
+    """
+    Generates a Q object from the given node of a parsed query
+    """
+    if node[0] == 'comparison':
+        return generate_comparison(org, node[1], node[2], node[3])
+
+    left = generate_q(org, node[1])
+    right = generate_q(org, node[2])
+
+    return (left & right) if node[0] == 'and' else (left | right)
+
+
+def resolve_identifier(org, identifier):
+    """
+    Resolves an identifier to a tuple of the non-field property or field key, and the contact field if there is one
+    """
+    # resolve identifier aliases, e.g. 'tel' -> 'urns__path'
     if identifier in PROPERTY_ALIASES.keys():
         identifier = PROPERTY_ALIASES[identifier]
 
     if identifier in NON_FIELD_PROPERTIES:
-        if identifier == 'urns__path' and lexer.org.is_anon:
+        if identifier == 'urns__path' and org.is_anon:
             raise SearchException("Cannot search by URN in anonymous org")
 
-        q = generate_non_field_comparison(identifier, comparator, value)
-    else:
-        from temba.contacts.models import ContactField
-        try:
-            field = ContactField.objects.get(org_id=lexer.org.id, key=identifier)
-        except ObjectDoesNotExist:
-            raise SearchException("Unrecognized contact field identifier %s" % identifier)
-
-        if comparator.lower() in ('=', 'is') and value == "":
-            q = generate_empty_field_test(field)
-        elif field.value_type == Value.TYPE_TEXT:
-            q = generate_text_field_comparison(field, comparator, value)
-        elif field.value_type == Value.TYPE_DECIMAL:
-            q = generate_decimal_field_comparison(field, comparator, value)
-        elif field.value_type == Value.TYPE_DATETIME:
-            q = generate_datetime_field_comparison(field, comparator, value, lexer.org)
-        elif field.value_type == Value.TYPE_STATE or field.value_type == Value.TYPE_DISTRICT:
-            q = generate_location_field_comparison(field, comparator, value)
-        else:
-            raise SearchException("Unrecognized contact field type '%s'" % field.value_type)
+        return identifier, None
 
-    return lexer.base_queryset.filter(q)
+    from temba.contacts.models import ContactField
+    try:
+        return identifier, ContactField.objects.get(org_id=org.id, key=identifier)
+    except ObjectDoesNotExist:
+        raise SearchException("Unrecognized contact field identifier %s" % identifier)
 
 
-def generate_non_field_comparison(relation, comparator, value):
+def generate_comparison(org, identifier, comparator, value):
+    """
+    Generates a Q object for the given field condition
+    :param org: the org
+    :param identifier: the contact attribute or field name, e.g. name
+    :param comparator: the comparator, e.g. =
+    :param value: the literal value, e.g. "Bob"
+    :return: the Q object
+    """
+    identifier, field = resolve_identifier(org, identifier)
+
+    if not field:
+        return generate_non_field_comparison(org, identifier, comparator, value)
+    elif comparator.lower() in ('=', 'is') and value == "":
+        return generate_empty_field_test(field)
+    elif field.value_type == Value.TYPE_TEXT:
+        return generate_text_field_comparison(field, comparator, value)
+    elif field.value_type == Value.TYPE_DECIMAL:
+        return generate_decimal_field_comparison(field, comparator, value)
+    elif field.value_type == Value.TYPE_DATETIME:
+        return generate_datetime_field_comparison(field, comparator, value, org)
+    elif field.value_type == Value.TYPE_STATE or field.value_type == Value.TYPE_DISTRICT:
+        return generate_location_field_comparison(field, comparator, value)
+    else:
+        raise SearchException("Unrecognized contact field type '%s'" % field.value_type)
+
+
+def generate_non_field_comparison(org, relation, comparator, value):
     lookup = TEXT_LOOKUP_ALIASES.get(comparator, None)
     if not lookup:
         raise SearchException("Unsupported comparator %s for non-field" % comparator)
 
+    if relation == 'urns__path':
+        from temba.contacts.models import ContactURN
+        urns = ContactURN.objects.filter(**{'org_id': org.id, 'path__%s' % lookup: value})
+        return Q(pk__in=urns.values('contact'))
+
     return Q(**{'%s__%s' % (relation, lookup): value})
 
 
+def generate_field_values_test(field, **kwargs):
+    """
+    Generates a Q object which matches contacts with a value for the given field matching the given lookups
+    """
+    values = Value.objects.filter(contact_field_id=field.id, **kwargs)
+    return Q(pk__in=values.values('contact'))
+
+
 def generate_empty_field_test(field):
-    contacts_with_field = field.org.org_contacts.filter(Q(**{'values__contact_field__id': field.id}))
-    return ~Q(**{'pk__in': contacts_with_field})
+    return ~generate_field_values_test(field)
 
 
 def generate_text_field_comparison(field, comparator, value):
@@ -174,7 +293,7 @@ def generate_text_field_comparison(field, comparator, value):
     if not lookup:
         raise SearchException("Unsupported comparator %s for text field" % comparator)
 
-    return Q(**{'values__contact_field__id': field.id, 'values__string_value__%s' % lookup: value})
+    return generate_field_values_test(field, **{'string_value__%s' % lookup: value})
 
 
 def generate_decimal_field_comparison(field, comparator, value):
@@ -187,7 +306,7 @@ def generate_decimal_field_comparison(field, comparator, value):
     except Exception:
         raise SearchException("Can't convert '%s' to a decimal" % unicode(value))
 
-    return Q(**{'values__contact_field__id': field.id, 'values__decimal_value__%s' % lookup: value})
+    return generate_field_values_test(field, **{'decimal_value__%s' % lookup: value})
 
 
 def generate_datetime_field_comparison(field, comparator, value, org):
@@ -206,20 +325,14 @@ def generate_datetime_field_comparison(field, comparator, value, org):
     value = local_date.astimezone(pytz.utc)
 
     if lookup == '<equal>':  # check if datetime is between date and date + 1d, i.e. anytime in that 24 hour period
-        return Q(**{
-            'values__contact_field__id': field.id,
-            'values__datetime_value__gte': value,
-            'values__datetime_value__lt': value + timedelta(days=1)})
+        return generate_field_values_test(field, datetime_value__gte=value,
+                                          datetime_value__lt=value + timedelta(days=1))
     elif lookup == 'lte':  # check if datetime is less then date + 1d, i.e. that day and all previous
-        return Q(**{
-            'values__contact_field__id': field.id,
-            'values__datetime_value__lt': value + timedelta(days=1)})
+        return generate_field_values_test(field, datetime_value__lt=value + timedelta(days=1))
     elif lookup == 'gt':  # check if datetime is greater than or equal to date + 1d, i.e. day after and subsequent
-        return Q(**{
-            'values__contact_field__id': field.id,
-            'values__datetime_value__gte': value + timedelta(days=1)})
+        return generate_field_values_test(field, datetime_value__gte=value + timedelta(days=1))
     else:
-        return Q(**{'values__contact_field__id': field.id, 'values__datetime_value__%s' % lookup: value})
+        return generate_field_values_test(field, **{'datetime_value__%s' % lookup: value})
 
 
 def generate_location_field_comparison(field, comparator, value):
@@ -227,9 +340,177 @@ def generate_location_field_comparison(field, comparator, value):
     if not lookup:
         raise SearchException("Unsupported comparator %s for location field" % comparator)
 
-    return Q(**{
-        'values__contact_field__id': field.id,
-        'values__location_value__name__%s' % lookup: value})
+    return generate_field_values_test(field, **{'location_value__name__%s' % lookup: value})
+
+
+# ================================== In-memory predicates ==================================
+
+def get_fields_version(org):
+    """
+    Gets the current version of the given org's contact fields
+    """
+    r = get_redis_connection()
+    return int(r.get(CONTACT_FIELDS_VERSION_KEY % org.id) or 0)
+
+
+def bump_fields_version(org_id):
+    """
+    Invalidates all compiled queries for the given org, called whenever one of its contact fields changes
+    """
+    r = get_redis_connection()
+    r.incr(CONTACT_FIELDS_VERSION_KEY % org_id)
+
+
+def compile_predicate(org, query):
+    """
+    Compiles a query into a function which tests whether a single contact matches, e.g. for re-evaluating dynamic
+    group membership after a contact changes without querying for every contact in the group. Compiled queries are
+    cached until the org's contact fields change.
+    :param org: the org
+    :param query: the query, e.g. 'name = "Bob"'
+    :return: a function which takes a contact and returns whether it matches
+    """
+    init_property_aliases()
+
+    def generate():
+        try:
+            return generate_predicate(org, parse_query(query))
+        except SearchException:
+            return generate_simple_predicate(org, query)
+
+    return get_cached(('predicate',) + get_org_cache_key(org, query), generate)
+
+
+def generate_simple_predicate(org, query):
+    """
+    Generates a predicate equivalent to contact_search_simple
+    """
+    terms = [term.upper() for term in query.split()]
+
+    def predicate(contact):
+        name = (contact.name or "").upper()
+        paths = [] if org.is_anon else [urn.path.upper() for urn in contact.get_urns()]
+
+        for term in terms:
+            if term in name or any(term in path for path in paths):
+                continue
+            if org.is_anon and term.isdigit() and int(term) == contact.pk:
+                continue
+            return False
+
+        return True
+
+    return predicate
+
+
+def generate_predicate(org, node):
+    """
+    Generates a predicate from the given node of a parsed query
+    """
+    if node[0] == 'comparison':
+        return generate_comparison_predicate(org, node[1], node[2], node[3])
+
+    left = generate_predicate(org, node[1])
+    right = generate_predicate(org, node[2])
+
+    if node[0] == 'and':
+        return lambda contact: left(contact) and right(contact)
+    else:
+        return lambda contact: left(contact) or right(contact)
+
+
+def generate_comparison_predicate(org, identifier, comparator, value):
+    """
+    Generates a predicate for the given field condition which matches the same contacts as generate_comparison
+    """
+    identifier, field = resolve_identifier(org, identifier)
+
+    if not field:
+        test = generate_text_test(comparator, value, "non-field")
+        if identifier == 'name':
+            return lambda contact: contact.name is not None and test(contact.name)
+        else:
+            return lambda contact: any(test(urn.path) for urn in contact.get_urns())
+
+    if comparator.lower() in ('=', 'is') and value == "":
+        return lambda contact: contact.get_field(field.key) is None
+    elif field.value_type == Value.TYPE_TEXT:
+        test = generate_text_test(comparator, value, "text field")
+        attr = lambda v: v.string_value
+    elif field.value_type == Value.TYPE_DECIMAL:
+        test = generate_decimal_test(comparator, value)
+        attr = lambda v: v.decimal_value
+    elif field.value_type == Value.TYPE_DATETIME:
+        test = generate_datetime_test(comparator, value, org)
+        attr = lambda v: v.datetime_value
+    elif field.value_type == Value.TYPE_STATE or field.value_type == Value.TYPE_DISTRICT:
+        test = generate_text_test(comparator, value, "location field")
+        attr = lambda v: v.location_value.name if v.location_value else None
+    else:
+        raise SearchException("Unrecognized contact field type '%s'" % field.value_type)
+
+    def predicate(contact):
+        field_value = contact.get_field(field.key)
+        if field_value is None:
+            return False
+
+        field_value = attr(field_value)
+        return field_value is not None and test(field_value)
+
+    return predicate
+
+
+def generate_text_test(comparator, value, kind):
+    lookup = TEXT_LOOKUP_ALIASES.get(comparator, None)
+    if not lookup:
+        raise SearchException("Unsupported comparator %s for %s" % (comparator, kind))
+
+    value = value.upper()
+
+    if lookup == 'iexact':
+        return lambda v: v.upper() == value
+    else:
+        return lambda v: value in v.upper()
+
+
+def generate_decimal_test(comparator, value):
+    lookup = DECIMAL_LOOKUP_ALIASES.get(comparator, None)
+    if not lookup:
+        raise SearchException("Unsupported comparator %s for decimal field" % comparator)
+
+    try:
+        value = Decimal(value)
+    except Exception:
+        raise SearchException("Can't convert '%s' to a decimal" % unicode(value))
+
+    op = LOOKUP_OPERATORS[lookup]
+    return lambda v: op(v, value)
+
+
+def generate_datetime_test(comparator, value, org):
+    lookup = DATETIME_LOOKUP_ALIASES.get(comparator, None)
+    if not lookup:
+        raise SearchException("Unsupported comparator %s for datetime field" % comparator)
+
+    tz = pytz.timezone(org.timezone)
+    local_date = str_to_datetime(value, tz, org.get_dayfirst(), fill_time=False)
+
+    # passed date wasn't parseable so don't match any contact
+    if not local_date:
+        return lambda v: False
+
+    value = local_date.astimezone(pytz.utc)
+    next_day = value + timedelta(days=1)
+
+    if lookup == '<equal>':
+        return lambda v: value <= v < next_day
+    elif lookup == 'lte':
+        return lambda v: v < next_day
+    elif lookup == 'gt':
+        return lambda v: v >= next_day
+    else:
+        op = LOOKUP_OPERATORS[lookup]
+        return lambda v: op(v, value)
 
 
 # ================================== Lexer definition ==================================
@@ -280,10 +561,7 @@ precedence = (
 
 def p_expression_binop(p):
     """expression : expression BINOP expression"""
-    if p[2].lower() == 'and':
-        p[0] = p[1] & p[3]
-    elif p[2].lower() == 'or':
-        p[0] = p[1] | p[3]
+    p[0] = (p[2].lower(), p[1], p[3])
 
 
 def p_expression_grouping(p):
@@ -293,7 +571,7 @@ def p_expression_grouping(p):
 
 def p_expression_comparison(p):
     """expression : TEXT COMPARATOR literal"""
-    p[0] = generate_queryset(p.lexer, p[1].lower(), p[2].lower(), p[3])
+    p[0] = ('comparison', p[1].lower(), p[2].lower(), p[3])
 
 
 def p_literal(p):
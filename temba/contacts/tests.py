@@ -6,6 +6,7 @@ import pytz
 import time
 
 from datetime import datetime, date, timedelta
+from decimal import Decimal
 from django.core.files.base import ContentFile
 from django.core.urlresolvers import reverse
 from django.conf import settings
@@ -28,7 +29,8 @@ from temba.utils import datetime_to_str, get_datetime_format
 from temba.values.models import Value
 from xlrd import open_workbook
 from .models import Contact, ContactGroup, ContactField, ContactURN, ExportContactsTask, URN, EXTERNAL_SCHEME
-from .models import TEL_SCHEME, TWITTER_SCHEME, EMAIL_SCHEME, ContactGroupCount
+from .models import TEL_SCHEME, TWITTER_SCHEME, EMAIL_SCHEME, ContactGroupCount, ContactImporter
+from .search import compile_predicate, compile_query, parse_query, SearchException
 from .tasks import squash_contactgroupcounts
 
 
@@ -386,6 +388,53 @@ class ContactGroupTest(TembaTest):
         response = self.client.get(filter_url)
         self.assertFalse('unlabel' in response.context['actions'])
 
+    def test_reevaluate_dynamic_groups(self):
+        age = ContactField.get_or_create(self.org, self.admin, 'age', value_type=Value.TYPE_DECIMAL)
+        ContactField.get_or_create(self.org, self.admin, 'gender')
+
+        adults = ContactGroup.create(self.org, self.admin, "Adult women")
+        adults.update_query('age >= 18 and gender = "female"')
+        joes = ContactGroup.create(self.org, self.admin, "Joes")
+        joes.update_query('name ~ joe or tel has 345')
+
+        self.assertEqual(set(joes.contacts.all()), {self.joe, self.mary})
+        self.assertEqual(set(adults.contacts.all()), set())
+
+        # predicates agree with the database search
+        for query in ('age >= 18 and gender = "female"', 'name ~ joe or tel has 345', 'Mary', 'age = ""'):
+            predicate = compile_predicate(self.org, query)
+            matches = {c for c in Contact.objects.filter(org=self.org, is_test=False) if predicate(c)}
+            self.assertEqual(matches, set(Contact.search(self.org, query)[0]))
+
+        self.mary.set_field(self.user, 'gender', "Female")
+        self.assertFalse(adults.contacts.filter(pk=self.mary.pk).exists())
+
+        # only the group which references the field is re-evaluated and only the new member is added
+        with self.assertNumQueries(0):
+            self.assertIs(compile_predicate(self.org, 'age >= 18 and gender = "female"'),
+                          compile_predicate(self.org, 'age >= 18 and gender = "female"'))
+
+        self.mary.set_field(self.user, 'age', "21")
+        self.assertEqual(set(adults.contacts.all()), {self.mary})
+        self.assertEqual(set(joes.contacts.all()), {self.joe, self.mary})
+
+        # changing a name re-evaluates name based groups
+        self.joe.name = "Joseph"
+        self.joe.save()
+        self.joe.handle_update(attrs=(Contact.NAME,))
+        self.assertEqual(set(joes.contacts.all()), {self.mary})
+
+        # blocked contacts drop out of dynamic groups
+        self.mary.block(self.admin)
+        self.mary.set_field(self.user, 'age', "22")
+        self.assertEqual(set(adults.contacts.all()), set())
+
+        # changing a field invalidates compiled queries
+        predicate = compile_predicate(self.org, 'age >= 18')
+        age.label = "Age In Years"
+        age.save()
+        self.assertIsNot(predicate, compile_predicate(self.org, 'age >= 18'))
+
     def test_delete(self):
         group = ContactGroup.create(self.org, self.user, "one")
 
@@ -515,6 +564,33 @@ class ContactTest(TembaTest):
         self.assertEquals(1, snoop.urns.all().count())
         self.assertEqual(snoop.urns.all().first().channel, self.channel)
 
+    def test_get_or_create_by_urn(self):
+        # creating a contact from a single URN doesn't need the org lock
+        with patch('temba.orgs.models.Org.lock_on') as mock_lock_on:
+            joe = Contact.get_or_create(self.org, self.user, name="Joe", urns=['tel:0783835665'])
+            self.assertTrue(joe.is_new)
+            self.assertEqual(joe, Contact.get_or_create(self.org, self.user, name="Joey", urns=['tel:+250783835665']))
+            self.assertFalse(mock_lock_on.called)
+
+        self.assertEqual("Joey", Contact.objects.get(pk=joe.pk).name)
+
+        # pretend another instance created the URN after we looked it up, we should end up with their contact
+        existing_urn = ContactURN.objects.get(urn='tel:+250783835665')
+        with patch('temba.contacts.models.ContactURN.lookup', side_effect=[None, existing_urn]):
+            contact = Contact.get_or_create(self.org, self.user, name="Joe", urns=['tel:+250783835665'])
+
+        self.assertEqual(joe, contact)
+        self.assertEqual(1, Contact.objects.filter(org=self.org, name__in=["Joe", "Joey"]).count())
+
+        # orphaned URNs are still claimed under the lock
+        existing_urn.contact = None
+        existing_urn.save()
+        self.assertIsNone(Contact.get_or_create_by_urn(self.org, self.user, 'tel:+250783835665', 'RW'))
+
+        frank = Contact.get_or_create(self.org, self.user, name="Frank", urns=['tel:+250783835665'])
+        self.assertNotEqual(joe, frank)
+        self.assertEqual(frank, ContactURN.objects.get(urn='tel:+250783835665').contact)
+
     def test_get_test_contact(self):
         test_contact_admin = Contact.get_test_contact(self.admin)
         self.assertTrue(test_contact_admin.is_test)
@@ -937,6 +1013,48 @@ class ContactTest(TembaTest):
             self.assertTrue(contact in Contact.search(self.org, '%d' % contact.pk)[0])
             self.assertTrue(contact in Contact.search(self.org, '%010d' % contact.pk)[0])
 
+    def test_contact_search_compiled(self):
+        age = ContactField.get_or_create(self.org, self.admin, 'age', "Age", value_type=Value.TYPE_DECIMAL)
+        ContactField.get_or_create(self.org, self.admin, 'profession', "Profession", value_type=Value.TYPE_TEXT)
+
+        self.joe.set_field(self.user, 'age', "25")
+        self.joe.set_field(self.user, 'profession', "Teacher")
+        self.frank.set_field(self.user, 'age', "30")
+
+        # parsed trees don't depend on the org
+        self.assertEqual(parse_query('age > 18 AND profession = "teacher"'),
+                         ('and', ('comparison', 'age', '>', '18'), ('comparison', 'profession', '=', 'teacher')))
+        self.assertRaises(SearchException, parse_query, 'age >')
+
+        # compiled queries are reused until fields change
+        query = compile_query(self.org, 'age > 18 AND profession = "teacher"')
+        self.assertIs(query, compile_query(self.org, 'age > 18 AND profession = "teacher"'))
+
+        # and don't need distinct as they don't join on values
+        qs, is_complex = Contact.search(self.org, 'age > 18 AND profession = "teacher"')
+        self.assertTrue(is_complex)
+        self.assertFalse(qs.query.distinct)
+        self.assertEqual(list(qs), [self.joe])
+
+        self.assertEqual(set(Contact.search(self.org, 'age > 18 OR profession = "teacher"')[0]), {self.joe, self.frank})
+        self.assertEqual(set(Contact.search(self.org, 'age = ""')[0]), {self.voldemort, self.billy})
+
+        age.label = "Age In Years"
+        age.save()
+
+        self.assertIsNot(query, compile_query(self.org, 'age > 18 AND profession = "teacher"'))
+
+        # invalid queries are remembered as invalid
+        self.assertRaises(SearchException, compile_query, self.org, 'height > 100')
+        self.assertRaises(SearchException, compile_query, self.org, 'height > 100')
+
+        ContactField.get_or_create(self.org, self.admin, 'height', "Height", value_type=Value.TYPE_DECIMAL)
+        self.assertEqual(list(Contact.search(self.org, 'height > 100')[0]), [])
+
+        # anon orgs compile their own queries
+        with AnonymousOrg(self.org):
+            self.assertRaises(SearchException, compile_query, self.org, 'tel = 123')
+
     def test_omnibox(self):
         # add a group with members and an empty group
         joe_and_frank = self.create_group("Joe and Frank", [self.joe, self.frank])
@@ -2556,6 +2674,53 @@ class ContactTest(TembaTest):
                 model_class="Contact", import_params='bogus!', import_log="", task_id="A")
             Contact.import_csv(task, log=None)
 
+    def test_contact_importer(self):
+        ContactField.get_or_create(self.org, self.admin, 'age', "Age", value_type=Value.TYPE_DECIMAL)
+        adults = ContactGroup.create(self.org, self.admin, "Adults")
+        adults.update_query('age > 18')
+
+        existing = self.create_contact("Existing", number="+250788000001")
+
+        importer = ContactImporter(self.org, self.admin, chunk_size=3, group_name="Imported")
+        importer.add("Bob", None, ['tel:+250788000002'], None, dict(age="21"))
+        importer.add("Jim", None, ['tel:+250788000003'], 'fre', dict(age="12"))
+
+        # rows are buffered until we have a full chunk
+        self.assertFalse(Contact.objects.filter(name__in=["Bob", "Jim"]).exists())
+
+        importer.add("Existing Updated", None, ['tel:+250788000001'], None, dict(age="30"))
+
+        bob = Contact.objects.get(name="Bob")
+        jim = Contact.objects.get(name="Jim")
+        existing = Contact.objects.get(pk=existing.pk)
+
+        self.assertEqual(importer.contact_ids, [bob.pk, jim.pk, existing.pk])
+        self.assertEqual(importer.num_creates, 2)
+        self.assertEqual(existing.name, "Existing Updated")
+        self.assertEqual(jim.language, 'fre')
+        self.assertEqual([u.urn for u in bob.urns.all()], ['tel:+250788000002'])
+        self.assertEqual(bob.get_field_raw('age'), "21")
+        self.assertEqual(bob.get_field('age').decimal_value, Decimal("21"))
+
+        # each chunk's contacts are added to the import group as we go
+        self.assertEqual(importer.group.name, "Imported")
+        self.assertEqual(set(importer.group.contacts.all()), {bob, jim, existing})
+
+        # new contacts are added to dynamic groups too
+        self.assertEqual(set(adults.contacts.all()), {bob, existing})
+
+        # a row which repeats a URN from earlier in the same chunk updates the contact created by that row
+        importer.add("Robert", None, ['tel:+250788000004'], None, {})
+        importer.add("Robert Jr", None, ['tel:+250788000004'], None, {})
+        importer.flush()
+
+        robert = Contact.objects.get(urns__urn='tel:+250788000004')
+        self.assertEqual(robert.name, "Robert Jr")
+        self.assertEqual(importer.contact_ids[3:], [robert.pk, robert.pk])
+        self.assertEqual(importer.num_rows, 5)
+        self.assertEqual(importer.num_creates, 3)
+        self.assertEqual(importer.group.contacts.count(), 4)
+
     def test_contact_import_with_languages(self):
         self.create_contact(name="Eric", number="+250788382382")
 
@@ -2700,6 +2865,59 @@ class ContactTest(TembaTest):
 
         self.assertEqual(Contact.serialize_field_value(color_field, value), 'Dark')
 
+    def test_export_field_values(self):
+        ContactField.get_or_create(self.org, self.admin, 'registration_date', "Registration Date", None,
+                                   Value.TYPE_DATETIME)
+        ContactField.get_or_create(self.org, self.admin, 'weight', "Weight", None, Value.TYPE_DECIMAL)
+        ContactField.get_or_create(self.org, self.admin, 'color', "Color", None, Value.TYPE_TEXT)
+        ContactField.get_or_create(self.org, self.admin, 'state', "State", None, Value.TYPE_STATE)
+        ContactField.get_or_create(self.org, self.admin, 'unset', "Unset", None, Value.TYPE_TEXT)
+        fields = list(ContactField.objects.filter(org=self.org, is_active=True).select_related('org'))
+
+        joe = Contact.objects.get(pk=self.joe.pk)
+        joe.set_field(self.user, 'registration_date', "2014-12-31 03:04:00")
+        joe.set_field(self.user, 'weight', "75.888888")
+        joe.set_field(self.user, 'color', "green")
+        joe.set_field(self.user, 'state', "kigali city")
+        Value.objects.filter(contact=joe, contact_field__key='color').update(category="Dark")
+
+        frank = Contact.objects.get(pk=self.frank.pk)
+        frank.set_field(self.user, 'color', "red")
+
+        joe.update_urns(self.admin, ['tel:+250781111111', 'twitter:joe', 'tel:+250782222222'])
+
+        task = ExportContactsTask.objects.create(org=self.org, host='test', created_by=self.admin,
+                                                 modified_by=self.admin)
+
+        with self.assertNumQueries(1):
+            values_by_id = task.get_field_values(fields, [joe.pk, frank.pk, self.billy.pk])
+
+        # should give the same display values as when we look them up one at a time
+        for contact in (joe, frank):
+            contact = Contact.objects.get(pk=contact.pk)
+            expected = {}
+            for field in fields:
+                value = Contact.get_field_display_for_value(field, contact.get_field(field.key))
+                if value is not None:
+                    expected[field.id] = value
+
+            self.assertEqual(values_by_id[contact.pk], expected)
+
+        self.assertEqual(values_by_id[joe.pk][ContactField.objects.get(key='color').id], "Dark")
+        self.assertEqual(values_by_id[joe.pk][ContactField.objects.get(key='state').id], "Kigali City")
+        self.assertNotIn(self.billy.pk, values_by_id)
+
+        with self.assertNumQueries(1):
+            urns_by_id = task.get_urn_paths([TEL_SCHEME, TWITTER_SCHEME, TEL_SCHEME], [joe.pk, self.billy.pk])
+
+        self.assertEqual(urns_by_id[joe.pk], {TEL_SCHEME: ['+250781111111', '+250782222222'],
+                                              TWITTER_SCHEME: ['joe']})
+
+        # nothing to look up, no queries
+        with self.assertNumQueries(0):
+            self.assertEqual(task.get_field_values([], [joe.pk]), {})
+            self.assertEqual(task.get_urn_paths([TEL_SCHEME], []), {})
+
     def test_set_location_fields(self):
         district_field = ContactField.get_or_create(self.org, self.admin, 'district', 'District', None, Value.TYPE_DISTRICT)
 
@@ -2782,6 +3000,49 @@ class ContactTest(TembaTest):
         self.assertEqual("SeaHawks", message_context['team'])
         self.assertFalse('color' in message_context)
 
+    def test_bulk_build_message_context(self):
+        self.create_group("Reporters", [self.joe, self.frank])
+
+        ContactField.get_or_create(self.org, self.admin, 'team')
+        fav_color = ContactField.get_or_create(self.org, self.admin, 'color')
+
+        self.joe.set_field(self.admin, 'color', "Blue")
+        self.joe.set_field(self.admin, 'team', "SeaHawks")
+        self.frank.set_field(self.admin, 'team', "Packers")
+
+        fav_color.is_active = False
+        fav_color.save()
+
+        contacts = list(Contact.objects.filter(pk__in=[self.joe.pk, self.frank.pk, self.billy.pk]))
+
+        # loading everything for our contacts takes a constant number of queries
+        with self.assertNumQueries(4):
+            contexts = Contact.bulk_build_message_context(self.org, contacts)
+
+        self.assertEqual("Joe", contexts[self.joe.pk]['first_name'])
+        self.assertEqual("123", contexts[self.joe.pk]['tel'])
+        self.assertEqual("Reporters", contexts[self.joe.pk]['groups'])
+        self.assertEqual("SeaHawks", contexts[self.joe.pk]['team'])
+        self.assertFalse('color' in contexts[self.joe.pk])
+
+        self.assertEqual("Reporters", contexts[self.frank.pk]['groups'])
+        self.assertEqual("Packers", contexts[self.frank.pk]['team'])
+
+        self.assertEqual("", contexts[self.billy.pk]['groups'])
+        self.assertEqual("", contexts[self.billy.pk]['team'])
+
+        # and our contexts match those built one by one
+        for contact in contacts:
+            self.assertEqual(Contact.objects.get(pk=contact.pk).build_message_context(), contexts[contact.pk])
+
+        # changes to a contact's fields or groups aren't hidden by what was cached
+        joe = contacts[[c.pk for c in contacts].index(self.joe.pk)]
+        joe.set_field(self.admin, 'age', "34")
+        self.assertEqual("34", joe.build_message_context()['age'])
+
+        joe.update_groups(self.admin, [self.create_group("Seahawks Fans", [])])
+        self.assertEqual("Seahawks Fans", joe.build_message_context()['groups'])
+
     def test_urn_priority(self):
         bob = self.create_contact("Bob")
 
@@ -3069,7 +3330,7 @@ class ContactFieldTest(TembaTest):
         blocking_export.is_finished = True
         blocking_export.save()
 
-        with self.assertNumQueries(35):
+        with self.assertNumQueries(33):
             self.client.get(reverse('contacts.contact_export'), dict())
             task = ExportContactsTask.objects.all().order_by('-id').first()
 
@@ -3093,7 +3354,7 @@ class ContactFieldTest(TembaTest):
         contact4 = self.create_contact('Stephen', '+12078778899', twitter='stephen')
         ContactURN.create(self.org, contact, 'tel:+12062233445')
 
-        with self.assertNumQueries(35):
+        with self.assertNumQueries(33):
             self.client.get(reverse('contacts.contact_export'), dict())
             task = ExportContactsTask.objects.all().order_by('-id').first()
 
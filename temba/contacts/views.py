@@ -18,12 +18,12 @@ from django.http import Http404, HttpResponseRedirect, HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
-from itertools import chain
+from itertools import chain, islice
 from smartmin.csv_imports.models import ImportTask
 from smartmin.views import SmartCreateView, SmartCRUDL, SmartCSVImportView, SmartDeleteView, SmartFormView
 from smartmin.views import SmartListView, SmartReadView, SmartUpdateView, SmartXlsView, smart_url
 from temba.channels.models import ChannelEvent
-from temba.msgs.models import Broadcast, Msg
+from temba.msgs.models import Broadcast, Msg, MsgArchive
 from temba.msgs.views import SendMessageForm
 from temba.orgs.views import OrgPermsMixin, OrgObjPermsMixin, ModalMixin
 from temba.values.models import Value
@@ -821,7 +821,16 @@ class ContactCRUDL(SmartCRUDL):
             else:
                 start_message = (page - 1) * msgs_per_page
                 end_message = page * msgs_per_page
-                text_messages = text_messages[start_message:end_message + 1]
+
+                # if this contact has archived messages, page through those merged with the ones in the database by
+                # when they were created, only reading as many of them as we need for this page
+                if contact.msg_archives.exists():
+                    archived = MsgArchive.get_messages(contact.org, contact=contact)
+                    archived = (m for m in archived if m.visibility != Msg.VISIBILITY_DELETED)
+                    merged = MsgArchive.merge_messages(text_messages, archived, page_size=msgs_per_page)
+                    text_messages = list(islice(merged, start_message, end_message + 1))
+                else:
+                    text_messages = text_messages[start_message:end_message + 1]
 
             # ignore our lead message past the first page
             count = len(text_messages)
@@ -838,15 +847,15 @@ class ContactCRUDL(SmartCRUDL):
             if not recent_seconds:
                 text_messages = text_messages[first_message:first_message + 100]
 
+            end_time = None
+
             # if we don't know our start time, go back to the beginning
             if not start_time:
                 start_time = timezone.datetime(2013, 1, 1, tzinfo=pytz.utc)
 
             # if we don't know our stop time yet, assume the first message
-            if page == 1:
-                end_time = timezone.now()
-            else:
-                end_time = text_messages[0].created_on
+            if not end_time:
+                end_time = text_messages[0].created_on if page > 1 and text_messages else timezone.now()
 
             context['start_time'] = start_time
 
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+#language=SQL
+INSTALL_SQL = """
+----------------------------------------------------------------------
+-- Squashes the path counts for a particular flow and path
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION
+  temba_squash_flowpathcount(_flow_id INT, _from_uuid VARCHAR(36), _to_uuid VARCHAR(36))
+RETURNS VOID AS $$
+BEGIN
+  WITH removed as (DELETE FROM flows_flowpathcount
+    WHERE "flow_id" = _flow_id AND "from_uuid" = _from_uuid AND "to_uuid" = _to_uuid RETURNING "count")
+    INSERT INTO flows_flowpathcount("flow_id", "from_uuid", "to_uuid", "count")
+    VALUES (_flow_id, _from_uuid, _to_uuid, GREATEST(0, (SELECT SUM("count") FROM removed)));
+END;
+$$ LANGUAGE plpgsql;
+
+----------------------------------------------------------------------
+-- Inserts a new path count for the path taken by a step, if it has one
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION
+  temba_insert_flowpathcount(_run_id INT, _step_type CHAR(1), _step_uuid VARCHAR(36), _rule_uuid VARCHAR(36),
+                             _next_uuid VARCHAR(36), _count INT)
+RETURNS VOID AS $$
+DECLARE
+  _from_uuid VARCHAR(36);
+BEGIN
+  -- paths from rule sets are from the rule that was matched
+  IF _step_type = 'R' THEN
+    _from_uuid := _rule_uuid;
+  ELSE
+    _from_uuid := _step_uuid;
+  END IF;
+
+  IF _from_uuid IS NOT NULL AND _next_uuid IS NOT NULL THEN
+    INSERT INTO flows_flowpathcount("flow_id", "from_uuid", "to_uuid", "count")
+    SELECT "flow_id", _from_uuid, _next_uuid, _count FROM flows_flowrun WHERE "id" = _run_id;
+  END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+----------------------------------------------------------------------
+-- Increments or decrements our path counts as steps are left
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION temba_update_flowpathcount() RETURNS TRIGGER AS $$
+BEGIN
+  -- Table being cleared, reset all counts
+  IF TG_OP = 'TRUNCATE' THEN
+    TRUNCATE flows_flowpathcount;
+    RETURN NULL;
+  END IF;
+
+  -- FlowStep being added
+  IF TG_OP = 'INSERT' THEN
+    -- Is this a test contact, ignore
+    IF temba_contact_is_test(NEW.contact_id) THEN
+      RETURN NULL;
+    END IF;
+
+    PERFORM temba_insert_flowpathcount(NEW.run_id, NEW.step_type, NEW.step_uuid, NEW.rule_uuid, NEW.next_uuid, 1);
+
+  -- FlowStep being removed
+  ELSIF TG_OP = 'DELETE' THEN
+    -- Is this a test contact, ignore
+    IF temba_contact_is_test(OLD.contact_id) THEN
+      RETURN NULL;
+    END IF;
+
+    PERFORM temba_insert_flowpathcount(OLD.run_id, OLD.step_type, OLD.step_uuid, OLD.rule_uuid, OLD.next_uuid, -1);
+
+  -- Updating the path taken
+  ELSIF TG_OP = 'UPDATE' THEN
+    -- Is this a test contact or no change to our path, ignore
+    IF temba_contact_is_test(NEW.contact_id) OR
+       (OLD.next_uuid IS NOT DISTINCT FROM NEW.next_uuid AND OLD.rule_uuid IS NOT DISTINCT FROM NEW.rule_uuid) THEN
+      RETURN NULL;
+    END IF;
+
+    PERFORM temba_insert_flowpathcount(OLD.run_id, OLD.step_type, OLD.step_uuid, OLD.rule_uuid, OLD.next_uuid, -1);
+    PERFORM temba_insert_flowpathcount(NEW.run_id, NEW.step_type, NEW.step_uuid, NEW.rule_uuid, NEW.next_uuid, 1);
+  END IF;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Install INSERT, UPDATE and DELETE triggers
+DROP TRIGGER IF EXISTS temba_flowstep_update_flowpathcount on flows_flowstep;
+CREATE TRIGGER temba_flowstep_update_flowpathcount
+   AFTER INSERT OR DELETE OR UPDATE OF next_uuid, rule_uuid
+   ON flows_flowstep
+   FOR EACH ROW
+   EXECUTE PROCEDURE temba_update_flowpathcount();
+
+-- Install TRUNCATE trigger
+DROP TRIGGER IF EXISTS temba_flowstep_truncate_flowpathcount on flows_flowstep;
+CREATE TRIGGER temba_flowstep_truncate_flowpathcount
+  AFTER TRUNCATE
+  ON flows_flowstep
+  EXECUTE PROCEDURE temba_update_flowpathcount();
+"""
+
+#language=SQL
+UNINSTALL_SQL = """
+DROP TRIGGER IF EXISTS temba_flowstep_update_flowpathcount on flows_flowstep;
+DROP TRIGGER IF EXISTS temba_flowstep_truncate_flowpathcount on flows_flowstep;
+"""
+
+
+def backfill_flowpath_counts(apps, schema_editor):
+    """
+    Backfills our path counts for all flows
+    """
+    Flow = apps.get_model('flows', 'Flow')
+    FlowStep = apps.get_model('flows', 'FlowStep')
+    FlowPathCount = apps.get_model('flows', 'FlowPathCount')
+
+    # for each flow that has at least one run
+    for flow in Flow.objects.exclude(runs=None):
+        steps = FlowStep.objects.filter(run__flow=flow, run__contact__is_test=False).exclude(next_uuid=None)
+        actions = steps.filter(step_type='A').values('step_uuid', 'next_uuid').annotate(count=Count('id'))
+        rules = steps.filter(step_type='R').exclude(rule_uuid=None)
+        rules = rules.values('rule_uuid', 'next_uuid').annotate(count=Count('id'))
+
+        counts = [FlowPathCount(flow=flow, from_uuid=c['step_uuid'], to_uuid=c['next_uuid'], count=c['count'])
+                  for c in actions]
+        counts += [FlowPathCount(flow=flow, from_uuid=c['rule_uuid'], to_uuid=c['next_uuid'], count=c['count'])
+                   for c in rules]
+
+        FlowPathCount.objects.filter(flow=flow).delete()
+        FlowPathCount.objects.bulk_create(counts)
+
+
+def clear_flowpath_counts(apps, schema_editor):
+    FlowPathCount = apps.get_model('flows', 'FlowPathCount')
+    FlowPathCount.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flows', '0055_populate_step_broadcasts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FlowPathCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('from_uuid', models.CharField(help_text='Which action set or rule this path is from', max_length=36)),
+                ('to_uuid', models.CharField(help_text='Which node this path is to', max_length=36)),
+                ('count', models.IntegerField(default=0)),
+                ('flow', models.ForeignKey(related_name='path_counts', to='flows.Flow')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='flowpathcount',
+            index_together=set([('flow', 'from_uuid', 'to_uuid')]),
+        ),
+        migrations.RunSQL(INSTALL_SQL, UNINSTALL_SQL),
+        migrations.RunPython(backfill_flowpath_counts, clear_flowpath_counts),
+    ]
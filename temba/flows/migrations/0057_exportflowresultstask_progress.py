@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flows', '0056_flowpathcount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportflowresultstask',
+            name='progress',
+            field=models.IntegerField(default=0, help_text='How far through writing this export we are, as a percentage'),
+        ),
+    ]
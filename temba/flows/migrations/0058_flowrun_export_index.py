@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+INDEX_SQL = """
+DO $$
+BEGIN
+
+IF NOT EXISTS (
+    SELECT 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relname = 'flows_flowrun_flow_id_contact_id_id' AND n.nspname = 'public') THEN
+    CREATE INDEX flows_flowrun_flow_id_contact_id_id ON flows_flowrun (flow_id, contact_id, id);
+END IF;
+
+END$$;"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flows', '0057_exportflowresultstask_progress'),
+    ]
+
+    operations = [
+        migrations.RunSQL(INDEX_SQL)
+    ]
@@ -1,15 +1,18 @@
 from __future__ import unicode_literals
 
+import copy
 import json
 import logging
 import numbers
 import phonenumbers
 import pytz
 import regex
+import threading
 import time
 import urllib2
 import xlwt
 import re
+import sys
 
 from collections import OrderedDict, defaultdict
 from datetime import timedelta
@@ -22,6 +25,8 @@ from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User, Group
 from django.db import models, connection
 from django.db.models import Q, Count, QuerySet, Sum
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _, ungettext_lazy as _n
 from django.utils.html import escape
@@ -33,8 +38,9 @@ from temba.locations.models import AdminBoundary, STATE_LEVEL, DISTRICT_LEVEL, W
 from temba.msgs.models import Broadcast, Msg, FLOW, INBOX, INCOMING, QUEUED, INITIALIZING, HANDLED, SENT, Label, PENDING
 from temba.orgs.models import Org, Language, UNREAD_FLOW_MSGS, CURRENT_EXPORT_VERSION
 from temba.utils import get_datetime_format, str_to_datetime, datetime_to_str, analytics, json_date_to_datetime, chunk_list
-from temba.utils.cache import get_cacheable
+from temba.utils.cache import get_cacheable, redis_writes
 from temba.utils.email import send_template_email, is_valid_address
+from temba.utils.exporter import TableExporter, CSVWorkbook
 from temba.utils.models import TembaModel, ChunkIterator
 from temba.utils.profiler import SegmentProfiler
 from temba.utils.queues import push_task
@@ -47,6 +53,12 @@ logger = logging.getLogger(__name__)
 FLOW_DEFAULT_EXPIRES_AFTER = 60 * 12
 START_FLOW_BATCH_SIZE = 500
 
+# how many flow definitions we keep in memory, least recently used are discarded first
+FLOW_DEFINITION_CACHE_SIZE = 250
+
+flow_definitions = OrderedDict()
+flow_definitions_lock = threading.Lock()
+
 
 class FlowException(Exception):
     def __init__(self, *args, **kwargs):
@@ -70,6 +82,42 @@ UNREAD_FLOW_RESPONSES = 'unread_flow_responses'
 # the most frequently we will check if our cache needs rebuilding
 FLOW_STAT_CACHE_FREQUENCY = 24 * 60 * 60  # 1 day
 
+# applies flow activity transitions, taking each run off the active set of the step it's leaving (or of every step
+# given in KEYS if that is *), adding count visits along its path and adding it to the active set of the step it's
+# arriving at. While the activity cache is being rebuilt, transitions are also journaled to be replayed onto the rebuild.
+FLOW_ACTIVITY_LUA = "local prefix = ARGV[1]\n" \
+                    "local rebuilding = redis.call('exists', KEYS[2]) == 1\n" \
+                    "for i = 2, #ARGV, 5 do\n" \
+                    "  local run, from, path, to, count = ARGV[i], ARGV[i + 1], ARGV[i + 2], ARGV[i + 3], ARGV[i + 4]\n" \
+                    "  if from == '*' then\n" \
+                    "    for k = 4, #KEYS do redis.call('srem', KEYS[k], run) end\n" \
+                    "  elseif from ~= '' then redis.call('srem', prefix .. from, run) end\n" \
+                    "  if path ~= '' and to ~= '' then redis.call('hincrby', KEYS[1], path .. ':' .. to, count) end\n" \
+                    "  if run ~= '' and to ~= '' then redis.call('sadd', prefix .. to, run) end\n" \
+                    "  if rebuilding then redis.call('rpush', KEYS[3], run, from, path, to, count) end\n" \
+                    "end\n" \
+                    "if rebuilding then redis.call('pexpire', KEYS[3], redis.call('pttl', KEYS[2])) end"
+FLOW_ACTIVITY_BATCH_SIZE = 1000
+
+# replays the transitions journaled during a rebuild onto the rebuilt activity cache and then swaps it into place. KEYS
+# are the rebuild marker, the journal and then pairs of live and rebuilt keys, the first pair being our visits.
+FLOW_ACTIVITY_SWAP_LUA = "local prefix, suffix = ARGV[1], ARGV[2]\n" \
+                         "local journal = redis.call('lrange', KEYS[2], 0, -1)\n" \
+                         "for i = 1, #journal, 5 do\n" \
+                         "  local run, from, path, to, count = journal[i], journal[i + 1], journal[i + 2], journal[i + 3], journal[i + 4]\n" \
+                         "  if from == '*' then\n" \
+                         "    for k = 6, #KEYS, 2 do redis.call('srem', KEYS[k], run) end\n" \
+                         "  elseif from ~= '' then redis.call('srem', prefix .. from .. suffix, run) end\n" \
+                         "  if path ~= '' and to ~= '' then redis.call('hincrby', KEYS[4], path .. ':' .. to, count) end\n" \
+                         "  if run ~= '' and to ~= '' then redis.call('sadd', prefix .. to .. suffix, run) end\n" \
+                         "end\n" \
+                         "for i = 3, #KEYS, 2 do\n" \
+                         "  if redis.call('exists', KEYS[i + 1]) == 1 then redis.call('rename', KEYS[i + 1], KEYS[i])\n" \
+                         "  else redis.call('del', KEYS[i]) end\n" \
+                         "end\n" \
+                         "redis.call('del', KEYS[1], KEYS[2])"
+FLOW_ACTIVITY_REBUILD_SUFFIX = ':rebuild'
+
 
 class FlowLock(Enum):
     """
@@ -98,6 +146,8 @@ class FlowStatsCache(Enum):
     visit_count_map = 4
     step_active_set = 5
     cache_check = 6
+    activity_rebuild = 7
+    activity_journal = 8
 
 
 def edit_distance(s1, s2):  # pragma: no cover
@@ -422,6 +472,11 @@ class Flow(TembaModel):
         if not uuid or not destination_type:
             return None
 
+        node = FlowDefinition.get(flow).get_node(flow, uuid, destination_type)
+        if node:
+            return node
+
+        # not part of our definition, look it up directly
         if destination_type == FlowStep.TYPE_RULE_SET:
             return RuleSet.get(flow, uuid)
         else:
@@ -822,31 +877,60 @@ class Flow(TembaModel):
         return r.lock(lock_key, lock_ttl)
 
     def do_calculate_flow_stats(self, lock_ttl=None):
+        """
+        Rebuilds our activity cache from the database. The new cache is built under temporary keys while activity
+        applied in the meantime is journaled, and then the journal is replayed onto it and it is renamed into place
+        in a single script.
+        """
         r = get_redis_connection()
+        rebuild_key = self.get_stats_cache_key(FlowStatsCache.activity_rebuild)
+        journal_key = self.get_stats_cache_key(FlowStatsCache.activity_journal)
+        visits_key = self.get_stats_cache_key(FlowStatsCache.visit_count_map)
+        active_prefix = self.get_stats_cache_key(FlowStatsCache.step_active_set) + ':'
 
-        # activity
+        if not lock_ttl:
+            lock_ttl = FLOW_LOCK_TTL
+
+        # activity, the lock only keeps rebuilds from overlapping as activity updates are atomic without it
         with self.lock_on(FlowLock.activity, lock_ttl=lock_ttl):
+            # start journaling activity before we read the database so nothing applied during our rebuild is lost
+            pipe = r.pipeline()
+            pipe.delete(journal_key)
+            pipe.set(rebuild_key, 1, lock_ttl)
+            pipe.execute()
+
             (active, visits) = self._calculate_activity()
 
-            # remove our old active cache
-            keys = self.calculate_active_step_keys()
-            if keys:
-                r.delete(*keys)
-            r.delete(self.get_stats_cache_key(FlowStatsCache.visit_count_map))
+            # write our new cache under temporary keys
+            step_keys = set(self.calculate_active_step_keys())
+            step_keys.update([active_prefix + step for step in active.keys()])
+            keys = [visits_key] + list(step_keys)
+
+            pipe = r.pipeline()
+            pipe.delete(*[key + FLOW_ACTIVITY_REBUILD_SUFFIX for key in keys])
 
-            # add current active cache
             for step, runs in active.items():
-                for run in runs:
-                    r.sadd(self.get_stats_cache_key(FlowStatsCache.step_active_set, step), run)
+                if runs:
+                    pipe.sadd(active_prefix + step + FLOW_ACTIVITY_REBUILD_SUFFIX, *runs)
 
             if len(visits):
-                r.hmset(self.get_stats_cache_key(FlowStatsCache.visit_count_map), visits)
+                pipe.hmset(visits_key + FLOW_ACTIVITY_REBUILD_SUFFIX, visits)
+
+            pipe.execute()
+
+            # then replay the journal onto them and swap them in
+            swap_keys = [rebuild_key, journal_key]
+            for key in keys:
+                swap_keys += [key, key + FLOW_ACTIVITY_REBUILD_SUFFIX]
+
+            r.eval(FLOW_ACTIVITY_SWAP_LUA, len(swap_keys), *(swap_keys + [active_prefix, FLOW_ACTIVITY_REBUILD_SUFFIX]))
 
     def _calculate_activity(self, simulation=False):
 
         """
-        Calculate our activity stats from the database. This is expensive. It should only be run
-        for simulation or in an async task to rebuild the activity cache
+        Calculate our activity stats from the database. Who is active where is read from the active steps and where
+        people have visited from our path counts, or from all our steps when simulating. It should only be run for
+        simulation or in an async task to rebuild the activity cache
         """
         # who is actively at each step
         steps = FlowStep.objects.values('run__pk', 'step_uuid').filter(run__is_active=True, run__flow=self, left_on=None, run__contact__is_test=simulation).annotate(count=Count('run_id'))
@@ -863,6 +947,17 @@ class Flow(TembaModel):
         for key, value in active.items():
             active[key] = list(value)
 
+        if simulation:
+            visits = self._calculate_visits(simulation=True)
+        else:
+            visits = FlowPathCount.get_visits(self)
+
+        return (active, visits)
+
+    def _calculate_visits(self, simulation=False):
+        """
+        Calculates where people have visited by aggregating all of our steps. This is expensive.
+        """
         visits = {}
         visited_actions = FlowStep.objects.values('step_uuid', 'next_uuid').filter(run__flow=self, step_type='A', run__contact__is_test=simulation).annotate(count=Count('run_id'))
         visited_rules = FlowStep.objects.values('rule_uuid', 'next_uuid').filter(run__flow=self, step_type='R', run__contact__is_test=simulation).exclude(rule_uuid=None).annotate(count=Count('run_id'))
@@ -876,7 +971,7 @@ class Flow(TembaModel):
             if step['next_uuid'] and step['count']:
                 visits['%s:%s' % (step['rule_uuid'], step['next_uuid'])] = step['count']
 
-        return (active, visits)
+        return visits
 
     def _check_for_cache_update(self):
         """
@@ -1113,8 +1208,8 @@ class Flow(TembaModel):
         """
         Increments the number of new responses for this flow.
         """
-        r = get_redis_connection()
-        r.hincrby(UNREAD_FLOW_RESPONSES, self.id, 1)
+        with redis_writes() as pipe:
+            pipe.hincrby(UNREAD_FLOW_RESPONSES, self.id, 1)
 
         # increment our global count as well
         self.org.increment_unread_msg_count(UNREAD_FLOW_MSGS)
@@ -1562,7 +1657,7 @@ class Flow(TembaModel):
 
         # build a map of contact to flow run
         run_map = dict()
-        for run in FlowRun.objects.filter(contact__in=batch_contact_ids, flow=self, created_on=now):
+        for run in FlowRun.objects.filter(contact__in=batch_contact_ids, flow=self, created_on=now).select_related('contact'):
             run_map[run.contact_id] = run
             if run.contact.is_test:
                 ActionLog.create(run, '%s has entered the "%s" flow' % (run.contact.get_display(self.org, short=True), run.flow.name))
@@ -1615,6 +1710,25 @@ class Flow(TembaModel):
         msgs = []
         optimize_sending_action = len(broadcasts) > 0
 
+        # if our entry is only the replies we've already sent as broadcasts, followed by either the end of the flow
+        # or a wait, there is nothing to evaluate per contact and we can add all our steps in bulk
+        entry_destination = None
+        bulk_entry = False
+        if entry_actions and optimize_sending_action and not start_msg and not simulation:
+            entry_destination = Flow.get_node(self, entry_actions.destination, entry_actions.destination_type)
+            if all(isinstance(action, ReplyAction) for action in entry_actions.get_actions()):
+                bulk_entry = not entry_destination or (entry_destination.get_step_type() == FlowStep.TYPE_RULE_SET and
+                                                       entry_destination.is_pause())
+
+        if bulk_entry:
+            runs = [run_map[contact_id] for contact_id in batch_contact_ids]
+            self.add_entry_steps(runs, entry_actions, entry_destination, message_map)
+
+            for contact_id in batch_contact_ids:
+                msgs += message_map.get(contact_id, [])
+
+            batch_contact_ids = []
+
         for contact_id in batch_contact_ids:
             # each contact maintains its own list of started flows
             started_flows_by_contact = list(started_flows)
@@ -1713,34 +1827,117 @@ class Flow(TembaModel):
 
         return step
 
-    def remove_active_for_run_ids(self, run_ids):
+    def add_entry_steps(self, runs, entry_actions, destination, message_map):
+        """
+        Adds the steps for a batch of newly started runs in bulk. This is only valid when our entry actions are
+        replies which have already been created as broadcast messages and the runs either exit the flow or wait
+        at the destination ruleset, so no contact needs to be evaluated on its own.
+
+        :param runs: the runs we just started
+        :param entry_actions: the entry actionset for this flow
+        :param destination: the pausing ruleset our entry actions lead to, or None if the runs are complete
+        :param message_map: map of contact id to the messages created for that contact
+        """
+        arrived_on = timezone.now()
+        next_uuid = destination.uuid if destination else None
+
+        steps = []
+        for run in runs:
+            steps.append(FlowStep(run=run, contact_id=run.contact_id, step_type=entry_actions.get_step_type(),
+                                  step_uuid=entry_actions.uuid, arrived_on=arrived_on, left_on=arrived_on,
+                                  next_uuid=next_uuid))
+            if destination:
+                steps.append(FlowStep(run=run, contact_id=run.contact_id, step_type=destination.get_step_type(),
+                                      step_uuid=destination.uuid, arrived_on=arrived_on))
+
+        FlowStep.objects.bulk_create(steps)
+
+        # bulk_create doesn't give us our ids back, so look up our entry steps to associate our messages with them
+        run_ids = [run.pk for run in runs]
+        step_ids = dict(FlowStep.objects.filter(run__in=run_ids, step_uuid=entry_actions.uuid).values_list('run', 'id'))
+
+        step_messages = []
+        step_broadcasts = set()
+        for run in runs:
+            step_id = step_ids[run.pk]
+            for msg in message_map.get(run.contact_id, []):
+                step_messages.append(FlowStep.messages.through(flowstep_id=step_id, msg_id=msg.pk))
+                if msg.broadcast_id:
+                    step_broadcasts.add((step_id, msg.broadcast_id))
+
+        FlowStep.messages.through.objects.bulk_create(step_messages)
+        FlowStep.broadcasts.through.objects.bulk_create([FlowStep.broadcasts.through(flowstep_id=pair[0],
+                                                                                     broadcast_id=pair[1])
+                                                         for pair in step_broadcasts])
+
+        # no destination, all our runs are now complete
+        if not destination:
+            modified_on = timezone.now()
+            FlowRun.objects.filter(pk__in=run_ids).update(exit_type=FlowRun.EXIT_TYPE_COMPLETED, exited_on=arrived_on,
+                                                          modified_on=modified_on, is_active=False)
+            for run in runs:
+                run.exit_type = FlowRun.EXIT_TYPE_COMPLETED
+                run.exited_on = arrived_on
+                run.modified_on = modified_on
+                run.is_active = False
+
+            # completed runs don't leave any activity behind
+            return
+
+        # everybody took the same path and is now waiting at our destination, update our activity all at once
+        active_run_ids = [run.pk for run in runs if not run.contact.is_test]
+        if active_run_ids:
+            self.apply_activity([(run_id, None, entry_actions.uuid, destination.uuid) for run_id in active_run_ids])
+
+    def apply_activity(self, transitions, pipe=None, count=1, active_keys=()):
+        """
+        Applies a list of transitions to our activity cache, each a tuple of (run id, uuid of the step being left,
+        uuid of the step or rule the path is from, uuid of the step being arrived at), where any of them can be None.
+        A step being left of * takes the run off all the given active keys. Each chunk of transitions is applied by a
+        single script, so this is atomic without needing a lock.
+        """
+        if pipe is None:
+            with redis_writes() as pipe:
+                return self.apply_activity(transitions, pipe, count, active_keys)
+
+        keys = [self.get_stats_cache_key(FlowStatsCache.visit_count_map),
+                self.get_stats_cache_key(FlowStatsCache.activity_rebuild),
+                self.get_stats_cache_key(FlowStatsCache.activity_journal)] + list(active_keys)
+        active_prefix = self.get_stats_cache_key(FlowStatsCache.step_active_set) + ':'
+
+        for batch in chunk_list(transitions, FLOW_ACTIVITY_BATCH_SIZE):
+            args = [active_prefix]
+            for run_id, from_uuid, path_uuid, to_uuid in batch:
+                args += [run_id or '', from_uuid or '', path_uuid or '', to_uuid or '', count]
+
+            pipe.eval(FLOW_ACTIVITY_LUA, len(keys), *(keys + args))
+
+    def remove_active_for_run_ids(self, run_ids, pipe=None):
         """
         Bulk deletion of activity for a list of run ids. This removes the runs
         from the active step, but does not remove the visited (path) data
         for the runs.
         """
-        r = get_redis_connection()
         if run_ids:
-            for key in self.calculate_active_step_keys():
-                r.srem(key, *run_ids)
+            self.apply_activity([(run_id, '*', None, None) for run_id in run_ids], pipe,
+                                active_keys=self.calculate_active_step_keys())
 
     def remove_active_for_step(self, step):
         """
         Removes the active stat for a run at the given step, but does not
         remove the (path) data for the runs.
         """
-        r = get_redis_connection()
-        r.srem(self.get_stats_cache_key(FlowStatsCache.step_active_set, step.step_uuid), step.run.pk)
+        self.apply_activity([(step.run.pk, step.step_uuid, None, None)])
 
     def remove_visits_for_step(self, step):
         """
         Decrements the count for the given step
         """
-        r = get_redis_connection()
         step_uuid = step.step_uuid
         if step.rule_uuid:
             step_uuid = step.rule_uuid
-        r.hincrby(self.get_stats_cache_key(FlowStatsCache.visit_count_map), "%s:%s" % (step_uuid, step.next_uuid), -1)
+
+        self.apply_activity([(None, None, step_uuid, step.next_uuid)], count=-1)
 
     def update_activity(self, step, previous_step=None, rule_uuid=None):
         """
@@ -1750,26 +1947,17 @@ class Flow(TembaModel):
         :param step: the step they just took
         :param previous_step: the step they were just on
         :param rule_uuid: the uuid for the rule they came from (if any)
-        :param simulation: if we are part of a simulation
         """
+        previous_uuid = None
+        path_uuid = None
 
-        with self.lock_on(FlowLock.activity):
-            r = get_redis_connection()
+        if previous_step:
+            previous_uuid = previous_step.step_uuid
 
-            # remove our previous active spot
-            if previous_step:
-                self.remove_active_for_step(previous_step)
+            # if we came from a rule, our path is from that instead of our step
+            path_uuid = rule_uuid if rule_uuid else previous_uuid
 
-                # mark our path
-                previous_uuid = previous_step.step_uuid
-
-                # if we came from a rule, use that instead of our step
-                if rule_uuid:
-                    previous_uuid = rule_uuid
-                r.hincrby(self.get_stats_cache_key(FlowStatsCache.visit_count_map), "%s:%s" % (previous_uuid, step.step_uuid), 1)
-
-            # make us active on our new step
-            r.sadd(self.get_stats_cache_key(FlowStatsCache.step_active_set, step.step_uuid), step.run.pk)
+        self.apply_activity([(step.run.pk, previous_uuid, path_uuid, step.step_uuid)])
 
     def get_entry_send_actions(self):
         """
@@ -2302,6 +2490,9 @@ class Flow(TembaModel):
             # clear property cache
             self.clear_props_cache()
 
+            # and our in-memory definition, the next message we handle will load our new revision
+            FlowDefinition.invalidate(self)
+
             # create a version of our flow for posterity
             if user is None:
                 user = self.created_by
@@ -2454,12 +2645,10 @@ class FlowRun(models.Model):
         for run in runs:
             runs_by_flow[run['flow_id']].append(run['id'])
 
-        # for each flow, remove activity for all runs
-        for flow_id, run_ids in runs_by_flow.iteritems():
-            flow = Flow.objects.filter(id=flow_id).first()
-
-            if flow:
-                flow.remove_active_for_run_ids(run_ids)
+        # for each flow, remove activity for all runs, all in one round trip
+        with redis_writes() as pipe:
+            for flow in Flow.objects.filter(id__in=runs_by_flow.keys()):
+                flow.remove_active_for_run_ids(runs_by_flow[flow.id], pipe)
 
         modified_on = timezone.now()
         if not exited_on:
@@ -2480,8 +2669,7 @@ class FlowRun(models.Model):
             step.release()
 
         # remove our run from the activity
-        with self.flow.lock_on(FlowLock.activity):
-            self.flow.remove_active_for_run_ids([self.pk])
+        self.flow.remove_active_for_run_ids([self.pk])
 
         # lastly delete ourselves
         self.delete()
@@ -3051,6 +3239,11 @@ class RuleSet(models.Model):
         return json.loads(self.rules)
 
     def get_rules(self):
+        # rules parsed by our flow definition, copied as matching rewrites their categories
+        rules = getattr(self, '__rules', None)
+        if rules is not None:
+            return [copy.copy(rule) for rule in rules]
+
         return Rule.from_json_array(self.flow.org, json.loads(self.rules))
 
     def get_rule_uuids(self):
@@ -3130,7 +3323,13 @@ class ActionSet(models.Model):
         return json.loads(self.actions)
 
     def get_actions(self):
-        return Action.from_json_array(self.flow.org, json.loads(self.actions))
+        # actions refer to groups, labels and flows which can change outside of a revision, so we only reuse the
+        # decoded json from our flow definition and always build our actions from it
+        actions_json = getattr(self, '__actions', None)
+        if actions_json is None:
+            actions_json = json.loads(self.actions)
+
+        return Action.from_json_array(self.flow.org, actions_json)
 
     def set_actions_dict(self, json_dict):
         self.actions = json.dumps(json_dict)
@@ -3142,6 +3341,88 @@ class ActionSet(models.Model):
         return "ActionSet: %s" % (self.uuid, )
 
 
+class FlowDefinition(object):
+    """
+    An in-memory copy of the nodes of a single revision of a flow, with ruleset rules parsed and action json decoded,
+    so that handling messages doesn't need to load and parse the same nodes from the database each time.
+    """
+    def __init__(self, flow):
+        self.key = FlowDefinition.get_key(flow)
+        self.rulesets = dict()
+        self.actionsets = dict()
+        self.rules = dict()
+        self.actions = dict()
+
+        for ruleset in RuleSet.objects.filter(flow=flow).select_related('flow', 'flow__org'):
+            self.rulesets[ruleset.uuid] = ruleset
+            self.rules[ruleset.uuid] = ruleset.get_rules()
+
+        for actionset in ActionSet.objects.filter(flow=flow).select_related('flow', 'flow__org'):
+            self.actionsets[actionset.uuid] = actionset
+            self.actions[actionset.uuid] = actionset.get_actions_dict()
+
+    @classmethod
+    def get_key(cls, flow):
+        return flow.pk, flow.saved_on, flow.version_number
+
+    @classmethod
+    def get(cls, flow):
+        """
+        Gets the definition for the current revision of the passed in flow, loading it if necessary
+        """
+        key = FlowDefinition.get_key(flow)
+
+        with flow_definitions_lock:
+            definition = flow_definitions.pop(flow.pk, None)
+            if definition and definition.key == key:
+                flow_definitions[flow.pk] = definition
+                return definition
+
+        definition = FlowDefinition(flow)
+
+        with flow_definitions_lock:
+            flow_definitions[flow.pk] = definition
+            while len(flow_definitions) > FLOW_DEFINITION_CACHE_SIZE:
+                flow_definitions.popitem(last=False)
+
+        return definition
+
+    @classmethod
+    def invalidate(cls, flow_or_id):
+        flow_id = flow_or_id.pk if isinstance(flow_or_id, Flow) else flow_or_id
+
+        with flow_definitions_lock:
+            flow_definitions.pop(flow_id, None)
+
+    def get_node(self, flow, uuid, destination_type):
+        """
+        Returns a copy of the given node for the passed in flow, our nodes are shared between threads so callers are
+        free to modify the copy they get back
+        """
+        if destination_type == FlowStep.TYPE_RULE_SET:
+            node = self.rulesets.get(uuid, None)
+            attr, parsed = '__rules', self.rules
+        else:
+            node = self.actionsets.get(uuid, None)
+            attr, parsed = '__actions', self.actions
+
+        if not node:
+            return None
+
+        node = copy.copy(node)
+        node.flow = flow
+        setattr(node, attr, parsed[uuid])
+        return node
+
+
+@receiver(post_save, sender=RuleSet)
+@receiver(post_delete, sender=RuleSet)
+@receiver(post_save, sender=ActionSet)
+@receiver(post_delete, sender=ActionSet)
+def invalidate_flow_definition(sender, instance, **kwargs):
+    FlowDefinition.invalidate(instance.flow_id)
+
+
 class FlowRevision(SmartModel):
     """
     JSON definitions for previous flow revisions
@@ -3299,6 +3580,73 @@ class FlowRunCount(models.Model):
         index_together = ('flow', 'exit_type')
 
 
+class FlowPathCount(models.Model):
+    """
+    Maintains counts of how many times non-test contacts have taken each path between two nodes of a flow, i.e. from
+    an action set or a rule to the next node. These are calculated via triggers on the database.
+    """
+    flow = models.ForeignKey(Flow, related_name='path_counts')
+    from_uuid = models.CharField(max_length=36, help_text=_("Which action set or rule this path is from"))
+    to_uuid = models.CharField(max_length=36, help_text=_("Which node this path is to"))
+    count = models.IntegerField(default=0)
+
+    LAST_SQUASH_KEY = 'last_flowpathcount_squash'
+
+    @classmethod
+    def squash_counts(cls):
+        # get the id of the last count we squashed
+        r = get_redis_connection()
+        last_squash = r.get(FlowPathCount.LAST_SQUASH_KEY)
+        if not last_squash:
+            last_squash = 0
+
+        # get the unique paths for all new ones
+        start = time.time()
+        squash_count = 0
+        paths = FlowPathCount.objects.filter(id__gt=last_squash).order_by('flow_id', 'from_uuid', 'to_uuid')
+        for count in paths.distinct('flow_id', 'from_uuid', 'to_uuid'):
+            # perform our atomic squash in SQL by calling our squash method
+            with connection.cursor() as c:
+                c.execute("SELECT temba_squash_flowpathcount(%s, %s, %s);",
+                          (count.flow_id, count.from_uuid, count.to_uuid))
+
+            squash_count += 1
+
+        # insert our new top squashed id
+        max_id = FlowPathCount.objects.all().order_by('-id').first()
+        if max_id:
+            r.set(FlowPathCount.LAST_SQUASH_KEY, max_id.id)
+
+        print "Squashed path counts for %d paths in %0.3fs" % (squash_count, time.time() - start)
+
+    @classmethod
+    def get_visits(cls, flow):
+        """
+        Gets the number of times each path of the given flow has been taken, as a map of from_uuid:to_uuid to count
+        """
+        counts = FlowPathCount.objects.filter(flow=flow).values('from_uuid', 'to_uuid').annotate(total=Sum('count'))
+        return {'%s:%s' % (c['from_uuid'], c['to_uuid']): c['total'] for c in counts if c['total']}
+
+    @classmethod
+    def populate_for_flow(cls, flow):
+        # remove old ones
+        FlowPathCount.objects.filter(flow=flow).delete()
+
+        # calculate our counts from the steps themselves
+        counts = []
+        for key, count in flow._calculate_visits().items():
+            from_uuid, to_uuid = key.split(':')
+            counts.append(FlowPathCount(flow=flow, from_uuid=from_uuid, to_uuid=to_uuid, count=count))
+
+        FlowPathCount.objects.bulk_create(counts)
+
+    def __unicode__(self):
+        return "PathCount[%d:%s:%s:%d]" % (self.flow_id, self.from_uuid, self.to_uuid, self.count)
+
+    class Meta:
+        index_together = ('flow', 'from_uuid', 'to_uuid')
+
+
 class ExportFlowResultsTask(SmartModel):
     """
     Container for managing our export requests
@@ -3324,6 +3672,9 @@ class ExportFlowResultsTask(SmartModel):
     config = models.TextField(null=True,
                               help_text=_("Any configuration options for this flow export"))
 
+    progress = models.IntegerField(default=0,
+                                   help_text=_("How far through writing this export we are, as a percentage"))
+
     @classmethod
     def create(cls, host, org, user, flows, contact_fields, responded_only, include_runs, include_msgs):
         config = {ExportFlowResultsTask.INCLUDE_RUNS: include_runs,
@@ -3352,10 +3703,45 @@ class ExportFlowResultsTask(SmartModel):
             self.is_finished = True
             self.save(update_fields=['is_finished'])
 
+    def iter_steps(self, runs, steps, contact_fields, chunk_size=1000):
+        """
+        Iterates the given steps of the given runs in (contact, run, arrived_on, id) order. Rather than loading every
+        step id up front, runs are paged through by (contact, id) starting from the last run of the previous chunk,
+        which the (flow, contact, id) index on runs supports, and each chunk's steps are then fetched by run. So only a
+        chunk of runs' worth of steps is ever held in memory however big the flow is.
+        """
+        runs = runs.order_by('contact', 'pk')
+        last_key = None
+
+        while True:
+            chunk = runs
+            if last_key:
+                chunk = chunk.extra(where=["(flows_flowrun.contact_id, flows_flowrun.id) > (%s, %s)"], params=last_key)
+
+            keys = list(chunk.values_list('contact', 'pk')[:chunk_size])
+            if not keys:
+                break
+
+            step_ids = steps.filter(run_id__in=[key[1] for key in keys])
+            step_ids = list(step_ids.order_by('contact', 'run', 'arrived_on', 'pk').values_list('pk', flat=True))
+
+            for step in ChunkIterator(FlowStep, step_ids,
+                                      order_by=['contact', 'run', 'arrived_on', 'pk'],
+                                      select_related=['run', 'contact'],
+                                      prefetch_related=['messages__contact_urn',
+                                                        'messages__channel',
+                                                        'contact__all_groups'],
+                                      contact_fields=contact_fields):
+                yield step
+
+            if len(keys) < chunk_size:
+                break
+
+            last_key = list(keys[-1])
+
     def do_export(self):
         from xlwt import Workbook
-        book = Workbook()
-        max_rows = 65535
+        max_rows = TableExporter.MAX_XLS_ROWS
 
         config = json.loads(self.config) if self.config else dict()
         include_runs = config.get(ExportFlowResultsTask.INCLUDE_RUNS, False)
@@ -3425,16 +3811,26 @@ class ExportFlowResultsTask(SmartModel):
         with SegmentProfiler("# of contacts"):
             contacts_count = ruleset_steps.values('contact').distinct().count()
 
-        # grab the ids for all our steps so we don't have to ever calculate them again
-        with SegmentProfiler("calculate step ids"):
-            all_steps = FlowStep.objects.filter(run__flow__in=flows)\
-                                        .order_by('contact', 'run', 'arrived_on', 'pk')\
-                                        .values('id')
+        all_steps = FlowStep.objects.filter(run__flow__in=flows)
+        all_step_runs = FlowRun.objects.filter(flow__in=flows)
+        if responded_only:
+            all_steps = all_steps.filter(run__responded=True)
+            all_step_runs = all_step_runs.filter(responded=True)
 
-            if responded_only:
-                all_steps = all_steps.filter(run__responded=True)
+        with SegmentProfiler("# of steps"):
+            total_steps = all_steps.count()
 
-            step_ids = [s['id'] for s in all_steps]
+        # if this won't fit in an Excel file without splitting it into lots of sheets, stream it out as CSVs instead
+        num_cols = 6 + len(contact_fields) + len(columns) * 3 + (1 if show_submitted_by else 0)
+        is_csv = num_cols > TableExporter.MAX_XLS_COLS or contacts_count > max_rows
+        is_csv |= include_runs and all_runs_count > max_rows
+        is_csv |= include_msgs and total_steps > max_rows
+
+        if is_csv:
+            book = CSVWorkbook()
+            max_rows = sys.maxint
+        else:
+            book = Workbook()
 
         # build our sheets
         run_sheets = []
@@ -3529,7 +3925,6 @@ class ExportFlowResultsTask(SmartModel):
         msgs = None
 
         processed_steps = 0
-        total_steps = len(step_ids)
         start = time.time()
         flow_names = ", ".join([f['name'] for f in self.flows.values('name')])
 
@@ -3542,22 +3937,22 @@ class ExportFlowResultsTask(SmartModel):
             urn_display = urn_display_cache.get(contact.pk)
             if urn_display:
                 return urn_display
+
+            # steps come grouped by contact so we only ever need to remember the current one
+            urn_display_cache.clear()
             urn_display = contact.get_urn_display(org=org, full=True)
             urn_display_cache[contact.pk] = urn_display
             return urn_display
 
-        for run_step in ChunkIterator(FlowStep, step_ids,
-                                      order_by=['contact', 'run', 'arrived_on', 'pk'],
-                                      select_related=['run', 'contact'],
-                                      prefetch_related=['messages__contact_urn',
-                                                        'messages__channel',
-                                                        'contact__all_groups'],
-                                      contact_fields=contact_fields):
+        for run_step in self.iter_steps(all_step_runs, all_steps, contact_fields):
 
             processed_steps += 1
             if processed_steps % 10000 == 0:
+                self.progress = processed_steps * 100 / total_steps
+                self.save(update_fields=['progress'])
+
                 print "Export of %s - %d%% complete in %0.2fs" % \
-                      (flow_names, processed_steps * 100 / total_steps, time.time() - start)
+                      (flow_names, self.progress, time.time() - start)
 
             # skip over test contacts
             if run_step.contact.is_test:
@@ -3743,14 +4138,15 @@ class ExportFlowResultsTask(SmartModel):
 
         # initialize the UUID which we will save results as
         self.uuid = str(uuid4())
-        self.save(update_fields=['uuid'])
+        self.progress = 100
+        self.save(update_fields=['uuid', 'progress'])
 
         # save as file asset associated with this task
         from temba.assets.models import AssetType
         from temba.assets.views import get_asset_url
 
         store = AssetType.results_export.store
-        store.save(self.pk, File(temp), 'xls')
+        store.save(self.pk, File(temp), 'zip' if is_csv else 'xls')
 
         subject = "Your export is ready"
         template = 'flows/email/flow_export_download'
@@ -3,11 +3,10 @@ from __future__ import unicode_literals
 from django.utils import timezone
 from djcelery_transactions import task
 from temba.msgs.models import Broadcast, Msg
-from temba.flows.models import FlowStatsCache
 from temba.utils.email import send_simple_email
 from temba.utils.queues import pop_task
 from redis_cache import get_redis_connection
-from .models import ExportFlowResultsTask, Flow, FlowStart, FlowRun, FlowStep, FlowRunCount
+from .models import ExportFlowResultsTask, Flow, FlowStart, FlowRun, FlowStep, FlowRunCount, FlowPathCount
 
 
 @task(track_started=True, name='send_email_action_task')
@@ -91,30 +90,21 @@ def check_flow_stats_accuracy_task(flow_id):
 
     flow = Flow.objects.get(pk=flow_id)
 
-    r = get_redis_connection()
-    runs_started_cached = r.get(flow.get_stats_cache_key(FlowStatsCache.runs_started_count))
-    runs_started_cached = 0 if runs_started_cached is None else int(runs_started_cached)
-    runs_started = flow.runs.filter(contact__is_test=False).count()
+    # compare our cached visits with our path counts, which is cheap as they are squashed
+    visits_cached = {k: v for k, v in flow.get_activity(check_cache=False)[1].items() if v}
+    visits = FlowPathCount.get_visits(flow)
 
-    if runs_started != runs_started_cached:
+    if visits != visits_cached:
         # log error that we had to rebuild, shouldn't be happening
-        logger.error('Rebuilt flow stats (Org: %d, Flow: %d). Cache was %d but should be %d.'
-                     % (flow.org.pk, flow.pk, runs_started_cached, runs_started))
+        logger.error('Rebuilt flow stats (Org: %d, Flow: %d). Cache had %d visits but should have %d.'
+                     % (flow.org.pk, flow.pk, sum(visits_cached.values()), sum(visits.values())))
 
         calculate_flow_stats_task.delay(flow.pk)
 
 
 @task(track_started=True, name="calculate_flow_stats")
 def calculate_flow_stats_task(flow_id):
-    r = get_redis_connection()
-
-    flow = Flow.objects.get(pk=flow_id)
-    runs_started_cached = r.get(flow.get_stats_cache_key(FlowStatsCache.runs_started_count))
-    runs_started_cached = 0 if runs_started_cached is None else int(runs_started_cached)
-    runs_started = flow.runs.filter(contact__is_test=False).count()
-
-    if runs_started != runs_started_cached:
-        Flow.objects.get(pk=flow_id).do_calculate_flow_stats()
+    Flow.objects.get(pk=flow_id).do_calculate_flow_stats()
 
 
 @task(track_started=True, name="squash_flowruncounts")
@@ -127,6 +117,16 @@ def squash_flowruncounts():
             FlowRunCount.squash_counts()
 
 
+@task(track_started=True, name="squash_flowpathcounts")
+def squash_flowpathcounts():
+    r = get_redis_connection()
+
+    key = 'squash_flowpathcounts'
+    if not r.get(key):
+        with r.lock(key, timeout=900):
+            FlowPathCount.squash_counts()
+
+
 @task(track_started=True, name="delete_flow_results_task")
 def delete_flow_results_task(flow_id):
     flow = Flow.objects.get(id=flow_id)
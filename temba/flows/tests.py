@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
+import csv
 import datetime
 import json
 import os
@@ -28,9 +29,11 @@ from temba.triggers.models import Trigger
 from temba.utils import datetime_to_str, str_to_datetime
 from temba.values.models import Value
 from uuid import uuid4
+from zipfile import ZipFile
 from .flow_migrations import migrate_to_version_5, migrate_to_version_6, migrate_to_version_7, migrate_to_version_8
 from .models import Flow, FlowStep, FlowRun, FlowLabel, FlowStart, FlowRevision, FlowException, ExportFlowResultsTask
-from .models import ActionSet, RuleSet, Action, Rule, FlowRunCount, get_flow_user
+from .models import ActionSet, RuleSet, Action, Rule, FlowRunCount, FlowPathCount, FlowDefinition, FlowStatsCache
+from .models import get_flow_user
 from .models import Test, TrueTest, FalseTest, AndTest, OrTest, PhoneTest, NumberTest
 from .models import EqTest, LtTest, LteTest, GtTest, GteTest, BetweenTest
 from .models import DateEqualTest, DateAfterTest, DateBeforeTest, HasDateTest
@@ -39,6 +42,7 @@ from .models import HasStateTest, HasDistrictTest, HasWardTest
 from .models import SendAction, AddLabelAction, AddToGroupAction, ReplyAction, SaveToContactAction, SetLanguageAction
 from .models import EmailAction, StartFlowAction, TriggerFlowAction, DeleteFromGroupAction, WebhookAction, ActionLog
 from temba.msgs.models import WIRED
+from redis_cache import get_redis_connection
 
 
 class FlowTest(TembaTest):
@@ -533,7 +537,7 @@ class FlowTest(TembaTest):
         blocking_export.is_finished = True
         blocking_export.save()
 
-        with self.assertNumQueries(47):
+        with self.assertNumQueries(49):
             workbook = self.export_flow_results(self.flow)
 
         tz = pytz.timezone(self.org.timezone)
@@ -626,7 +630,7 @@ class FlowTest(TembaTest):
                                             "Test Channel"], tz)
 
         # test without msgs or runs or unresponded
-        with self.assertNumQueries(46):
+        with self.assertNumQueries(48):
             workbook = self.export_flow_results(self.flow, include_msgs=False, include_runs=False, responded_only=True)
 
         tz = pytz.timezone(self.org.timezone)
@@ -650,7 +654,7 @@ class FlowTest(TembaTest):
         age = ContactField.get_or_create(self.org, self.admin, 'age', "Age")
         self.contact.set_field(self.admin, 'age', 36)
 
-        with self.assertNumQueries(52):
+        with self.assertNumQueries(54):
             workbook = self.export_flow_results(self.flow, include_msgs=False, include_runs=True, responded_only=True,
                                                 contact_fields=[age])
 
@@ -746,6 +750,49 @@ class FlowTest(TembaTest):
             self.assertEqual(entries.nrows, 1)
             self.assertEqual(entries.ncols, 9)
 
+    def test_export_results_streamed(self):
+        self.flow.update(self.definition)
+        self.flow.start([], [self.contact, self.contact2])
+
+        Flow.find_and_handle(self.create_msg(direction=INCOMING, contact=self.contact, text="orange"))
+        Flow.find_and_handle(self.create_msg(direction=INCOMING, contact=self.contact2, text="green"))
+
+        # iterating steps in small chunks should give us every step in the same order as a single query
+        runs = FlowRun.objects.filter(flow=self.flow)
+        steps = FlowStep.objects.filter(run__flow=self.flow)
+        expected = list(steps.order_by('contact', 'run', 'arrived_on', 'pk'))
+        task = ExportFlowResultsTask.create('test', self.org, self.admin, [self.flow], [], False, True, True)
+
+        self.assertEqual(list(task.iter_steps(runs, steps, [], chunk_size=1)), expected)
+        self.assertEqual(list(task.iter_steps(runs, steps, [], chunk_size=runs.count())), expected)
+
+        # pretend Excel can only fit one row a sheet so our export is streamed as CSVs instead
+        with patch('temba.utils.exporter.TableExporter.MAX_XLS_ROWS', 1):
+            task.start_export()
+
+        task.refresh_from_db()
+        self.assertTrue(task.is_finished)
+        self.assertEqual(task.progress, 100)
+
+        filename = "%s/test_orgs/%d/results_exports/%s.zip" % (settings.MEDIA_ROOT, self.org.pk, task.uuid)
+        archive = ZipFile(filename)
+        self.assertEqual(archive.namelist(), ['Runs.csv', 'Contacts.csv', 'Messages.csv'])
+
+        runs = list(csv.reader(archive.open('Runs.csv')))
+        self.assertEqual(len(runs), 3)  # header + 2 runs
+        self.assertEqual(runs[0][:2], ["Contact UUID", "URN"])
+        self.assertEqual(runs[1][0], self.contact.uuid)
+        self.assertEqual(runs[1][6:], ["Orange", "orange", "orange"])
+        self.assertEqual(runs[2][0], self.contact2.uuid)
+        self.assertEqual(runs[2][6:], ["Other", "green", "green"])
+
+        contacts = list(csv.reader(archive.open('Contacts.csv')))
+        self.assertEqual(len(contacts), 3)
+
+        msgs = list(csv.reader(archive.open('Messages.csv')))
+        self.assertEqual(msgs[0], ["Contact UUID", "URN", "Name", "Date", "Direction", "Message", "Channel"])
+        self.assertEqual(len(msgs), 7)  # header + 3 messages for each contact
+
     def test_copy(self):
         # save our original flow
         self.flow.update(self.definition)
@@ -3124,6 +3171,47 @@ class FlowsTest(FlowFileTest):
     def clear_activity(self, flow):
         flow.clear_stats_cache()
 
+    def test_flow_definition_cache(self):
+        flow = self.get_flow('favorites')
+        color = RuleSet.objects.get(label='Color', flow=flow)
+
+        FlowDefinition.invalidate(flow)
+        Flow.get_node(flow, color.uuid, FlowStep.TYPE_RULE_SET)
+
+        # once loaded, getting nodes doesn't hit the database
+        with self.assertNumQueries(0):
+            node = Flow.get_node(flow, color.uuid, FlowStep.TYPE_RULE_SET)
+            rules = node.get_rules()
+            entry = Flow.get_node(flow, flow.entry_uuid, FlowStep.TYPE_ACTION_SET)
+            entry.get_actions()
+
+        self.assertEqual(color, node)
+        self.assertEqual(flow, node.flow)
+        self.assertEqual([rule.uuid for rule in color.get_rules()], [rule.uuid for rule in rules])
+
+        # callers get their own copies of nodes and rules
+        node.operand = '@step.value|upper_case'
+        rules[0].category = 'Changed'
+        other = Flow.get_node(flow, color.uuid, FlowStep.TYPE_RULE_SET)
+        self.assertEqual('@step.value', other.operand)
+        self.assertNotEqual('Changed', other.get_rules()[0].category)
+
+        # saving a node clears our definition
+        color.label = 'Colour'
+        color.save()
+        self.assertEqual('Colour', Flow.get_node(flow, color.uuid, FlowStep.TYPE_RULE_SET).label)
+
+        # as does saving a new revision of the flow
+        definition = flow.as_json()
+        for ruleset in definition['rule_sets']:
+            if ruleset['uuid'] == color.uuid:
+                ruleset['label'] = 'Shade'
+        flow.update(definition)
+        self.assertEqual('Shade', Flow.get_node(flow, color.uuid, FlowStep.TYPE_RULE_SET).label)
+
+        # and messages are still handled
+        self.assertEqual("I don't know that color. Try again.", self.send_message(flow, 'chartreuse'))
+
     def test_validate_flow_definition(self):
 
         with self.assertRaises(ValueError):
@@ -3417,6 +3505,76 @@ class FlowsTest(FlowFileTest):
         squash_flowruncounts()
         self.assertEqual(max_id, FlowRunCount.objects.all().order_by('-id').first().id)
 
+    def test_apply_activity(self):
+        flow = self.get_flow('favorites')
+        self.clear_activity(flow)
+
+        color = RuleSet.objects.get(label='Color', flow=flow)
+        beer = RuleSet.objects.get(label='Beer', flow=flow)
+        color_rule = color.get_rules()[0].uuid
+
+        # three runs arrive at color in one call, without taking a lock
+        with patch('temba.flows.models.Flow.lock_on') as mock_lock_on:
+            flow.apply_activity([(1, None, flow.entry_uuid, color.uuid),
+                                 (2, None, flow.entry_uuid, color.uuid),
+                                 (3, None, flow.entry_uuid, color.uuid)])
+            self.assertFalse(mock_lock_on.called)
+
+        (active, visited) = flow.get_activity(check_cache=False)
+        self.assertEqual({color.uuid: 3}, active)
+        self.assertEqual({'%s:%s' % (flow.entry_uuid, color.uuid): 3}, visited)
+
+        # two move on to beer and one exits
+        flow.apply_activity([(1, color.uuid, color_rule, beer.uuid),
+                             (2, color.uuid, color_rule, beer.uuid),
+                             (3, color.uuid, None, None)])
+
+        (active, visited) = flow.get_activity(check_cache=False)
+        self.assertEqual({beer.uuid: 2}, active)
+        self.assertEqual({'%s:%s' % (flow.entry_uuid, color.uuid): 3, '%s:%s' % (color_rule, beer.uuid): 2}, visited)
+
+        # runs can be removed in bulk
+        flow.remove_active_for_run_ids([1, 2])
+        self.assertEqual({}, flow.get_activity(check_cache=False)[0])
+
+    def test_path_counts(self):
+        flow = self.get_flow('favorites')
+
+        color = RuleSet.objects.get(label='Color', flow=flow)
+        other_action = ActionSet.objects.get(y=8, flow=flow)
+        other_rule_to_msg = '%s:%s' % (color.get_rules()[-1].uuid, other_action.uuid)
+
+        self.send_message(flow, 'chartreuse')
+        self.send_message(flow, 'mauve')
+
+        # our path counts match what our activity cache says
+        visits = FlowPathCount.get_visits(flow)
+        self.assertEqual(2, visits[other_rule_to_msg])
+        self.assertEqual({k: v for k, v in flow.get_activity()[1].items() if v}, visits)
+
+        # squashing leaves a single row for each path
+        FlowPathCount.squash_counts()
+        self.assertEqual(len(visits), FlowPathCount.objects.filter(flow=flow).count())
+        self.assertEqual(visits, FlowPathCount.get_visits(flow))
+
+        # test contacts don't count
+        test_contact = Contact.get_test_contact(self.admin)
+        self.send_message(flow, 'chartreuse', contact=test_contact)
+        self.assertEqual(visits, FlowPathCount.get_visits(flow))
+
+        # a rebuild uses our path counts rather than looking at every step
+        self.clear_activity(flow)
+        with patch('temba.flows.models.Flow._calculate_visits') as mock_calculate_visits:
+            flow.do_calculate_flow_stats()
+            self.assertFalse(mock_calculate_visits.called)
+
+        self.assertEqual(visits, flow.get_activity()[1])
+
+        # and can be repopulated from the steps themselves
+        FlowPathCount.objects.filter(flow=flow).delete()
+        FlowPathCount.populate_for_flow(flow)
+        self.assertEqual(visits, FlowPathCount.get_visits(flow))
+
     def test_activity(self):
 
         flow = self.get_flow('favorites')
@@ -3495,6 +3653,40 @@ class FlowsTest(FlowFileTest):
         self.assertEquals(1, flow.get_completed_runs())
         self.assertEquals(50, flow.get_completed_percentage())
 
+        # activity applied during a rebuild is replayed onto the rebuilt cache rather than lost
+        calculate_activity = flow._calculate_activity
+
+        def calculate_with_activity(*args, **kwargs):
+            result = calculate_activity(*args, **kwargs)
+            flow.apply_activity([(123456, None, 'elsewhere', beer.uuid)])
+            return result
+
+        with patch('temba.flows.models.Flow._calculate_activity') as mock_calculate_activity:
+            mock_calculate_activity.side_effect = calculate_with_activity
+            flow.do_calculate_flow_stats()
+
+        (rebuilt_active, rebuilt_visited) = flow.get_activity()
+        self.assertEqual(active.get(beer.uuid, 0) + 1, rebuilt_active[beer.uuid])
+        self.assertEqual(1, rebuilt_visited['elsewhere:%s' % beer.uuid])
+
+        # including runs being removed from every step
+        def calculate_with_removal(*args, **kwargs):
+            result = calculate_activity(*args, **kwargs)
+            flow.remove_active_for_run_ids([123456])
+            return result
+
+        with patch('temba.flows.models.Flow._calculate_activity') as mock_calculate_activity:
+            mock_calculate_activity.side_effect = calculate_with_removal
+            flow.do_calculate_flow_stats()
+
+        self.assertEqual(active, flow.get_activity()[0])
+
+        # and once the rebuild is done, nothing more is journaled
+        r = get_redis_connection()
+        flow.apply_activity([(123456, None, None, beer.uuid)])
+        self.assertFalse(r.exists(flow.get_stats_cache_key(FlowStatsCache.activity_journal)))
+        flow.remove_active_for_run_ids([123456])
+
         # we are going to expire, but we want runs across two different flows
         # to make sure that our optimization for expiration is working properly
         cga_flow = self.get_flow('color_gender_age')
@@ -4873,6 +5065,39 @@ class FlowBatchTest(FlowFileTest):
         self.assertEqual(step.messages.all().count(), 1)
         self.assertEqual(step.broadcasts.all().count(), 1)
 
+    def test_flow_batch_start_bulk_steps(self):
+        flow = self.get_flow('favorites')
+        flow.clear_stats_cache()
+
+        color = RuleSet.objects.get(label='Color', flow=flow)
+
+        contacts = []
+        for i in range(5):
+            contacts.append(self.create_contact("Contact %d" % i, "2507883833%02d" % i))
+
+        flow.start([], contacts)
+
+        # each run has left the entry step for the color ruleset where it is waiting
+        self.assertEqual(5, FlowStep.objects.filter(step_uuid=flow.entry_uuid, next_uuid=color.uuid).exclude(left_on=None).count())
+        self.assertEqual(5, FlowStep.objects.filter(step_uuid=color.uuid, left_on=None).count())
+        self.assertEqual(5, FlowRun.objects.filter(is_active=True).count())
+
+        # with the message for each contact and the broadcast on its entry step
+        broadcast = Broadcast.objects.get()
+        for contact in contacts:
+            step = FlowStep.objects.get(contact=contact, step_uuid=flow.entry_uuid)
+            self.assertEqual(Msg.all_messages.get(contact=contact), step.messages.get())
+            self.assertEqual(broadcast, step.broadcasts.get())
+
+        (active, visited) = flow.get_activity()
+        self.assertEqual({color.uuid: 5}, active)
+        self.assertEqual(5, visited['%s:%s' % (flow.entry_uuid, color.uuid)])
+
+        # and they can carry on through the flow
+        self.send_message(flow, 'blue', contact=contacts[0])
+        (active, visited) = flow.get_activity()
+        self.assertEqual(4, active[color.uuid])
+
 
 class OrderingTest(FlowFileTest):
 
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orgs', '0018_fix_org_groups'),
+        ('msgs', '0057_update_triggers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MsgArchive',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('start_date', models.DateField(help_text='The first day of the month of messages in this archive')),
+                ('record_count', models.IntegerField(help_text='The number of messages in this archive')),
+                ('size', models.IntegerField(help_text='The size of the archive file in bytes')),
+                ('path', models.CharField(help_text='The storage path of the archive file', max_length=255)),
+                ('created_on', models.DateTimeField(default=django.utils.timezone.now, help_text='When this archive was created')),
+                ('org', models.ForeignKey(related_name='msg_archives', to='orgs.Org', help_text='The org whose messages are archived')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='msgarchive',
+            unique_together=set([('org', 'start_date')]),
+        ),
+    ]
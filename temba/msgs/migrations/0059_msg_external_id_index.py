@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+INDEX_SQL = """
+DO $$
+BEGIN
+
+IF NOT EXISTS (
+    SELECT 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relname = 'msgs_msg_channel_external_id' AND n.nspname = 'public') THEN
+    CREATE INDEX msgs_msg_channel_external_id ON msgs_msg (channel_id, external_id) WHERE external_id IS NOT NULL;
+END IF;
+
+END$$;"""
+
+DROP_SQL = "DROP INDEX IF EXISTS msgs_msg_channel_external_id;"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('msgs', '0058_msgarchive'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='msg',
+            name='external_id',
+            field=models.CharField(help_text='External id used for integrating with callbacks from other APIs', max_length=255, null=True, verbose_name='External ID', blank=True),
+        ),
+        migrations.RunSQL(INDEX_SQL, DROP_SQL)
+    ]
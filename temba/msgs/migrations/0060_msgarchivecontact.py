@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0036_reevaluate_dynamic_groups'),
+        ('msgs', '0059_msg_external_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MsgArchiveContact',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('chunks', models.TextField(help_text="The offsets and lengths of the archive chunks with this contact's messages, as JSON")),
+                ('archive', models.ForeignKey(related_name='contacts', to='msgs.MsgArchive', help_text='The archive')),
+                ('contact', models.ForeignKey(related_name='msg_archives', to='contacts.Contact', help_text='The contact with messages in the archive')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='msgarchivecontact',
+            unique_together=set([('archive', 'contact')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('msgs', '0060_msgarchivecontact'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='msgarchive',
+            name='chunks',
+            field=models.TextField(help_text='The offsets and lengths of the chunks of the archive, as JSON', null=True),
+        ),
+    ]
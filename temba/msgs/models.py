@@ -1,17 +1,23 @@
 from __future__ import unicode_literals
 
+import gzip
 import json
 import logging
+import os
 import pytz
 import regex
 import time
 import traceback
 
+from collections import Counter, defaultdict
 from datetime import datetime, timedelta
+from io import BytesIO
+from itertools import chain
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
 from django.core.files import File
+from django.core.files.storage import default_storage
 from django.core.files.temp import NamedTemporaryFile
 from django.db import models, transaction, connection
 from django.db.models import Q, Count, Prefetch, Sum
@@ -23,11 +29,13 @@ from redis_cache import get_redis_connection
 from smartmin.models import SmartModel
 from temba.contacts.models import Contact, ContactGroup, ContactURN, URN, TEL_SCHEME
 from temba.channels.models import Channel, ChannelEvent, ANDROID, SEND, CALL
-from temba.orgs.models import Org, TopUp, Language, UNREAD_INBOX_MSGS
+from temba.orgs.models import Org, TopUp, TopUpCredits, Language, UNREAD_INBOX_MSGS
 from temba.schedules.models import Schedule
+from temba.utils.cache import redis_writes
 from temba.utils.email import send_template_email
 from temba.utils import get_datetime_format, datetime_to_str, analytics, chunk_list
-from temba.utils.expressions import evaluate_template
+from temba.utils import datetime_to_json_date, json_date_to_datetime
+from temba.utils.expressions import evaluate_template, compile_template
 from temba.utils.models import TembaModel
 from temba.utils.queues import DEFAULT_PRIORITY, push_task, LOW_PRIORITY, HIGH_PRIORITY
 from uuid import uuid4
@@ -38,11 +46,21 @@ __message_handlers = None
 
 MSG_QUEUE = 'msgs'
 SEND_MSG_TASK = 'send_msg_task'
+SEND_MSG_BATCH_SIZE = 10
+SEND_MSG_BATCH_ORGS = 5
 
 HANDLER_QUEUE = 'handler'
 HANDLE_EVENT_TASK = 'handle_event_task'
 MSG_EVENT = 'msg'
 FIRE_EVENT = 'fire'
+HANDLE_EVENT_BATCH_SIZE = 10
+HANDLE_EVENT_BATCH_ORGS = 5
+CREATE_INCOMING_TASK = 'create_incoming_task'
+CREATE_INCOMING_BATCH_SIZE = 100
+CREATE_INCOMING_BATCH_ORGS = 5
+CREATE_INCOMING_MAX_ATTEMPTS = 3
+MSG_STATUS_QUEUE = 'msg_status_updates'
+MSG_STATUS_BATCH_SIZE = 1000
 
 BATCH_SIZE = 500
 
@@ -72,6 +90,15 @@ BULK_THRESHOLD = 50
 
 MSG_SENT_KEY = 'msgs_sent_%y_%m_%d'
 
+# maps a channel and external id to the ids of the messages sent with it, for as long as we expect delivery reports
+MSG_EXTERNAL_ID_KEY = 'msg_external_id:%d:%s'
+MSG_EXTERNAL_ID_TTL = 60 * 60 * 24 * 3
+
+# the storage paths of the written parts of a message export, and how many parts are still to be written
+EXPORT_PARTS_KEY = 'msg_export_parts:%d'
+EXPORT_PARTS_REMAINING_KEY = 'msg_export_parts_remaining:%d'
+EXPORT_PARTS_TTL = 60 * 60 * 24
+
 # status codes used for both messages and broadcasts (single char constant, human readable, API readable)
 STATUS_CONFIG = (
     # special state for flows used to hold off sending the message until the flow is ready to receive a response
@@ -368,10 +395,6 @@ class Broadcast(models.Model):
 
         RelatedRecipient = Broadcast.recipients.through
 
-        # we batch up our SQL calls to speed up the creation of our SMS objects
-        batch = []
-        recipient_batch = []
-
         # our priority is based on the number of recipients
         priority = SMS_NORMAL_PRIORITY
         if len(recipients) == 1:
@@ -401,66 +424,53 @@ class Broadcast(models.Model):
         if self.language_dict:
             text_translations = json.loads(self.language_dict)
 
-        for recipient in recipients:
-            contact = recipient if isinstance(recipient, Contact) else recipient.contact
-
-            # if contact has a language and it's a valid org language, it has priority
-            if contact.language and contact.language in org_languages:
-                preferred_languages = [contact.language] + other_preferred_languages
-            else:
-                preferred_languages = other_preferred_languages
+        # we prepare and commit our messages in batches
+        for recipient_chunk in chunk_list(recipients, BATCH_SIZE):
+            recipient_texts = []
+            for recipient in recipient_chunk:
+                contact = recipient if isinstance(recipient, Contact) else recipient.contact
 
-            # find the right text to send
-            text = Language.get_localized_text(text_translations, preferred_languages, self.text)
+                # if contact has a language and it's a valid org language, it has priority
+                if contact.language and contact.language in org_languages:
+                    preferred_languages = [contact.language] + other_preferred_languages
+                else:
+                    preferred_languages = other_preferred_languages
+
+                # find the right text to send
+                recipient_texts.append((recipient, Language.get_localized_text(text_translations, preferred_languages, self.text)))
+
+            # contacts which we have no way of reaching won't get a message
+            batch = Msg.create_outgoing_batch(org, self.created_by, recipient_texts,
+                                              broadcast=self,
+                                              channel=self.channel,
+                                              response_to=response_to,
+                                              message_context=message_context,
+                                              status=status,
+                                              msg_type=msg_type,
+                                              priority=priority,
+                                              created_on=created_on)
+            if not batch:
+                continue
 
             try:
-                msg = Msg.create_outgoing(org,
-                                          self.created_by,
-                                          recipient,
-                                          text,
-                                          broadcast=self,
-                                          channel=self.channel,
-                                          response_to=response_to,
-                                          message_context=message_context,
-                                          status=status,
-                                          msg_type=msg_type,
-                                          insert_object=False,
-                                          priority=priority,
-                                          created_on=created_on)
-
-            except UnreachableException:
-                # there was no way to reach this contact, do not create a message
-                msg = None
-
-            # only add it to our batch if it was legit
-            if msg:
-                batch.append(msg)
-                # keep track of this URN as a recipient
-                recipient_batch.append(RelatedRecipient(contacturn_id=msg.contact_urn_id, broadcast_id=self.id))
-
-            # we commit our messages in batches
-            if len(batch) >= BATCH_SIZE:
                 Msg.all_messages.bulk_create(batch)
-                RelatedRecipient.objects.bulk_create(recipient_batch)
-
-                # send any messages
-                if trigger_send:
-                    self.org.trigger_send(Msg.current_messages.filter(broadcast=self, created_on=created_on).select_related('contact', 'contact_urn', 'channel'))
-
-                    # increment our created on so we can load our next batch
-                    created_on = created_on + timedelta(seconds=1)
-
-                batch = []
-                recipient_batch = []
+            except Exception:
+                # these messages were never created, so give back the credits reserved for them
+                for topup_id, count in Counter([msg.topup_id for msg in batch if not msg.contact.is_test]).items():
+                    org.release_credits(topup_id, count)
+                raise
 
-        # commit any remaining objects
-        if batch:
-            Msg.all_messages.bulk_create(batch)
-            RelatedRecipient.objects.bulk_create(recipient_batch)
+            # keep track of these URNs as recipients
+            RelatedRecipient.objects.bulk_create([RelatedRecipient(contacturn_id=msg.contact_urn_id, broadcast_id=self.id)
+                                                  for msg in batch])
 
+            # send any messages
             if trigger_send:
                 self.org.trigger_send(Msg.current_messages.filter(broadcast=self, created_on=created_on).select_related('contact', 'contact_urn', 'channel'))
 
+                # increment our created on so we can load our next batch
+                created_on = created_on + timedelta(seconds=1)
+
         # for large batches, status is handled externally
         # we do this as with the high concurrency of sending we can run into postgresl deadlocks
         # (this could be our fault, or could be: http://www.postgresql.org/message-id/20140731233051.GN17765@andrew-ThinkPad-X230)
@@ -625,7 +635,8 @@ class Msg(models.Model):
     next_attempt = models.DateTimeField(auto_now_add=True, verbose_name=_("Next Attempt"),
                                         help_text=_("When we should next attempt to deliver this message"))
 
-    external_id = models.CharField(max_length=255, null=True, blank=True, db_index=True, verbose_name=_("External ID"),
+    # indexed by a partial index on (channel, external_id) for messages which have one, see migration 0059
+    external_id = models.CharField(max_length=255, null=True, blank=True, verbose_name=_("External ID"),
                                    help_text=_("External id used for integrating with callbacks from other APIs"))
 
     topup = models.ForeignKey(TopUp, null=True, blank=True, related_name='msgs', on_delete=models.SET_NULL,
@@ -855,6 +866,53 @@ class Msg(models.Model):
             if channel:
                 analytics.gauge('temba.msg_errored_%s' % channel.channel_type.lower())
 
+    @classmethod
+    def resolve_external_ids(cls, channel_external_ids, r=None):
+        """
+        Resolves a list of (channel id, external id) tuples to the ids of the messages sent with them. Messages sent
+        recently are found in redis, any others in the database. Returns a dict of (channel id, external id) to a
+        list of message ids.
+        """
+        if not r:
+            r = get_redis_connection()
+
+        channel_external_ids = list(set(channel_external_ids))
+
+        pipe = r.pipeline()
+        for channel_id, external_id in channel_external_ids:
+            pipe.smembers(MSG_EXTERNAL_ID_KEY % (channel_id, external_id))
+
+        resolved = dict()
+        missing = []
+        for channel_external_id, msg_ids in zip(channel_external_ids, pipe.execute()):
+            if msg_ids:
+                resolved[channel_external_id] = sorted([int(msg_id) for msg_id in msg_ids])
+            else:
+                missing.append(channel_external_id)
+
+        if missing:
+            by_channel = defaultdict(set)
+            for channel_id, external_id in missing:
+                by_channel[channel_id].add(external_id)
+
+            missing_q = Q(pk__in=[])
+            for channel_id, external_ids in by_channel.items():
+                missing_q |= Q(channel_id=channel_id, external_id__in=external_ids)
+
+            msgs = Msg.all_messages.filter(missing_q).exclude(external_id=None).order_by('id')
+            for msg_id, channel_id, external_id in msgs.values_list('id', 'channel', 'external_id'):
+                resolved.setdefault((channel_id, external_id), []).append(msg_id)
+
+        return resolved
+
+    @classmethod
+    def get_by_external_id(cls, channel, external_id):
+        """
+        Gets the current messages sent by the given channel with the given external id, usually just one
+        """
+        msg_ids = cls.resolve_external_ids([(channel.id, external_id)]).get((channel.id, external_id), [])
+        return Msg.current_messages.filter(channel=channel, pk__in=msg_ids)
+
     @classmethod
     def mark_sent(cls, r, channel, msg, status, latency, external_id=None):
         """
@@ -867,11 +925,16 @@ class Msg(models.Model):
             msg.external_id = external_id
 
         # use redis to mark this message sent
-        pipe = r.pipeline()
-        sent_key = timezone.now().strftime(MSG_SENT_KEY)
-        pipe.sadd(sent_key, str(msg.id))
-        pipe.expire(sent_key, 86400)
-        pipe.execute()
+        with redis_writes(r) as pipe:
+            sent_key = timezone.now().strftime(MSG_SENT_KEY)
+            pipe.sadd(sent_key, str(msg.id))
+            pipe.expire(sent_key, 86400)
+
+            # and remember its external id so delivery reports can find it without querying by external id
+            if external_id:
+                external_id_key = MSG_EXTERNAL_ID_KEY % (msg.channel, external_id)
+                pipe.sadd(external_id_key, str(msg.id))
+                pipe.expire(external_id_key, MSG_EXTERNAL_ID_TTL)
 
         if external_id:
             Msg.current_messages.filter(id=msg.id).update(status=status, sent_on=msg.sent_on, external_id=external_id)
@@ -899,6 +962,64 @@ class Msg(models.Model):
                     created_on=self.created_on.strftime('%x %X'),
                     model="msg")
 
+    def as_archive_json(self):
+        """
+        Returns this message as JSON for a message archive, including what exports need to know about its contact,
+        URN and labels as those may have changed or no longer exist when it is read back
+        """
+        def date_or_none(d):
+            return datetime_to_json_date(d, micros=True) if d else None
+
+        return dict(id=self.id, org=self.org_id, channel=self.channel_id, broadcast=self.broadcast_id,
+                    contact=dict(id=self.contact_id, uuid=self.contact.uuid, name=self.contact.name,
+                                 is_test=self.contact.is_test),
+                    contact_urn=self.contact_urn_id, urn=self.contact_urn.urn if self.contact_urn else None,
+                    response_to=self.response_to_id, direction=self.direction, text=self.text, media=self.media,
+                    status=self.status, visibility=self.visibility, msg_type=self.msg_type, priority=self.priority,
+                    has_template_error=self.has_template_error, msg_count=self.msg_count,
+                    error_count=self.error_count, external_id=self.external_id, topup=self.topup_id,
+                    labels=[dict(uuid=l.uuid, name=l.name) for l in self.labels.all()],
+                    created_on=date_or_none(self.created_on), modified_on=date_or_none(self.modified_on),
+                    sent_on=date_or_none(self.sent_on), queued_on=date_or_none(self.queued_on))
+
+    @classmethod
+    def from_archive_json(cls, record):
+        """
+        Creates an unsaved message from a message archive record, which is attached as archive_record
+        """
+        def date_or_none(d):
+            return json_date_to_datetime(d) if d else None
+
+        msg = Msg(id=record['id'], org_id=record['org'], channel_id=record['channel'],
+                  broadcast_id=record['broadcast'], contact_id=record['contact']['id'],
+                  contact_urn_id=record['contact_urn'], response_to_id=record['response_to'],
+                  direction=record['direction'], text=record['text'], media=record['media'], status=record['status'],
+                  visibility=record['visibility'], msg_type=record['msg_type'], priority=record['priority'],
+                  has_template_error=record['has_template_error'], msg_count=record['msg_count'],
+                  error_count=record['error_count'], external_id=record['external_id'], topup_id=record['topup'],
+                  created_on=date_or_none(record['created_on']), modified_on=date_or_none(record['modified_on']),
+                  sent_on=date_or_none(record['sent_on']), queued_on=date_or_none(record['queued_on']))
+        msg.archive_record = record
+        return msg
+
+    @classmethod
+    def delete_archived(cls, msg_ids):
+        """
+        Deletes messages which have been archived. Their credits remain used.
+        """
+        for batch in chunk_list(msg_ids, 1000):
+            batch = list(batch)
+
+            # newer messages may be responses to these
+            Msg.all_messages.filter(response_to__in=batch).exclude(id__in=batch).update(response_to=None)
+
+            # deleting messages gives back their credits, so record them as used again
+            used = Msg.all_messages.filter(id__in=batch).exclude(topup=None).order_by().values('topup')
+            used = used.annotate(count=Count('id'))
+            TopUpCredits.objects.bulk_create([TopUpCredits(topup_id=u['topup'], used=u['count']) for u in used])
+
+            Msg.all_messages.filter(id__in=batch).delete()
+
     def simulator_json(self):
         msg_json = self.as_json()
         msg_json['text'] = escape(self.text).replace('\n', "<br/>")
@@ -1172,6 +1293,179 @@ class Msg(models.Model):
 
         return msg
 
+    @classmethod
+    def stage_incoming(cls, channel, urn, text, date=None, media=None, external_id=None):
+        """
+        Accepts a new incoming message from a channel handler. When STAGE_INCOMING_MSGS is set, the message is just
+        queued to be created in a batch by create_incoming_task and we return None, otherwise it is created and
+        returned immediately.
+        """
+        if not getattr(settings, 'STAGE_INCOMING_MSGS', False):
+            msg = Msg.create_incoming(channel, urn, text, date=date, media=media)
+            if external_id:
+                Msg.all_messages.filter(pk=msg.id).update(external_id=external_id)
+                msg.external_id = external_id
+            return msg
+
+        # fix our date now, it is what lets us ignore retries of the same message from aggregators
+        if not date:
+            date = timezone.now()
+
+        push_task(channel.org, HANDLER_QUEUE, CREATE_INCOMING_TASK,
+                  dict(channel=channel.id, urn=urn, text=text, date=datetime_to_json_date(date, micros=True),
+                       media=media, external_id=external_id))
+        return None
+
+    @classmethod
+    def create_incoming_batch(cls, staged_msgs):
+        """
+        Creates the incoming messages queued by stage_incoming. Channels and existing contacts are loaded, duplicates
+        checked for, credits taken and messages created for the whole batch at once, then each message is handled as
+        usual.
+
+        By now the batch has been taken off its queue and acknowledged to the aggregator, so a failure for one message
+        mustn't lose the others. Messages which can't be created are queued again, up to CREATE_INCOMING_MAX_ATTEMPTS
+        times, and any credit taken for them is given back.
+        """
+        from temba.api.models import WebHookEvent, SMS_RECEIVED
+
+        channel_ids = set([staged['channel'] for staged in staged_msgs])
+        channels = Channel.objects.filter(pk__in=channel_ids, is_active=True).exclude(org=None).select_related('org')
+        channels_by_id = {channel.pk: channel for channel in channels}
+
+        # organize our messages by org, messages for channels which have since been removed are dropped
+        staged_by_org = defaultdict(list)
+        for staged in staged_msgs:
+            channel = channels_by_id.get(staged['channel'])
+            if channel:
+                staged_by_org[channel.org_id].append((channel, staged))
+
+        def requeue(channel, staged):
+            attempts = staged.get('attempts', 0) + 1
+            if attempts < CREATE_INCOMING_MAX_ATTEMPTS:
+                push_task(channel.org, HANDLER_QUEUE, CREATE_INCOMING_TASK, dict(staged, attempts=attempts))
+            else:
+                logger.error("Giving up on incoming message after %d attempts: %s" % (attempts, json.dumps(staged)))
+
+        user = User.objects.get(pk=settings.ANONYMOUS_USER_ID)
+        created = []
+
+        def create_msg(channel, staged, contact, contact_urn, date, text, topup_id, now):
+            return Msg(contact=contact, contact_urn=contact_urn, org=channel.org, channel=channel, text=text,
+                       created_on=date, modified_on=now, queued_on=now, direction=INCOMING, media=staged['media'],
+                       external_id=staged.get('external_id'), status=PENDING, topup_id=topup_id)
+
+        for org_staged in staged_by_org.values():
+            org = org_staged[0][0].org
+
+            # URNs which already have contacts are looked up in one query, only new URNs need get_or_create
+            normalized = {}
+            for channel, staged in org_staged:
+                normalized[(channel.pk, staged['urn'])] = URN.normalize(staged['urn'], channel.country.code)
+
+            existing_urns = ContactURN.objects.filter(org=org, urn__in=set(normalized.values())).exclude(contact=None)
+            existing_urns = {urn.urn: urn for urn in existing_urns.select_related('contact')}
+            urn_channel_updates = defaultdict(set)
+
+            pending = []
+            for channel, staged in org_staged:
+                try:
+                    contact_urn = existing_urns.get(normalized[(channel.pk, staged['urn'])])
+                    if contact_urn:
+                        contact = contact_urn.contact
+
+                        # like get_or_create, incoming messages move their URN's affinity to their channel
+                        if contact_urn.channel_id != channel.pk:
+                            contact_urn.channel = channel
+                            urn_channel_updates[channel].add(contact_urn.pk)
+                    else:
+                        contact = Contact.get_or_create(org, user, urns=[staged['urn']], incoming_channel=channel)
+                        contact_urn = contact.urn_objects[staged['urn']]
+
+                    date = json_date_to_datetime(staged['date'])
+                    pending.append((channel, staged, contact, contact_urn, date))
+                except Exception:
+                    logger.exception("Unable to get contact for incoming message")
+                    requeue(channel, staged)
+
+            try:
+                for channel, urn_ids in urn_channel_updates.items():
+                    ContactURN.objects.filter(pk__in=urn_ids).update(channel=channel)
+
+                # aggregators retry their requests, so ignore any message we already have, whether in the database
+                # or earlier in this batch
+                existing = Msg.all_messages.filter(direction=INCOMING, contact__in=[p[2] for p in pending],
+                                                   created_on__in=[p[4] for p in pending])
+                seen = set(existing.values_list('contact_id', 'text', 'created_on'))
+
+                new = []
+                for channel, staged, contact, contact_urn, date in pending:
+                    text = staged['text'][:640] if staged['text'] else staged['text']
+                    key = (contact.pk, text, date)
+                    if key not in seen:
+                        seen.add(key)
+                        new.append((channel, staged, contact, contact_urn, date, text))
+
+                # costs 1 credit to receive a message
+                topup_ids = iter(org.decrement_credits(len([n for n in new if not n[2].is_test])))
+            except Exception:
+                logger.exception("Unable to check incoming messages for org %d" % org.pk)
+                for channel, staged, contact, contact_urn, date in pending:
+                    requeue(channel, staged)
+                continue
+
+            now = timezone.now()
+            new = [n + (None if n[2].is_test else next(topup_ids),) for n in new]
+            org_created = []
+
+            # create all our messages at once, and since bulk_create doesn't give us their ids, look them up by their
+            # contact, text and date which we know are unique
+            try:
+                msgs = [create_msg(*(n + (now,))) for n in new]
+                with transaction.atomic():
+                    Msg.all_messages.bulk_create(msgs)
+
+                created_ids = Msg.all_messages.filter(org=org, direction=INCOMING, queued_on=now,
+                                                      contact__in=[m.contact for m in msgs])
+                created_ids = {(c, t, d): pk for c, t, d, pk in created_ids.values_list('contact', 'text',
+                                                                                        'created_on', 'pk')}
+                for msg in msgs:
+                    msg.pk = created_ids[(msg.contact_id, msg.text, msg.created_on)]
+                    org_created.append((msg.channel, msg))
+
+            # if that fails, fall back to creating them one by one so only those which fail are retried
+            except Exception:
+                logger.exception("Unable to bulk create incoming messages for org %d" % org.pk)
+
+                for channel, staged, contact, contact_urn, date, text, topup_id in new:
+                    try:
+                        with transaction.atomic():
+                            msg = create_msg(channel, staged, contact, contact_urn, date, text, topup_id, now)
+                            msg.save()
+                    except Exception:
+                        logger.exception("Unable to create incoming message")
+                        if not contact.is_test:
+                            org.release_credits(topup_id, 1)
+                        requeue(channel, staged)
+                        continue
+
+                    org_created.append((channel, msg))
+
+            for channel, msg in org_created:
+                created.append(msg)
+                analytics.gauge('temba.msg_incoming_%s' % channel.channel_type.lower())
+
+                # once created, a message which fails to be handled is left pending for check_messages_task
+                try:
+                    msg.handle()
+
+                    # fire an event off for this message
+                    WebHookEvent.trigger_sms_event(SMS_RECEIVED, msg, msg.created_on)
+                except Exception:
+                    logger.exception("Unable to handle incoming message %d" % msg.pk)
+
+        return created
+
     @classmethod
     def substitute_variables(cls, text, contact, message_context,
                              org=None, url_encode=False, partial_vars=False):
@@ -1200,16 +1494,26 @@ class Msg(models.Model):
             dayfirst = org.get_dayfirst()
             tz = org.get_tzinfo()
 
-        (format_date, format_time) = get_datetime_format(dayfirst)
+        # our date context only needs building once when a context is used for a batch of messages
+        if 'date' not in message_context:
+            (format_date, format_time) = get_datetime_format(dayfirst)
+            now = timezone.now()
+
+            date_context = dict()
+            date_context['__default__'] = datetime_to_str(now, format=format_time, tz=tz)
+            date_context['now'] = date_context['__default__']
+            date_context['today'] = datetime_to_str(now, format=format_date, tz=tz)
+            date_context['tomorrow'] = datetime_to_str(now + timedelta(days=1), format=format_date, tz=tz)
+            date_context['yesterday'] = datetime_to_str(now - timedelta(days=1), format=format_date, tz=tz)
 
-        date_context = dict()
-        date_context['__default__'] = datetime_to_str(timezone.now(), format=format_time, tz=tz)
-        date_context['now'] = datetime_to_str(timezone.now(), format=format_time, tz=tz)
-        date_context['today'] = datetime_to_str(timezone.now(), format=format_date, tz=tz)
-        date_context['tomorrow'] = datetime_to_str(timezone.now() + timedelta(days=1), format=format_date, tz=tz)
-        date_context['yesterday'] = datetime_to_str(timezone.now() - timedelta(days=1), format=format_date, tz=tz)
+            message_context['date'] = date_context
 
-        message_context['date'] = date_context
+        # templates which are just simple variable references don't need to go through the full evaluator
+        if not url_encode:
+            compiled = compile_template(text)
+            output = compiled.evaluate(message_context) if compiled else None
+            if output is not None:
+                return output, []
 
         date_style = DateStyle.DAY_FIRST if dayfirst else DateStyle.MONTH_FIRST
         context = EvaluationContext(message_context, tz, date_style)
@@ -1262,37 +1566,8 @@ class Msg(models.Model):
         (text, errors) = Msg.substitute_variables(text, contact, message_context, org=org)
 
         # if we are doing a single message, check whether this might be a loop of some kind
-        if insert_object:
-            # prevent the loop of message while the sending phone is the channel
-            # get all messages with same text going to same number
-            same_msgs = Msg.current_messages.filter(contact_urn=contact_urn,
-                                                    contact__is_test=False,
-                                                    channel=channel,
-                                                    media=media,
-                                                    text=text,
-                                                    direction=OUTGOING,
-                                                    created_on__gte=created_on - timedelta(minutes=10))
-
-            # we aren't considered with robo detection on calls
-            same_msg_count = same_msgs.exclude(msg_type=IVR).count()
-
-            if same_msg_count >= 10:
-                analytics.gauge('temba.msg_loop_caught')
-                return None
-
-            # be more aggressive about short codes for duplicate messages
-            # we don't want machines talking to each other
-            tel = contact.raw_tel()
-            if tel and len(tel) < 6:
-                same_msg_count = Msg.current_messages.filter(contact_urn=contact_urn,
-                                                             contact__is_test=False,
-                                                             channel=channel,
-                                                             text=text,
-                                                             direction=OUTGOING,
-                                                             created_on__gte=created_on - timedelta(hours=24)).count()
-                if same_msg_count >= 10:
-                    analytics.gauge('temba.msg_shortcode_loop_caught')
-                    return None
+        if insert_object and cls.find_loops(org, [(contact, contact_urn, channel, text, media)], created_on):
+            return None
 
         # costs 1 credit to send a message
         if not topup_id and not contact.is_test:
@@ -1328,6 +1603,168 @@ class Msg(models.Model):
 
         return Msg.all_messages.create(**msg_args) if insert_object else Msg(**msg_args)
 
+    @classmethod
+    def create_outgoing_batch(cls, org, user, recipients, broadcast=None, channel=None, priority=SMS_NORMAL_PRIORITY,
+                              created_on=None, response_to=None, message_context=None, status=PENDING, media=None,
+                              msg_type=INBOX, check_loops=False):
+        """
+        Prepares unsaved outgoing messages for a chunk of recipients, each a tuple of the recipient and the text to
+        send them. URNs and channels are resolved for the whole chunk, credits are reserved in bulk and if loop
+        detection is requested, that is done in grouped queries for the chunk. Recipients we can't reach are skipped.
+        """
+        if not org or not user:  # pragma: no cover
+            raise ValueError("Trying to create outgoing messages with no org or user")
+
+        # for IVR messages we need a channel that can call
+        role = CALL if msg_type == IVR else SEND
+
+        if not created_on:
+            created_on = timezone.now()
+
+        if not message_context:
+            message_context = dict()
+
+        # a step given by the caller is shared by every message, otherwise each recipient gets their own
+        shared_step = 'step' in message_context
+
+        if response_to:
+            msg_type = response_to.msg_type
+
+        # first resolve each recipient to a contact and URN
+        resolved = []
+        for recipient, text in recipients:
+            if status != SENT:
+                contact, contact_urn = cls.resolve_recipient(org, user, recipient, channel, role=role)
+                if contact_urn:
+                    resolved.append((contact, contact_urn, text))
+            else:
+                # if messages have already been sent, recipients must be tuples of contact and URN
+                contact, contact_urn = recipient
+                resolved.append((contact, contact_urn, text))
+
+        # fetch the channels last used by any of our URNs in one query rather than one per URN
+        if status != SENT and not channel:
+            urns = [r[1] for r in resolved if r[1].channel_id]
+            urn_channels = {c.id: c for c in Channel.objects.filter(pk__in={urn.channel_id for urn in urns})}
+            for urn in urns:
+                if urn.channel_id in urn_channels:
+                    urn.channel = urn_channels[urn.channel_id]
+
+        channel_contexts = dict()
+        candidates = []
+        for contact, contact_urn, text in resolved:
+            msg_channel = channel
+
+            if status != SENT and not msg_channel:
+                if msg_type == IVR:
+                    msg_channel = org.get_call_channel()
+                else:
+                    msg_channel = org.get_send_channel(contact_urn=contact_urn)
+
+                if not msg_channel and not contact.is_test:
+                    raise ValueError("No suitable channel available for this org")
+
+            # make sure 'channel' is populated if we have a channel, building each channel's context only once
+            if msg_channel:
+                if msg_channel.id not in channel_contexts:
+                    channel_contexts[msg_channel.id] = msg_channel.build_message_context()
+                message_context['channel'] = channel_contexts[msg_channel.id]
+
+            if not shared_step:
+                message_context.pop('step', None)
+
+            (text, errors) = Msg.substitute_variables(text, contact, message_context, org=org)
+
+            candidates.append((contact, contact_urn, msg_channel, text, media, errors))
+
+        # drop any messages which look like they are part of a loop
+        if check_loops:
+            loops = cls.find_loops(org, [c[:5] for c in candidates], created_on)
+            candidates = [c for c in candidates if (c[1].id, c[2].id if c[2] else None, c[3], c[4]) not in loops]
+
+        # reserve our credits for the whole chunk, it costs 1 credit to send a message
+        topup_ids = org.decrement_credits(len([c for c in candidates if not c[0].is_test]))
+
+        msgs = []
+        for contact, contact_urn, msg_channel, text, media, errors in candidates:
+            # track this if we have a channel
+            if msg_channel:
+                analytics.gauge('temba.msg_outgoing_%s' % msg_channel.channel_type.lower())
+
+            msg = Msg(contact=contact,
+                      contact_urn=contact_urn,
+                      org=org,
+                      channel=msg_channel,
+                      text=text.strip(),
+                      created_on=created_on,
+                      modified_on=created_on,
+                      direction=OUTGOING,
+                      status=status,
+                      broadcast=broadcast,
+                      response_to=response_to,
+                      msg_type=msg_type,
+                      priority=priority,
+                      media=media,
+                      has_template_error=len(errors) > 0)
+
+            if not contact.is_test:
+                topup_id = topup_ids.pop(0)
+                if topup_id is not None:
+                    msg.topup_id = topup_id
+
+            msgs.append(msg)
+
+        return msgs
+
+    @classmethod
+    def find_loops(cls, org, candidates, created_on):
+        """
+        Given a list of candidate outgoing messages as tuples of (contact, contact URN, channel, text, media), finds
+        those which look like they are part of a loop, i.e. the same message has been sent to the same URN over and
+        over again. Returns a set of (contact URN id, channel id, text, media) tuples for any found.
+        """
+        candidates = [c for c in candidates if not c[0].is_test and c[1].id]
+        if not candidates:
+            return set()
+
+        def keys_of(counts, include_media):
+            return {(c['contact_urn'], c['channel'], c['text'], c['media'] if include_media else None)
+                    for c in counts if c['count'] >= 10}
+
+        # we aren't considered with robo detection on calls
+        recent = Msg.current_messages.filter(org=org, contact_urn__in=[c[1].id for c in candidates],
+                                             contact__is_test=False, direction=OUTGOING,
+                                             created_on__gte=created_on - timedelta(minutes=10)).exclude(msg_type=IVR)
+        recent = recent.order_by().values('contact_urn', 'channel', 'text', 'media').annotate(count=Count('id'))
+        repeated = keys_of(recent, True)
+
+        # be more aggressive about short codes for duplicate messages, we don't want machines talking to each other
+        shortcode_urn_ids = []
+        for contact, contact_urn, channel, text, media in candidates:
+            tel = contact.raw_tel()
+            if tel and len(tel) < 6:
+                shortcode_urn_ids.append(contact_urn.id)
+
+        shortcode_repeated = set()
+        if shortcode_urn_ids:
+            recent = Msg.current_messages.filter(org=org, contact_urn__in=shortcode_urn_ids, contact__is_test=False,
+                                                 direction=OUTGOING, created_on__gte=created_on - timedelta(hours=24))
+            recent = recent.order_by().values('contact_urn', 'channel', 'text').annotate(count=Count('id'))
+            shortcode_repeated = keys_of(recent, False)
+
+        loops = set()
+        for contact, contact_urn, channel, text, media in candidates:
+            key = (contact_urn.id, channel.id if channel else None, text, media)
+
+            if key in repeated:
+                analytics.gauge('temba.msg_loop_caught')
+                loops.add(key)
+            elif contact_urn.id in shortcode_urn_ids and (key[0], key[1], key[2], None) in shortcode_repeated:
+                analytics.gauge('temba.msg_shortcode_loop_caught')
+                loops.add(key)
+
+        return loops
+
     @staticmethod
     def resolve_recipient(org, user, recipient, channel, role=SEND):
         """
@@ -1394,6 +1831,121 @@ class Msg(models.Model):
 
         Channel.track_status(self.channel, "Delivered")
 
+    @classmethod
+    def stage_status(cls, channel, status, msg_id=None, external_id=None):
+        """
+        Accepts a status update from a channel's delivery report for the message with the given id or external id.
+        When STAGE_MSG_STATUSES is set, the update is pushed onto a redis list to be applied in bulk by
+        apply_msg_statuses_task and we return True. Otherwise we return False and the caller updates the message.
+        """
+        if not getattr(settings, 'STAGE_MSG_STATUSES', False):
+            return False
+
+        update = dict(channel=channel.id, id=msg_id, external_id=external_id, status=status,
+                      date=datetime_to_json_date(timezone.now(), micros=True))
+
+        r = get_redis_connection()
+        r.rpush(MSG_STATUS_QUEUE, json.dumps(update))
+        return True
+
+    @classmethod
+    def apply_staged_statuses(cls, max_batches=None):
+        """
+        Applies the status updates staged by stage_status a batch at a time, returning how many were applied
+        """
+        r = get_redis_connection()
+        applied = 0
+        batches = 0
+
+        while max_batches is None or batches < max_batches:
+            updates = [json.loads(update) for update in r.lrange(MSG_STATUS_QUEUE, 0, MSG_STATUS_BATCH_SIZE - 1)]
+
+            if not updates:
+                break
+
+            # only trim the batch once it has been applied, so a failure leaves it to be retried. Handlers only ever
+            # append to the list so the batch is still at its head.
+            applied += cls.update_statuses(updates)
+            r.ltrim(MSG_STATUS_QUEUE, len(updates), -1)
+            batches += 1
+
+        return applied
+
+    @classmethod
+    def update_statuses(cls, updates):
+        """
+        Applies a batch of status updates, each a dict of channel, id or external_id, status and date, with one
+        UPDATE per status rather than one per message. Each message's sent_on is taken from its own report date.
+        Returns how many messages were updated.
+        """
+        # resolve any external ids to message ids
+        external_ids = [(u['channel'], u['external_id']) for u in updates if not u['id'] and u['external_id']]
+        external_ids = cls.resolve_external_ids(external_ids) if external_ids else dict()
+
+        # only the latest update for each message counts
+        latest = dict()
+        for update in updates:
+            if update['id']:
+                msg_ids = [update['id']]
+            else:
+                msg_ids = external_ids.get((update['channel'], update['external_id']), [])
+
+            for msg_id in msg_ids:
+                msg_id = int(msg_id)
+                if msg_id not in latest or update['date'] >= latest[msg_id]['date']:
+                    latest[msg_id] = update
+
+        by_status = defaultdict(list)
+        for msg_id, update in latest.items():
+            by_status[update['status']].append(msg_id)
+
+        now = timezone.now()
+        updated = 0
+
+        for status, msg_ids in by_status.items():
+            if status not in (SENT, DELIVERED, FAILED):
+                continue
+
+            # join against the channel and report date of each message, so messages only take reports from their own
+            # channel and each get their own sent_on
+            values = ', '.join(['(%s, %s, %s::timestamptz)'] * len(msg_ids))
+            params = [status, now]
+            for msg_id in msg_ids:
+                params += [msg_id, latest[msg_id]['channel'], json_date_to_datetime(latest[msg_id]['date'])]
+
+            if status == SENT:
+                # an out of order sent report shouldn't undo a delivery or failure
+                sql = 'UPDATE msgs_msg m SET status = %%s, modified_on = %%s, sent_on = v.sent_on ' \
+                      'FROM (VALUES %s) AS v(id, channel_id, sent_on) ' \
+                      'WHERE m.id = v.id AND m.channel_id = v.channel_id AND m.status IN (%%s, %%s, %%s, %%s)' % values
+                params += [PENDING, QUEUED, WIRED, ERRORED]
+            elif status == DELIVERED:
+                sql = 'UPDATE msgs_msg m SET status = %%s, modified_on = %%s, sent_on = COALESCE(m.sent_on, v.sent_on) ' \
+                      'FROM (VALUES %s) AS v(id, channel_id, sent_on) ' \
+                      'WHERE m.id = v.id AND m.channel_id = v.channel_id' % values
+            else:
+                sql = 'UPDATE msgs_msg m SET status = %%s, modified_on = %%s ' \
+                      'FROM (VALUES %s) AS v(id, channel_id, sent_on) ' \
+                      'WHERE m.id = v.id AND m.channel_id = v.channel_id' % values
+
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                updated += cursor.rowcount
+
+        # track our statuses and update our broadcasts once for the batch
+        status_names = {SENT: "Sent", DELIVERED: "Delivered", FAILED: "Failed"}
+        channels = {c.id: c for c in Channel.objects.filter(id__in=set([u['channel'] for u in latest.values()]))}
+        for update in latest.values():
+            if update['status'] in status_names:
+                Channel.track_status(channels.get(update['channel']), status_names[update['status']])
+
+        broadcast_ids = Msg.current_messages.filter(id__in=latest.keys()).exclude(broadcast=None)
+        broadcast_ids = broadcast_ids.order_by().values_list('broadcast', flat=True).distinct()
+        for broadcast in Broadcast.objects.filter(id__in=list(broadcast_ids)):
+            broadcast.update()
+
+        return updated
+
     def archive(self):
         """
         Archives this message
@@ -1868,38 +2420,88 @@ class ExportMessagesTask(SmartModel):
 
     def start_export(self):
         """
-        Starts our export, wrapping it in a try block to make sure we mark it as finished when complete.
+        Starts our export. If it is split into parts, these are written by their own tasks and the last one to
+        finish merges them, otherwise we export everything here, making sure we mark it as finished when complete.
         """
+        parts = self.get_part_ranges()
+        if len(parts) > 1:
+            from .tasks import export_sms_part_task
+
+            r = get_redis_connection()
+            r.set(EXPORT_PARTS_REMAINING_KEY % self.pk, len(parts), ex=EXPORT_PARTS_TTL)
+
+            for index, (start_date, end_date) in enumerate(parts):
+                export_sms_part_task.delay(self.pk, index, len(parts), start_date, end_date)
+            return
+
         try:
-            start = time.time()
             self.do_export()
         finally:
-            elapsed = time.time() - start
-            analytics.track(self.created_by.username, 'temba.msg_export_latency', properties=dict(value=elapsed))
+            self.finish_export()
 
-            self.is_finished = True
-            self.save(update_fields=['is_finished'])
+    def finish_export(self):
+        elapsed = (timezone.now() - self.created_on).total_seconds()
+        analytics.track(self.created_by.username, 'temba.msg_export_latency', properties=dict(value=elapsed))
 
-    def do_export(self):
-        from xlwt import Workbook, XFStyle
-        book = Workbook()
+        self.is_finished = True
+        self.save(update_fields=['is_finished'])
 
-        date_style = XFStyle()
-        date_style.num_format_str = 'DD-MM-YYYY HH:MM:SS'
+    def get_part_ranges(self):
+        """
+        Gets the (start_date, end_date) ranges of the parts this export should be split into, newest first. Exports
+        are split into MSG_EXPORT_PARTS parts of roughly equal numbers of days.
+        """
+        num_parts = getattr(settings, 'MSG_EXPORT_PARTS', 1)
+        if num_parts <= 1:
+            return [(self.start_date, self.end_date)]
 
-        fields = ['Date', 'Contact', 'Contact Type', 'Name', 'Contact UUID', 'Direction', 'Text', 'Labels']
+        tz = self.org.get_tzinfo()
+        start_date = self.start_date
+        end_date = self.end_date or timezone.now().astimezone(tz).date()
+
+        # without a start date we begin at the oldest message, which if there are archives will be in one of them
+        if not start_date:
+            oldest_archive = self.org.msg_archives.order_by('start_date').values_list('start_date', flat=True).first()
+            oldest_msg = Msg.get_messages(self.org).order_by('created_on').values_list('created_on', flat=True).first()
+
+            if oldest_archive:
+                start_date = oldest_archive
+            elif oldest_msg:
+                start_date = oldest_msg.astimezone(tz).date()
+            else:
+                return [(self.start_date, self.end_date)]
 
+        num_days = (end_date - start_date).days + 1
+        num_parts = max(1, min(num_parts, num_days))
+
+        parts = []
+        for index in range(num_parts):
+            part_start = start_date + timedelta(days=num_days * index / num_parts)
+            part_end = start_date + timedelta(days=num_days * (index + 1) / num_parts - 1)
+            parts.append([part_start, part_end])
+
+        # the oldest and newest parts stay open ended if the export is, so they pick up anything we didn't see
+        parts[0][0] = self.start_date
+        parts[-1][1] = self.end_date
+
+        return [tuple(part) for part in reversed(parts)]
+
+    def get_rows(self, start_date, end_date):
+        """
+        Gets the rows for the messages matching this export between the given dates, newest first
+        """
         all_messages = Msg.get_messages(self.org).order_by('-created_on')
 
         tz = self.org.get_tzinfo()
+        start_on = end_on = None
 
-        if self.start_date:
-            start_date = tz.localize(datetime.combine(self.start_date, datetime.min.time()))
-            all_messages = all_messages.filter(created_on__gte=start_date)
+        if start_date:
+            start_on = tz.localize(datetime.combine(start_date, datetime.min.time()))
+            all_messages = all_messages.filter(created_on__gte=start_on)
 
-        if self.end_date:
-            end_date = tz.localize(datetime.combine(self.end_date, datetime.max.time()))
-            all_messages = all_messages.filter(created_on__lte=end_date)
+        if end_date:
+            end_on = tz.localize(datetime.combine(end_date, datetime.max.time()))
+            all_messages = all_messages.filter(created_on__lte=end_on)
 
         if self.groups.all():
             all_messages = all_messages.filter(contact__all_groups__in=self.groups.all())
@@ -1909,6 +2511,113 @@ class ExportMessagesTask(SmartModel):
 
         all_message_ids = [m['id'] for m in all_messages.values('id')]
 
+        processed = 0
+        start = time.time()
+
+        prefetch = Prefetch('labels', queryset=Label.label_objects.order_by('name'))
+        live_messages = MsgIterator(all_message_ids,
+                                    order_by=[''
+                                              '-created_on'],
+                                    select_related=['contact', 'contact_urn'],
+                                    prefetch_related=[prefetch])
+
+        # older messages may have been moved into archives which come after any messages still in the database
+        archived_messages = self.get_archived_messages(start_on, end_on)
+
+        for msg in chain(live_messages, archived_messages):
+            record = getattr(msg, 'archive_record', None)
+            if record:
+                contact_name = record['contact']['name'] or ''
+                contact_uuid = record['contact']['uuid']
+                msg_labels = ", ".join(sorted(label['name'] for label in record['labels']))
+                contact_urn = None
+                if record['urn']:
+                    urn_scheme, urn_path = URN.to_parts(record['urn'])
+                    contact_urn = ContactURN(urn=record['urn'], scheme=urn_scheme, path=urn_path)
+                anon_identifier = "%010d" % record['contact']['id']
+            else:
+                contact_name = msg.contact.name if msg.contact.name else ''
+                contact_uuid = msg.contact.uuid
+                msg_labels = ", ".join(msg_label.name for msg_label in msg.labels.all())
+                contact_urn = msg.contact_urn
+                anon_identifier = msg.contact.anon_identifier
+
+            # only show URN path if org isn't anon and there is a URN
+            if self.org.is_anon:
+                urn_path = anon_identifier
+            elif contact_urn:
+                urn_path = contact_urn.get_display(org=self.org, full=True)
+            else:
+                urn_path = ''
+
+            urn_scheme = contact_urn.scheme if contact_urn else ''
+
+            yield [msg.created_on, urn_path, urn_scheme, contact_name, contact_uuid, msg.get_direction_display(),
+                   msg.text, msg_labels]
+
+            processed += 1
+            if processed % 10000 == 0:
+                print "Export of %d msgs for %s - %d%% complete in %0.2fs" % \
+                      (len(all_message_ids), self.org.name, processed * 100 / max(len(all_message_ids), processed),
+                       time.time() - start)
+
+    def write_part(self, index, num_parts, start_date, end_date):
+        """
+        Writes the rows of one part of this export to storage, and if it's the last part to finish, merges them all
+        """
+        r = get_redis_connection()
+        try:
+            temp = NamedTemporaryFile(delete=True)
+            for row in self.get_rows(start_date, end_date):
+                row[0] = datetime_to_json_date(row[0], micros=True)
+                temp.write(json.dumps(row) + '\n')
+            temp.flush()
+
+            path = default_storage.save('msg_export_parts/%d/%d.jsonl' % (self.pk, index), File(temp))
+            r.hset(EXPORT_PARTS_KEY % self.pk, index, path)
+            r.expire(EXPORT_PARTS_KEY % self.pk, EXPORT_PARTS_TTL)
+        finally:
+            if r.decr(EXPORT_PARTS_REMAINING_KEY % self.pk) == 0:
+                self.merge_parts(num_parts)
+
+    def merge_parts(self, num_parts):
+        """
+        Merges the parts of this export into a single export file, in order. If any part failed to be written, the
+        export is finished without a file as it would be missing messages.
+        """
+        r = get_redis_connection()
+        paths = r.hgetall(EXPORT_PARTS_KEY % self.pk)
+
+        def iter_part_rows():
+            for index in range(num_parts):
+                with default_storage.open(paths[str(index)]) as part:
+                    for line in part:
+                        row = json.loads(line)
+                        row[0] = json_date_to_datetime(row[0])
+                        yield row
+
+        try:
+            if len(paths) == num_parts:
+                self.write_export(iter_part_rows())
+        finally:
+            for path in paths.values():
+                default_storage.delete(path)
+
+            r.delete(EXPORT_PARTS_KEY % self.pk, EXPORT_PARTS_REMAINING_KEY % self.pk)
+            self.finish_export()
+
+    def do_export(self):
+        self.write_export(self.get_rows(self.start_date, self.end_date))
+
+    def write_export(self, rows):
+        from xlwt import Workbook, XFStyle
+        book = Workbook()
+
+        date_style = XFStyle()
+        date_style.num_format_str = 'DD-MM-YYYY HH:MM:SS'
+
+        fields = ['Date', 'Contact', 'Contact Type', 'Name', 'Contact UUID', 'Direction', 'Text', 'Labels']
+
         messages_sheet_number = 1
 
         current_messages_sheet = book.add_sheet(unicode(_("Messages %d" % messages_sheet_number)))
@@ -1918,14 +2627,8 @@ class ExportMessagesTask(SmartModel):
 
         row = 1
         processed = 0
-        start = time.time()
 
-        prefetch = Prefetch('labels', queryset=Label.label_objects.order_by('name'))
-        for msg in MsgIterator(all_message_ids,
-                               order_by=[''
-                                         '-created_on'],
-                               select_related=['contact', 'contact_urn'],
-                               prefetch_related=[prefetch]):
+        for values in rows:
 
             if row >= 65535:
                 messages_sheet_number += 1
@@ -1935,36 +2638,16 @@ class ExportMessagesTask(SmartModel):
                     current_messages_sheet.write(0, col, unicode(field))
                 row = 1
 
-            contact_name = msg.contact.name if msg.contact.name else ''
-            contact_uuid = msg.contact.uuid
-            created_on = msg.created_on.astimezone(pytz.utc).replace(tzinfo=None)
-            msg_labels = ", ".join(msg_label.name for msg_label in msg.labels.all())
-
-            # only show URN path if org isn't anon and there is a URN
-            if self.org.is_anon:
-                urn_path = msg.contact.anon_identifier
-            elif msg.contact_urn:
-                urn_path = msg.contact_urn.get_display(org=self.org, full=True)
-            else:
-                urn_path = ''
-
-            urn_scheme = msg.contact_urn.scheme if msg.contact_urn else ''
+            created_on = values[0].astimezone(pytz.utc).replace(tzinfo=None)
 
             current_messages_sheet.write(row, 0, created_on, date_style)
-            current_messages_sheet.write(row, 1, urn_path)
-            current_messages_sheet.write(row, 2, urn_scheme)
-            current_messages_sheet.write(row, 3, contact_name)
-            current_messages_sheet.write(row, 4, contact_uuid)
-            current_messages_sheet.write(row, 5, msg.get_direction_display())
-            current_messages_sheet.write(row, 6, msg.text)
-            current_messages_sheet.write(row, 7, msg_labels)
+            for col in range(1, len(fields)):
+                current_messages_sheet.write(row, col, values[col])
             row += 1
             processed += 1
 
             if processed % 10000 == 0:
                 current_messages_sheet.flush_row_data()
-                print "Export of %d msgs for %s - %d%% complete in %0.2fs" % \
-                      (len(all_message_ids), self.org.name, processed * 100 / len(all_message_ids), time.time() - start)
 
         temp = NamedTemporaryFile(delete=True)
         book.save(temp)
@@ -1992,3 +2675,253 @@ class ExportMessagesTask(SmartModel):
         gc.collect()
 
         send_template_email(self.created_by.username, subject, template, dict(link=download_url), branding)
+
+    def get_archived_messages(self, start_date, end_date):
+        """
+        Gets the archived messages matching this export, newest first
+        """
+        groups = list(self.groups.all())
+        group_contact_ids = set(Contact.objects.filter(all_groups__in=groups).values_list('id', flat=True))
+
+        for msg in MsgArchive.get_messages(self.org, after=start_date, before=end_date):
+            record = msg.archive_record
+
+            if record['contact']['is_test'] or msg.visibility != Msg.VISIBILITY_VISIBLE:
+                continue
+            if groups and record['contact']['id'] not in group_contact_ids:
+                continue
+            if self.label and self.label.uuid not in [label['uuid'] for label in record['labels']]:
+                continue
+
+            yield msg
+
+
+class MsgArchive(models.Model):
+    """
+    A month of an org's messages which have been moved out of the messages table into a gzipped file of JSON lines,
+    one per message. Archives are read-only and are read back by exports and contact history.
+
+    Each chunk of messages is compressed separately, so that with the offsets of the chunks that contain a contact's
+    messages, those can be read back without decompressing the rest of the archive.
+    """
+    CHUNK_SIZE = 1000
+
+    org = models.ForeignKey(Org, related_name='msg_archives', help_text=_("The org whose messages are archived"))
+
+    start_date = models.DateField(help_text=_("The first day of the month of messages in this archive"))
+
+    record_count = models.IntegerField(help_text=_("The number of messages in this archive"))
+
+    size = models.IntegerField(help_text=_("The size of the archive file in bytes"))
+
+    path = models.CharField(max_length=255, help_text=_("The storage path of the archive file"))
+
+    chunks = models.TextField(null=True, help_text=_("The offsets and lengths of the chunks of the archive, as JSON"))
+
+    created_on = models.DateTimeField(default=timezone.now, help_text=_("When this archive was created"))
+
+    class Meta:
+        unique_together = ('org', 'start_date')
+
+    @classmethod
+    def get_month_range(cls, date):
+        """
+        Gets the UTC start and end of the month of the given date
+        """
+        start = datetime(date.year, date.month, 1, tzinfo=pytz.utc)
+        end = datetime(start.year + start.month // 12, start.month % 12 + 1, 1, tzinfo=pytz.utc)
+        return start, end
+
+    @classmethod
+    def archive_old_months(cls, org, before):
+        """
+        Archives every month of the given org's messages which ends before the given date
+        """
+        archives = []
+        after = None
+
+        while True:
+            msgs = Msg.all_messages.filter(org=org)
+            if after:
+                msgs = msgs.filter(created_on__gte=after)
+
+            oldest = msgs.order_by('created_on').values_list('created_on', flat=True).first()
+            if not oldest:
+                break
+
+            start, end = cls.get_month_range(oldest)
+            if end > before:
+                break
+
+            if not cls.objects.filter(org=org, start_date=start.date()).exists():
+                archives.append(cls.archive_month(org, start.date()))
+
+            after = end
+
+        return archives
+
+    @classmethod
+    def archive_month(cls, org, date):
+        """
+        Moves the given org's messages for the month of the given date into a new archive. Messages which are still
+        referenced by flow steps or channel logs are left in the database so flow results and logs keep them.
+        """
+        from temba.channels.models import ChannelLog
+        from temba.flows.models import FlowStep
+
+        start, end = cls.get_month_range(date)
+        msgs = Msg.all_messages.filter(org=org, created_on__gte=start, created_on__lt=end)
+        msgs = msgs.exclude(id__in=FlowStep.messages.through.objects.values('msg_id'))
+        msgs = msgs.exclude(id__in=ChannelLog.objects.values('msg_id'))
+        msg_ids = list(msgs.order_by('created_on', 'id').values_list('id', flat=True))
+
+        temp = NamedTemporaryFile(delete=True)
+        chunks = []
+        contact_chunks = defaultdict(list)
+
+        prefetch = Prefetch('labels', queryset=Label.label_objects.order_by('name'))
+        for chunk_ids in chunk_list(msg_ids, cls.CHUNK_SIZE):
+            offset = temp.tell()
+            chunk_file = gzip.GzipFile(fileobj=temp, mode='wb')
+            contact_ids = set()
+
+            for msg in MsgIterator(list(chunk_ids), order_by=['created_on', 'id'],
+                                   select_related=['contact', 'contact_urn'], prefetch_related=[prefetch]):
+                chunk_file.write(json.dumps(msg.as_archive_json()) + '\n')
+                contact_ids.add(msg.contact_id)
+
+            chunk_file.close()
+
+            chunks.append((offset, temp.tell() - offset))
+            for contact_id in contact_ids:
+                contact_chunks[contact_id].append(chunks[-1])
+
+        temp.flush()
+
+        path = default_storage.save('msg_archives/%d/%s.jsonl.gz' % (org.id, start.strftime('%Y_%m')), File(temp))
+
+        # only record the archive once its messages are gone, so a failure leaves the month to be archived again
+        with transaction.atomic():
+            archive = cls.objects.create(org=org, start_date=start.date(), record_count=len(msg_ids),
+                                         size=os.path.getsize(temp.name), path=path, chunks=json.dumps(chunks))
+            MsgArchiveContact.objects.bulk_create([MsgArchiveContact(archive=archive, contact_id=contact_id,
+                                                                     chunks=json.dumps(contact_chunk))
+                                                   for contact_id, contact_chunk in contact_chunks.iteritems()])
+            Msg.delete_archived(msg_ids)
+
+        return archive
+
+    @classmethod
+    def get_messages(cls, org, contact=None, after=None, before=None):
+        """
+        Reads back archived messages as unsaved messages, newest first, optionally only those for the given contact
+        or created within the given range
+        """
+        archives = cls.objects.filter(org=org).order_by('-start_date')
+        if contact:
+            archives = archives.filter(contacts__contact=contact)
+        if after:
+            archives = archives.filter(start_date__gte=cls.get_month_range(after)[0].date())
+        if before:
+            archives = archives.filter(start_date__lte=before.date())
+
+        for archive in archives:
+            # records are stored oldest first, so read the chunks from last to first and each one backwards, which
+            # only ever holds a single chunk of messages in memory
+            for records in archive.iter_chunks(reversed(archive.get_chunks(contact))):
+                for record in reversed(records):
+                    if contact and record['contact']['id'] != contact.id:
+                        continue
+
+                    msg = Msg.from_archive_json(record)
+                    if (after and msg.created_on < after) or (before and msg.created_on > before):
+                        continue
+
+                    yield msg
+
+    @classmethod
+    def merge_messages(cls, messages, archived, page_size=100):
+        """
+        Merges the given queryset of messages with the given archived messages, both newest first, into a single newest
+        first iterator. Messages which flows or logs still refer to are kept in the database so can be older than
+        archived ones, which means neither can simply follow the other. The queryset is read a page at a time.
+        """
+        def iter_messages():
+            offset = 0
+            while True:
+                page = list(messages[offset:offset + page_size])
+                for msg in page:
+                    yield msg
+
+                if len(page) < page_size:
+                    return
+                offset += page_size
+
+        messages, archived = iter_messages(), iter(archived)
+        msg, archived_msg = next(messages, None), next(archived, None)
+
+        while msg is not None or archived_msg is not None:
+            if archived_msg is None or (msg is not None and msg.created_on >= archived_msg.created_on):
+                yield msg
+                msg = next(messages, None)
+            else:
+                yield archived_msg
+                archived_msg = next(archived, None)
+
+    def get_chunks(self, contact=None):
+        """
+        Gets the (offset, length) of each chunk of this archive, oldest first, or only those with messages for the
+        given contact. Archives which didn't record their chunks are read as a single chunk.
+        """
+        if contact:
+            archive_contact = self.contacts.filter(contact=contact).first()
+            return json.loads(archive_contact.chunks) if archive_contact else []
+
+        return json.loads(self.chunks) if self.chunks else [(0, self.size)]
+
+    def iter_chunks(self, chunks):
+        """
+        Iterates over the given chunks of this archive, yielding the records of each, oldest first
+        """
+        stored_file = default_storage.open(self.path)
+        try:
+            for offset, length in chunks:
+                stored_file.seek(offset)
+                chunk = BytesIO(stored_file.read(length))
+
+                yield [json.loads(line) for line in gzip.GzipFile(fileobj=chunk, mode='rb')]
+        finally:
+            stored_file.close()
+
+    def iter_records(self):
+        """
+        Iterates over the records in this archive, oldest first
+        """
+        for records in self.iter_chunks(self.get_chunks()):
+            for record in records:
+                yield record
+
+    def iter_contact_records(self, contact):
+        """
+        Iterates over the records in the chunks of this archive which contain messages for the given contact, oldest
+        first. Other contacts' records in those chunks are included too.
+        """
+        for records in self.iter_chunks(self.get_chunks(contact)):
+            for record in records:
+                yield record
+
+
+class MsgArchiveContact(models.Model):
+    """
+    Where a contact's messages are in a message archive, so reading them back doesn't mean reading the whole archive
+    """
+    archive = models.ForeignKey(MsgArchive, related_name='contacts', help_text=_("The archive"))
+
+    contact = models.ForeignKey(Contact, related_name='msg_archives',
+                                help_text=_("The contact with messages in the archive"))
+
+    chunks = models.TextField(help_text=_("The offsets and lengths of the archive chunks with this contact's "
+                                          "messages, as JSON"))
+
+    class Meta:
+        unique_together = ('archive', 'contact')
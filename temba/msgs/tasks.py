@@ -4,15 +4,18 @@ import logging
 import time
 
 from datetime import timedelta
+from django.conf import settings
 from django.utils import timezone
 from django.core.cache import cache
 from djcelery_transactions import task
 from redis_cache import get_redis_connection
 from temba.contacts.models import Contact
+from temba.utils.cache import redis_batch
 from temba.utils.mage import mage_handle_new_message, mage_handle_new_contact
-from temba.utils.queues import pop_task
-from .models import Msg, Broadcast, ExportMessagesTask, PENDING, HANDLE_EVENT_TASK, MSG_EVENT
-from .models import FIRE_EVENT, SystemLabel
+from temba.utils.queues import pop_tasks
+from .models import Msg, MsgArchive, Broadcast, ExportMessagesTask, PENDING, HANDLE_EVENT_TASK, MSG_EVENT
+from .models import FIRE_EVENT, HANDLE_EVENT_BATCH_SIZE, HANDLE_EVENT_BATCH_ORGS, SystemLabel
+from .models import CREATE_INCOMING_TASK, CREATE_INCOMING_BATCH_SIZE, CREATE_INCOMING_BATCH_ORGS
 
 logger = logging.getLogger(__name__)
 
@@ -36,13 +39,16 @@ def process_message_task(msg_id, from_mage=False, new_contact=False):
             print "M[%09d] Processing - %s" % (msg.id, msg.text)
             start = time.time()
 
-            # if message was created in Mage...
-            if from_mage:
-                mage_handle_new_message(msg.org, msg)
-                if new_contact:
-                    mage_handle_new_contact(msg.org, msg.contact)
+            # counters, caches and queued tasks from handling this message are all sent to redis at once
+            with redis_batch(r):
+                # if message was created in Mage...
+                if from_mage:
+                    mage_handle_new_message(msg.org, msg)
+                    if new_contact:
+                        mage_handle_new_contact(msg.org, msg.contact)
+
+                Msg.process_message(msg)
 
-            Msg.process_message(msg)
             print "M[%09d] %08.3f s - %s" % (msg.id, time.time() - start, msg.text)
 
 
@@ -195,6 +201,16 @@ def export_sms_task(id):
         export_task.start_export()
 
 
+@task(track_started=True, name='export_sms_part_task')
+def export_sms_part_task(id, index, num_parts, start_date, end_date):
+    """
+    Writes one date range part of a message export, merging all the parts if it is the last to finish
+    """
+    export_task = ExportMessagesTask.objects.filter(pk=id).first()
+    if export_task:
+        export_task.write_part(index, num_parts, start_date, end_date)
+
+
 @task(track_started=True, name="handle_event_task", time_limit=180, soft_time_limit=120)
 def handle_event_task():
     """
@@ -204,37 +220,79 @@ def handle_event_task():
     Currently two types of events may be "popped" from our queue:
            msg - Which contains the id of the Msg to be processed
           fire - Which contains the id of the EventFire that needs to be fired
+
+    Events are popped off in small batches, so a single wakeup can work through several events across orgs.
     """
-    from temba.campaigns.models import EventFire
-    r = get_redis_connection()
+    # pop off the next batch of events, it is possible this is empty, in which case there is nothing to do
+    event_tasks = pop_tasks(HANDLE_EVENT_TASK, max_items=HANDLE_EVENT_BATCH_SIZE, max_orgs=HANDLE_EVENT_BATCH_ORGS)
 
-    # pop off the next task
-    event_task = pop_task(HANDLE_EVENT_TASK)
+    # handle each event in turn, one event failing shouldn't mean losing the rest of our batch
+    error = None
+    for event_task in event_tasks:
+        try:
+            handle_event(event_task)
+        except Exception as e:
+            logger.error("Error handling event: %s" % event_task, exc_info=True)
+            error = error or e
 
-    # it is possible we have no message to send, if so, just return
-    if not event_task:
-        return
+    # but we still want our task to fail if any events did
+    if error:
+        raise error
+
+
+def handle_event(event_task):
+    """
+    Handles a single event popped off of our handler queue
+    """
+    from temba.campaigns.models import EventFire
 
     if event_task['type'] == MSG_EVENT:
         process_message_task(event_task['id'], event_task.get('from_mage', False), event_task.get('new_contact', False))
 
     elif event_task['type'] == FIRE_EVENT:
-        # use a lock to make sure we don't do two at once somehow
-        key = 'fire_campaign_%s' % event_task['id']
-        if not r.get(key):
-            with r.lock(key, timeout=120):
-                event = EventFire.objects.filter(pk=event_task['id'], fired=None)\
-                                         .select_related('event', 'event__campaign', 'event__campaign__org').first()
-                if event:
-                    print "E[%09d] Firing for org: %s" % (event.id, event.event.campaign.org.name)
-                    start = time.time()
-                    event.fire()
-                    print "E[%09d] %08.3f s" % (event.id, time.time() - start)
+        # fires are queued in batches for the same event, but may also be a single fire
+        fire_ids = event_task.get('fires', [event_task.get('id')])
+
+        # fires are claimed atomically by batch_fire, so overlapping batches can't fire the same contact twice
+        fires = list(EventFire.objects.filter(pk__in=fire_ids, fired=None)
+                                      .select_related('contact', 'event', 'event__flow', 'event__campaign',
+                                                      'event__campaign__org'))
+        if fires:
+            event = fires[0].event
+            start = time.time()
+            fired = EventFire.batch_fire(fires)
+            print "E[%09d] Fired %d of %d for org: %s in %08.3f s" % (event.id, len(fired), len(fires),
+                                                                      event.campaign.org.name, time.time() - start)
 
     else:
         raise Exception("Unexpected event type: %s" % event_task)
 
 
+@task(track_started=True, name="create_incoming_task", time_limit=180, soft_time_limit=120)
+def create_incoming_task():
+    """
+    Priority queue task that creates the incoming messages staged by channel handlers, a batch at a time
+    """
+    staged_msgs = pop_tasks(CREATE_INCOMING_TASK, max_items=CREATE_INCOMING_BATCH_SIZE,
+                            max_orgs=CREATE_INCOMING_BATCH_ORGS)
+    if staged_msgs:
+        with redis_batch():
+            Msg.create_incoming_batch(staged_msgs)
+
+
+@task(track_started=True, name='apply_msg_statuses_task', time_limit=60, soft_time_limit=60)
+def apply_msg_statuses_task():
+    """
+    Applies the message status updates staged by channel handlers in bulk
+    """
+    r = get_redis_connection()
+
+    key = 'apply_msg_statuses_task'
+    if not r.get(key):
+        with r.lock(key, timeout=60):
+            Msg.apply_staged_statuses(max_batches=20)
+
+
 @task(track_started=True, name='purge_broadcasts_task', time_limit=900, soft_time_limit=900)
 def purge_broadcasts_task():
     """
@@ -258,6 +316,33 @@ def purge_broadcasts_task():
                 broadcast.save(update_fields=['purged'])
 
 
+@task(track_started=True, name='archive_msgs_task', time_limit=7200, soft_time_limit=7200)
+def archive_msgs_task():
+    """
+    Moves each org's messages from months older than ARCHIVE_MSGS_AFTER_MONTHS into archives
+    """
+    from temba.orgs.models import Org
+
+    months = getattr(settings, 'ARCHIVE_MSGS_AFTER_MONTHS', None)
+    if not months:
+        return
+
+    r = get_redis_connection()
+
+    # archive every month which ended before the start of the month N months ago
+    now = timezone.now()
+    month = now.year * 12 + now.month - 1 - months
+    before = MsgArchive.get_month_range(now.replace(year=month // 12, month=month % 12 + 1, day=1))[0]
+
+    key = 'archive_msgs_task'
+    if not r.get(key):
+        with r.lock(key, timeout=7200):
+            for org in Org.objects.filter(is_active=True).order_by('id'):
+                archives = MsgArchive.archive_old_months(org, before)
+                if archives:
+                    logger.info("Archived %d months of messages for org #%d" % (len(archives), org.id))
+
+
 @task(track_started=True, name="squash_systemlabels")
 def squash_systemlabels():
     r = get_redis_connection()
@@ -4,21 +4,24 @@ from __future__ import unicode_literals
 import json
 import pytz
 
-from datetime import timedelta
+from datetime import date, datetime, timedelta
 from django.conf import settings
+from django.core.files.storage import default_storage
+from django.test.utils import override_settings
 from django.core.urlresolvers import reverse
 from django.utils import timezone
 from mock import patch
 from temba.channels.models import Channel, ChannelEvent
 from temba.contacts.models import ContactField, ContactURN, TEL_SCHEME
 from temba.msgs.models import Msg, Contact, ContactGroup, ExportMessagesTask, RESENT, FAILED, OUTGOING, PENDING, WIRED
-from temba.msgs.models import Broadcast, Label, SystemLabel, UnreachableException, SMS_BULK_PRIORITY
-from temba.msgs.models import HANDLED, QUEUED, SENT, INCOMING, INBOX, FLOW
+from temba.msgs.models import Broadcast, Label, MsgArchive, SystemLabel, UnreachableException, SMS_BULK_PRIORITY
+from temba.msgs.models import HANDLED, QUEUED, SENT, DELIVERED, INCOMING, INBOX, FLOW
+from temba.msgs.models import HANDLER_QUEUE, CREATE_INCOMING_TASK
 from temba.msgs.tasks import purge_broadcasts_task
-from temba.orgs.models import Language
+from temba.orgs.models import Language, Org
 from temba.schedules.models import Schedule
 from temba.tests import TembaTest, AnonymousOrg
-from temba.utils import dict_to_struct, datetime_to_str
+from temba.utils import dict_to_struct, datetime_to_str, datetime_to_json_date
 from temba.utils.expressions import get_function_listing
 from temba.values.models import Value
 from redis_cache import get_redis_connection
@@ -253,6 +256,250 @@ class MsgTest(TembaTest):
         must_return_none = Msg.create_outgoing(self.org, self.admin, "tel:" + self.channel.address, 'Infinite Loop')
         self.assertIsNone(must_return_none)
 
+    def test_stage_incoming(self):
+        # by default messages are created right away
+        msg = Msg.stage_incoming(self.channel, "tel:+250788382382", "Hello", external_id='ext1')
+        self.assertEqual("Hello", msg.text)
+        self.assertEqual('ext1', Msg.all_messages.get(pk=msg.pk).external_id)
+
+        # when staging they are created by our task
+        with override_settings(STAGE_INCOMING_MSGS=True):
+            self.assertIsNone(Msg.stage_incoming(self.channel, "tel:+250788382383", "Bonjour", external_id='ext2'))
+
+        msg = Msg.all_messages.get(text="Bonjour")
+        self.assertEqual(INCOMING, msg.direction)
+        self.assertEqual('ext2', msg.external_id)
+        self.assertEqual("tel:+250788382383", msg.contact_urn.urn)
+        self.assertEqual(self.channel, msg.channel)
+        self.assertEqual(HANDLED, msg.status)
+
+    def test_create_incoming_batch(self):
+        date = timezone.now()
+        staged = dict(channel=self.channel.id, urn="tel:+250788382382", text="Hi", media=None,
+                      date=datetime_to_json_date(date, micros=True))
+        other = dict(channel=self.channel.id, urn="tel:+250788382383", text="Hey", media=None,
+                     date=datetime_to_json_date(date, micros=True))
+
+        # duplicates in our batch are ignored
+        msgs = Msg.create_incoming_batch([staged, other, dict(staged)])
+        self.assertEqual(2, len(msgs))
+        self.assertEqual(date, msgs[0].created_on)
+        self.assertEqual("+250788382382", msgs[0].contact.get_urn(TEL_SCHEME).path)
+        self.assertEqual(1, ContactURN.objects.filter(org=self.org, urn="tel:+250788382383").count())
+
+        # as are retries of messages we've already created, or for channels that have been removed
+        inactive = Channel.create(self.org, self.user, 'RW', 'A', name="Old", address="+250785551414")
+        inactive.is_active = False
+        inactive.save()
+
+        self.assertEqual([], Msg.create_incoming_batch([staged, dict(other, channel=inactive.id)]))
+        self.assertEqual(2, Msg.all_messages.filter(direction=INCOMING).count())
+
+        # messages from existing contacts don't go through get_or_create and are created together
+        later = datetime_to_json_date(date + timedelta(seconds=1), micros=True)
+        with patch.object(Contact, 'get_or_create') as mock_get_or_create:
+            with patch.object(Msg, 'handle'):
+                msgs = Msg.create_incoming_batch([dict(staged, date=later), dict(other, date=later)])
+
+            self.assertFalse(mock_get_or_create.called)
+
+        self.assertEqual(["Hi", "Hey"], [m.text for m in msgs])
+        self.assertEqual([m.pk for m in msgs], [Msg.all_messages.get(text=m.text, created_on=m.created_on).pk
+                                                 for m in msgs])
+        self.assertEqual(msgs[0].contact_urn, ContactURN.objects.get(org=self.org, urn="tel:+250788382382"))
+
+    def test_create_incoming_batch_failures(self):
+        date = datetime_to_json_date(timezone.now(), micros=True)
+        good = dict(channel=self.channel.id, urn="tel:+250788382382", text="Hi", media=None, date=date)
+        bad_urn = dict(channel=self.channel.id, urn="tel:+250788382383", text="Hey", media=None, date=date)
+        bad_handle = dict(channel=self.channel.id, urn="tel:+250788382384", text="Yo", media=None, date=date)
+
+        get_or_create = Contact.get_or_create
+        handle = Msg.handle
+
+        def failing_get_or_create(org, user, urns=None, **kwargs):
+            if urns == [bad_urn['urn']]:
+                raise ValueError("Invalid URN")
+            return get_or_create(org, user, urns=urns, **kwargs)
+
+        def failing_handle(msg):
+            if msg.text == "Yo":
+                raise ValueError("Handling failed")
+            return handle(msg)
+
+        with patch('temba.msgs.models.push_task') as mock_push_task:
+            with patch.object(Contact, 'get_or_create', side_effect=failing_get_or_create):
+                with patch.object(Msg, 'handle', autospec=True, side_effect=failing_handle):
+                    msgs = Msg.create_incoming_batch([good, bad_urn, bad_handle])
+
+            # the other messages are still created, the one we couldn't handle is left pending to be handled later
+            self.assertEqual(["Hi", "Yo"], [m.text for m in msgs])
+            self.assertEqual(HANDLED, Msg.all_messages.get(text="Hi").status)
+            self.assertEqual(PENDING, Msg.all_messages.get(text="Yo").status)
+
+            # and the one we couldn't create is queued to be tried again
+            mock_push_task.assert_called_once_with(self.org, HANDLER_QUEUE, CREATE_INCOMING_TASK,
+                                                   dict(bad_urn, attempts=1))
+            mock_push_task.reset_mock()
+
+            # if creating messages in bulk fails, they're created one by one, and those which still fail give back
+            # the credit they took
+            credits_used = self.org.get_credits_used()
+            save = Msg.save
+
+            def failing_save(msg, *args, **kwargs):
+                if msg.text == "Again":
+                    raise ValueError("DB error")
+                return save(msg, *args, **kwargs)
+
+            with patch.object(Msg.all_messages, 'bulk_create', side_effect=ValueError("DB error")):
+                with patch.object(Msg, 'save', autospec=True, side_effect=failing_save):
+                    msgs = Msg.create_incoming_batch([dict(good, text="Again"), dict(good, text="Fine")])
+
+            self.assertEqual(["Fine"], [m.text for m in msgs])
+            self.assertEqual(credits_used + 1, self.org.get_credits_used())
+            mock_push_task.assert_called_once_with(self.org, HANDLER_QUEUE, CREATE_INCOMING_TASK,
+                                                   dict(good, text="Again", attempts=1))
+            mock_push_task.reset_mock()
+
+            # until we've tried enough times
+            with patch.object(Contact, 'get_or_create', side_effect=failing_get_or_create):
+                self.assertEqual([], Msg.create_incoming_batch([dict(bad_urn, attempts=2)]))
+
+            self.assertFalse(mock_push_task.called)
+
+    def test_stage_status(self):
+        joe = self.create_contact("Joe", "+250788382382")
+        msg1 = Msg.create_outgoing(self.org, self.admin, joe, "Hi 1")
+        msg2 = Msg.create_outgoing(self.org, self.admin, joe, "Hi 2")
+        msg3 = Msg.create_outgoing(self.org, self.admin, joe, "Hi 3")
+        Msg.all_messages.filter(pk=msg1.pk).update(status=WIRED)
+        Msg.all_messages.filter(pk=msg2.pk).update(status=WIRED, external_id='ext2')
+        Msg.all_messages.filter(pk=msg3.pk).update(status=DELIVERED, sent_on=timezone.now())
+
+        # by default statuses aren't staged
+        self.assertFalse(Msg.stage_status(self.channel, SENT, msg_id=msg1.pk))
+
+        with override_settings(STAGE_MSG_STATUSES=True):
+            self.assertTrue(Msg.stage_status(self.channel, SENT, msg_id=msg1.pk))
+            self.assertTrue(Msg.stage_status(self.channel, DELIVERED, msg_id=msg1.pk))
+            self.assertTrue(Msg.stage_status(self.channel, FAILED, external_id='ext2'))
+            self.assertTrue(Msg.stage_status(self.channel, SENT, msg_id=msg3.pk))
+            self.assertTrue(Msg.stage_status(self.channel, DELIVERED, external_id='unknown'))
+
+        # nothing changes until they're applied
+        self.assertEqual(WIRED, Msg.all_messages.get(pk=msg1.pk).status)
+
+        # the latest update for each message wins, but a late sent report doesn't undo a delivery
+        self.assertEqual(2, Msg.apply_staged_statuses())
+
+        msg1 = Msg.all_messages.get(pk=msg1.pk)
+        self.assertEqual(DELIVERED, msg1.status)
+        self.assertIsNotNone(msg1.sent_on)
+        self.assertEqual(FAILED, Msg.all_messages.get(pk=msg2.pk).status)
+        self.assertEqual(DELIVERED, Msg.all_messages.get(pk=msg3.pk).status)
+
+        self.assertEqual(0, Msg.apply_staged_statuses())
+
+        # each message gets the date of its own report as its sent_on
+        msg4 = Msg.create_outgoing(self.org, self.admin, joe, "Hi 4")
+        msg5 = Msg.create_outgoing(self.org, self.admin, joe, "Hi 5")
+        Msg.all_messages.filter(pk__in=[msg4.pk, msg5.pk]).update(status=WIRED)
+
+        with override_settings(STAGE_MSG_STATUSES=True):
+            with patch('django.utils.timezone.now') as mock_now:
+                mock_now.return_value = datetime(2016, 1, 1, 10, 0, 0, 0, pytz.UTC)
+                Msg.stage_status(self.channel, SENT, msg_id=msg4.pk)
+                mock_now.return_value = datetime(2016, 1, 1, 11, 0, 0, 0, pytz.UTC)
+                Msg.stage_status(self.channel, SENT, msg_id=msg5.pk)
+
+        # a failure while applying leaves the batch to be retried
+        with patch('temba.msgs.models.Msg.update_statuses') as mock_update:
+            mock_update.side_effect = ValueError("boom")
+            self.assertRaises(ValueError, Msg.apply_staged_statuses)
+
+        self.assertEqual(WIRED, Msg.all_messages.get(pk=msg4.pk).status)
+
+        self.assertEqual(2, Msg.apply_staged_statuses())
+        self.assertEqual(datetime(2016, 1, 1, 10, 0, 0, 0, pytz.UTC), Msg.all_messages.get(pk=msg4.pk).sent_on)
+        self.assertEqual(datetime(2016, 1, 1, 11, 0, 0, 0, pytz.UTC), Msg.all_messages.get(pk=msg5.pk).sent_on)
+        self.assertEqual(0, Msg.apply_staged_statuses())
+
+        # reports are ignored for messages which weren't sent through the reporting channel
+        other = Channel.create(self.org, self.user, None, 'TT', name="Other", address="other")
+        with override_settings(STAGE_MSG_STATUSES=True):
+            Msg.stage_status(other, DELIVERED, msg_id=msg4.pk)
+            Msg.stage_status(other, FAILED, msg_id=msg5.pk)
+
+        self.assertEqual(0, Msg.apply_staged_statuses())
+        self.assertEqual(SENT, Msg.all_messages.get(pk=msg4.pk).status)
+        self.assertEqual(SENT, Msg.all_messages.get(pk=msg5.pk).status)
+
+    def test_resolve_external_ids(self):
+        joe = self.create_contact("Joe", "+250788382382")
+        msg1 = Msg.create_outgoing(self.org, self.admin, joe, "Hi 1")
+        msg2 = Msg.create_outgoing(self.org, self.admin, joe, "Hi 2")
+
+        # messages sent by our channels are found in redis
+        r = get_redis_connection()
+        Msg.mark_sent(r, self.channel, dict_to_struct('MsgStruct', msg1.as_task_json()), WIRED, -1, 'ext1')
+        self.assertEqual('ext1', Msg.all_messages.get(pk=msg1.pk).external_id)
+
+        with self.assertNumQueries(0):
+            self.assertEqual({(self.channel.pk, 'ext1'): [msg1.pk]},
+                             Msg.resolve_external_ids([(self.channel.pk, 'ext1')]))
+
+        # others from the database
+        Msg.all_messages.filter(pk=msg2.pk).update(external_id='ext2')
+
+        with self.assertNumQueries(1):
+            self.assertEqual({(self.channel.pk, 'ext1'): [msg1.pk], (self.channel.pk, 'ext2'): [msg2.pk]},
+                             Msg.resolve_external_ids([(self.channel.pk, 'ext1'), (self.channel.pk, 'ext2'),
+                                                       (self.channel.pk, 'ext3')]))
+
+        self.assertEqual([msg2], list(Msg.get_by_external_id(self.channel, 'ext2')))
+        self.assertEqual([], list(Msg.get_by_external_id(self.channel, 'ext3')))
+
+    def test_create_outgoing_batch(self):
+        joe = self.create_contact("Joe", "+250788382382")
+        frank = self.create_contact("Frank", twitter="frank")
+        test_contact = Contact.get_test_contact(self.admin)
+
+        recipients = [(joe, "Hi @contact.first_name"), (frank, "Hello"), ("tel:+250788000001", "Hola")]
+
+        # frank can't be reached through our tel channel so doesn't get a message
+        msgs = Msg.create_outgoing_batch(self.org, self.admin, recipients, channel=self.channel)
+        self.assertEqual(2, len(msgs))
+        self.assertEqual([joe, Contact.from_urn(self.org, "tel:+250788000001")], [m.contact for m in msgs])
+        self.assertEqual(["Hi Joe", "Hola"], [m.text for m in msgs])
+        self.assertEqual([self.channel, self.channel], [m.channel for m in msgs])
+
+        # each recipient gets their own step context
+        kevin = self.create_contact("Kevin", "+250788000002")
+        msgs = Msg.create_outgoing_batch(self.org, self.admin, [(joe, "Hi @step.contact"), (kevin, "Hi @step.contact")],
+                                         channel=self.channel)
+        self.assertEqual(["Hi Joe", "Hi Kevin"], [m.text for m in msgs])
+
+        # none of these are saved yet but all are paid for
+        self.assertFalse(any([m.pk for m in msgs]))
+        self.assertTrue(all([m.topup_id for m in msgs]))
+
+        # test contacts don't use up credits
+        msgs = Msg.create_outgoing_batch(self.org, self.admin, [(test_contact, "Testing")])
+        self.assertEqual(1, len(msgs))
+        self.assertIsNone(msgs[0].topup_id)
+
+        # loop detection is done for the whole batch when requested
+        for i in range(10):
+            Msg.create_outgoing(self.org, self.admin, joe, "Loop")
+
+        msgs = Msg.create_outgoing_batch(self.org, self.admin, [(joe, "Loop"), (joe, "Not a loop")], check_loops=True)
+        self.assertEqual(["Not a loop"], [m.text for m in msgs])
+
+        # but not otherwise
+        msgs = Msg.create_outgoing_batch(self.org, self.admin, [(joe, "Loop")])
+        self.assertEqual(["Loop"], [m.text for m in msgs])
+
     def test_create_incoming(self):
         Msg.create_incoming(self.channel, "tel:250788382382", "It's going well")
         Msg.create_incoming(self.channel, "tel:250788382382", "My name is Frank")
@@ -708,6 +955,66 @@ class MsgTest(TembaTest):
             self.assertExcelRow(sheet, 3, [msg2.created_on, "%010d" % self.joe.pk, "tel", "Joe Blow", msg2.contact.uuid, "Incoming", "hello 2", ""], pytz.UTC)
             self.assertExcelRow(sheet, 4, [msg1.created_on, "%010d" % self.joe.pk, "tel", "Joe Blow", msg1.contact.uuid, "Incoming", "hello 1", "label1"], pytz.UTC)
 
+    @patch('temba.utils.email.send_temba_email')
+    def test_message_export_parts(self, mock_send_temba_email):
+        self.clear_storage()
+
+        tz = self.org.get_tzinfo()
+        joe_urn = self.joe.get_urn(TEL_SCHEME).urn
+
+        for day in (1, 2, 3, 5, 8):
+            msg = Msg.create_incoming(self.channel, joe_urn, "hello %d" % day)
+            Msg.all_messages.filter(pk=msg.pk).update(created_on=tz.localize(datetime(2016, 4, day, 12, 0)))
+
+        task = ExportMessagesTask.objects.create(org=self.org, host='test', created_by=self.admin,
+                                                 modified_by=self.admin, start_date=date(2016, 4, 1),
+                                                 end_date=date(2016, 4, 8))
+
+        # exports aren't split by default
+        self.assertEqual(task.get_part_ranges(), [(date(2016, 4, 1), date(2016, 4, 8))])
+
+        with override_settings(MSG_EXPORT_PARTS=3):
+            self.assertEqual(task.get_part_ranges(), [(date(2016, 4, 6), date(2016, 4, 8)),
+                                                      (date(2016, 4, 3), date(2016, 4, 5)),
+                                                      (date(2016, 4, 1), date(2016, 4, 2))])
+
+            # open ended exports start from the oldest message and keep their oldest and newest parts open ended
+            open_task = ExportMessagesTask.objects.create(org=self.org, host='test', created_by=self.admin,
+                                                          modified_by=self.admin)
+            parts = open_task.get_part_ranges()
+            self.assertEqual(len(parts), 3)
+            self.assertIsNone(parts[0][1])
+            self.assertEqual(parts[1][0], parts[2][1] + timedelta(days=1))
+            self.assertIsNone(parts[2][0])
+
+            # can't have more parts than days
+            task.end_date = date(2016, 4, 2)
+            self.assertEqual(task.get_part_ranges(), [(date(2016, 4, 2), date(2016, 4, 2)),
+                                                      (date(2016, 4, 1), date(2016, 4, 1))])
+            task.end_date = date(2016, 4, 8)
+
+            task.start_export()
+
+        task.refresh_from_db()
+        self.assertTrue(task.is_finished)
+
+        filename = "%s/test_orgs/%d/message_exports/%s.xls" % (settings.MEDIA_ROOT, self.org.pk, task.uuid)
+        workbook = open_workbook(filename, 'rb')
+        sheet = workbook.sheets()[0]
+
+        # parts are merged newest first
+        self.assertEqual(sheet.nrows, 6)
+        self.assertEqual([sheet.cell(row, 6).value for row in range(1, 6)],
+                         ["hello 8", "hello 5", "hello 3", "hello 2", "hello 1"])
+        self.assertExcelRow(sheet, 1, [tz.localize(datetime(2016, 4, 8, 12, 0)), "123", "tel", "Joe Blow",
+                                       self.joe.uuid, "Incoming", "hello 8", ""], pytz.UTC)
+
+        # and our parts are cleaned up
+        r = get_redis_connection()
+        self.assertFalse(r.exists('msg_export_parts:%d' % task.pk))
+        self.assertFalse(r.exists('msg_export_parts_remaining:%d' % task.pk))
+        self.assertEqual(default_storage.listdir('msg_export_parts/%d' % task.pk)[1], [])
+
     def assertHasClass(self, text, clazz):
         self.assertTrue(text.find(clazz) >= 0)
 
@@ -751,6 +1058,121 @@ class MsgTest(TembaTest):
                                        ChannelEvent.TYPE_CALL_OUT_MISSED, timezone.now(), 5)
         self.assertHasClass(as_icon(out_miss), 'icon-call-outgoing red')
 
+    def test_archive(self):
+        self.clear_storage()
+
+        joe_urn = self.joe.get_urn(TEL_SCHEME).urn
+        msg1 = Msg.create_incoming(self.channel, joe_urn, "old 1")
+        msg2 = Msg.create_incoming(self.channel, joe_urn, "old 2")
+        msg3 = Msg.create_incoming(self.channel, joe_urn, "new")
+        reply = Msg.create_outgoing(self.org, self.admin, self.joe, "reply", response_to=msg2)
+
+        label = Label.get_or_create(self.org, self.user, "label1")
+        label.toggle_label([msg1], add=True)
+
+        # move the first two messages back to March 2016 and the reply to April
+        Msg.all_messages.filter(pk__in=[msg1.pk, msg2.pk]).update(created_on=datetime(2016, 3, 5, tzinfo=pytz.utc))
+        Msg.all_messages.filter(pk=reply.pk).update(created_on=datetime(2016, 4, 5, tzinfo=pytz.utc))
+
+        credits_used = self.org._calculate_credits_used()
+
+        # nothing ends before March 2016
+        self.assertEqual(MsgArchive.archive_old_months(self.org, datetime(2016, 3, 31, tzinfo=pytz.utc)), [])
+
+        archives = MsgArchive.archive_old_months(self.org, datetime(2016, 4, 1, tzinfo=pytz.utc))
+        self.assertEqual(len(archives), 1)
+        self.assertEqual(archives[0].start_date, date(2016, 3, 1))
+        self.assertEqual(archives[0].record_count, 2)
+
+        # messages are gone from the database, but their credits remain used
+        self.assertFalse(Msg.all_messages.filter(pk__in=[msg1.pk, msg2.pk]).exists())
+        self.assertEqual(Msg.all_messages.get(pk=reply.pk).response_to, None)
+        self.assertEqual(Msg.all_messages.get(pk=msg3.pk).text, "new")
+        self.assertEqual(self.org._calculate_credits_used(), credits_used)
+
+        # March is already archived
+        self.assertEqual(MsgArchive.archive_old_months(self.org, datetime(2016, 4, 1, tzinfo=pytz.utc)), [])
+
+        archived = list(MsgArchive.get_messages(self.org, contact=self.joe))
+        self.assertEqual([m.pk for m in archived], [msg2.pk, msg1.pk])
+        self.assertEqual(archived[1].text, "old 1")
+        self.assertEqual(archived[1].created_on, datetime(2016, 3, 5, tzinfo=pytz.utc))
+        self.assertEqual(archived[1].archive_record['labels'], [dict(uuid=label.uuid, name="label1")])
+        self.assertEqual(archived[1].archive_record['urn'], joe_urn)
+
+        self.assertEqual(list(MsgArchive.get_messages(self.org, contact=self.frank)), [])
+        self.assertEqual(list(MsgArchive.get_messages(self.org, after=datetime(2016, 4, 1, tzinfo=pytz.utc))), [])
+
+        # archived messages are included in exports
+        export = ExportMessagesTask.objects.create(org=self.org, host='rapidpro.io',
+                                                   created_by=self.admin, modified_by=self.admin)
+        export.do_export()
+
+        filename = "%s/test_orgs/%d/message_exports/%s.xls" % (settings.MEDIA_ROOT, self.org.pk, export.uuid)
+        sheet = open_workbook(filename, 'rb').sheets()[0]
+        self.assertEqual(sheet.nrows, 5)
+        self.assertEqual(sheet.cell(3, 6).value, "old 2")
+        self.assertEqual(sheet.cell(4, 6).value, "old 1")
+        self.assertEqual(sheet.cell(4, 7).value, "label1")
+
+        # and in the contact's history, merged with the messages still in the database by when they were created,
+        # which can put messages kept in the database after newer archived ones
+        Msg.all_messages.filter(pk=msg3.pk).update(created_on=datetime(2016, 2, 5, tzinfo=pytz.utc))
+
+        self.login(self.admin)
+        with patch('temba.msgs.models.MsgArchive.iter_records') as mock_iter_records:
+            response = self.client.get(reverse('contacts.contact_history', args=[self.joe.uuid]))
+            self.assertFalse(mock_iter_records.called)  # only the chunks with Joe's messages are read
+
+        self.assertEqual([getattr(item, 'pk', None) for item in response.context['activity']],
+                         [reply.pk, msg2.pk, msg1.pk, msg3.pk])
+        self.assertFalse(response.context['more'])
+
+        # merging pages through both
+        merged = MsgArchive.merge_messages(Msg.all_messages.filter(contact=self.joe).order_by('-created_on'),
+                                           MsgArchive.get_messages(self.org, contact=self.joe), page_size=1)
+        self.assertEqual([m.pk for m in merged], [reply.pk, msg2.pk, msg1.pk, msg3.pk])
+
+        # contacts without archived messages don't look at archives at all
+        response = self.client.get(reverse('contacts.contact_history', args=[self.frank.uuid]))
+        self.assertFalse(response.context['more'])
+
+    def test_archive_chunks(self):
+        self.clear_storage()
+
+        joe_urn = self.joe.get_urn(TEL_SCHEME).urn
+        frank_urn = self.frank.get_urn(TEL_SCHEME).urn
+        msgs = []
+        for i in range(5):
+            msgs.append(Msg.create_incoming(self.channel, joe_urn if i in (0, 4) else frank_urn, "msg %d" % i))
+
+        # a message which a flow step still refers to
+        flow = self.create_flow()
+        run = flow.start([], [self.joe])[0]
+        step_msg = Msg.all_messages.filter(steps__run=run).first()
+
+        Msg.all_messages.filter(pk__in=[m.pk for m in msgs] + [step_msg.pk]).update(
+            created_on=datetime(2016, 3, 5, tzinfo=pytz.utc))
+
+        with patch('temba.msgs.models.MsgArchive.CHUNK_SIZE', 2):
+            archive = MsgArchive.archive_month(self.org, date(2016, 3, 1))
+
+        # messages referenced by flow steps stay in the database
+        self.assertEqual(archive.record_count, 5)
+        self.assertTrue(Msg.all_messages.filter(pk=step_msg.pk).exists())
+
+        # Joe's messages are in the first and last chunks, Frank's in the first two
+        self.assertEqual(len(json.loads(archive.contacts.get(contact=self.joe).chunks)), 2)
+        self.assertEqual(len(json.loads(archive.contacts.get(contact=self.frank).chunks)), 2)
+
+        self.assertEqual([r['text'] for r in archive.iter_records()], ["msg %d" % i for i in range(5)])
+        self.assertEqual([r['text'] for r in archive.iter_contact_records(self.joe)], ["msg 0", "msg 1", "msg 4"])
+        self.assertEqual([m.text for m in MsgArchive.get_messages(self.org, contact=self.joe)], ["msg 4", "msg 0"])
+
+        # the archive is read back a chunk at a time, newest first
+        self.assertEqual(len(json.loads(archive.chunks)), 3)
+        self.assertEqual([m.text for m in MsgArchive.get_messages(self.org)], ["msg %d" % i for i in range(4, -1, -1)])
+
 
 class MsgCRUDLTest(TembaTest):
     def setUp(self):
@@ -860,6 +1282,20 @@ class BroadcastTest(TembaTest):
         finally:
             msgs_models.BATCH_SIZE = orig_batch_size
 
+    def test_broadcast_credits_released(self):
+        broadcast = Broadcast.create(self.org, self.user, "Like a tweet", [self.joe_and_frank, self.kevin])
+        remaining = self.org.get_credits_remaining()
+
+        # if our messages can't be created, the credits reserved for them are given back
+        with patch.object(Msg.all_messages, 'bulk_create') as mock_bulk_create:
+            mock_bulk_create.side_effect = ValueError("boom")
+            self.assertRaises(ValueError, broadcast.send)
+
+        self.assertEqual(remaining, Org.objects.get(pk=self.org.pk).get_credits_remaining())
+
+        broadcast.send()
+        self.assertEqual(remaining - 3, Org.objects.get(pk=self.org.pk).get_credits_remaining())
+
     def test_broadcast_model(self):
 
         def assertBroadcastStatus(sms, new_sms_status, broadcast_status):
@@ -33,7 +33,7 @@ from temba.nexmo import NexmoClient
 from temba.utils.email import send_template_email
 from temba.utils import analytics, str_to_datetime, get_datetime_format, datetime_to_str, random_string
 from temba.utils import timezone_to_country_code
-from temba.utils.cache import get_cacheable_result, incrby_existing
+from temba.utils.cache import get_cacheable_result, incrby_existing, redis_writes
 from twilio.rest import TwilioRestClient
 from urlparse import urlparse
 from uuid import uuid4
@@ -90,6 +90,8 @@ NEXMO_KEY = 'NEXMO_KEY'
 NEXMO_SECRET = 'NEXMO_SECRET'
 NEXMO_UUID = 'NEXMO_UUID'
 
+ORG_MAX_TPS = 'MAX_TPS'
+
 ORG_STATUS = 'STATUS'
 SUSPENDED = 'suspended'
 RESTORED = 'restored'
@@ -107,7 +109,8 @@ ORG_CREDITS_TOTAL_CACHE_KEY = 'org:%d:cache:credits_total'
 ORG_CREDITS_PURCHASED_CACHE_KEY = 'org:%d:cache:credits_purchased'
 ORG_CREDITS_USED_CACHE_KEY = 'org:%d:cache:credits_used'
 ORG_ACTIVE_TOPUP_KEY = 'org:%d:cache:active_topup'
-ORG_ACTIVE_TOPUP_REMAINING = 'org:%d:cache:credits_remaining:%d'
+ORG_ACTIVE_TOPUP_REMAINING_PREFIX = 'org:%d:cache:credits_remaining:'
+ORG_ACTIVE_TOPUP_REMAINING = ORG_ACTIVE_TOPUP_REMAINING_PREFIX + '%d'
 ORG_CREDIT_EXPIRING_CACHE_KEY = 'org:%d:cache:credits_expiring_soon'
 ORG_LOW_CREDIT_THRESHOLD_CACHE_KEY = 'org:%d:cache:low_credits_threshold'
 
@@ -1079,6 +1082,82 @@ class Org(SmartModel):
 
         return active_topup_pk
 
+    def decrement_credits(self, count):
+        """
+        Decrements this org's credit by the given number of credits, returning a list of the topup ids assigned to
+        each credit
+        """
+        topup_ids = []
+        for topup_id, reserved in self.reserve_credits(count):
+            topup_ids += [topup_id] * reserved
+
+        return topup_ids
+
+    def reserve_credits(self, count):
+        """
+        Reserves the given number of credits, returning a list of (topup id, count) blocks which cover them. Blocks are
+        taken from our active topup in a single atomic call, and only within 100 credits of the end of a topup do we
+        fall back to taking one credit at a time, which recalculates our active topup.
+        """
+        # takes as many of the requested credits as we can from the active topup without going below the threshold,
+        # returning the topup id and the number of credits taken
+        lua = "local topup = redis.call('get', KEYS[1])\n" \
+              "if not topup then return {0, 0} end\n" \
+              "local remaining_key = ARGV[2] .. topup\n" \
+              "local remaining = tonumber(redis.call('get', remaining_key))\n" \
+              "if not remaining then return {0, 0} end\n" \
+              "local take = math.min(tonumber(ARGV[1]), remaining - tonumber(ARGV[3]))\n" \
+              "if take <= 0 then return {0, 0} end\n" \
+              "redis.call('decrby', remaining_key, take)\n" \
+              "local used = redis.call('get', KEYS[2])\n" \
+              "if used then\n" \
+              "  local ttl = redis.call('pttl', KEYS[2])\n" \
+              "  redis.call('set', KEYS[2], tonumber(used) + take)\n" \
+              "  if ttl > 0 then redis.call('pexpire', KEYS[2], ttl) end\n" \
+              "end\n" \
+              "return {tonumber(topup), take}"
+
+        r = get_redis_connection()
+        used_key = ORG_CREDITS_USED_CACHE_KEY % self.pk
+        blocks = []
+
+        while count > 0:
+            topup_id, reserved = r.eval(lua, 2, ORG_ACTIVE_TOPUP_KEY % self.pk, used_key,
+                                        count, ORG_ACTIVE_TOPUP_REMAINING_PREFIX % self.pk, 100)
+
+            if not reserved:
+                topup_id = self.decrement_credit()
+                reserved = 1
+
+                # no topup has credits left, so the rest go unassigned until apply_topups is run
+                if topup_id is None:
+                    incrby_existing(used_key, count - 1, r)
+                    reserved = count
+                else:
+                    topup_id = int(topup_id)
+
+            if blocks and blocks[-1][0] == topup_id:
+                blocks[-1] = (topup_id, blocks[-1][1] + reserved)
+            else:
+                blocks.append((topup_id, reserved))
+
+            count -= reserved
+
+        return blocks
+
+    def release_credits(self, topup_id, count):
+        """
+        Gives back credits which were reserved from the given topup but not used
+        """
+        if count <= 0:
+            return
+
+        r = get_redis_connection()
+        incrby_existing(ORG_CREDITS_USED_CACHE_KEY % self.pk, -count, r)
+
+        if topup_id is not None:
+            incrby_existing(ORG_ACTIVE_TOPUP_REMAINING % (self.pk, topup_id), count, r)
+
     def _calculate_active_topup(self):
         """
         Calculates the oldest non-expired topup that still has credits
@@ -1381,8 +1460,8 @@ class Org(SmartModel):
         Increments our redis cache of how many unread messages exist for this org and type.
         @param type: either UNREAD_INBOX_MSGS or UNREAD_FLOW_MSGS
         """
-        r = get_redis_connection()
-        r.hincrby(type, self.id, 1)
+        with redis_writes() as pipe:
+            pipe.hincrby(type, self.id, 1)
 
     def get_unread_msg_count(self, msg_type):
         """
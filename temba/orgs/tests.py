@@ -718,6 +718,45 @@ class OrgTest(TembaTest):
 
         self.assertEquals(5500, self.org.get_credits_remaining())
 
+    def test_decrement_credits(self):
+        welcome_topup = TopUp.objects.get()
+
+        self.assertEqual([], self.org.decrement_credits(0))
+
+        # first credits calculate our active topup from scratch
+        self.assertEqual([welcome_topup.pk] * 5, [int(t) for t in self.org.decrement_credits(5)])
+
+        # after which we can take a block of credits without hitting the database
+        with self.assertNumQueries(0):
+            self.assertEqual([welcome_topup.pk] * 100, self.org.decrement_credits(100))
+
+        # without an active topup we go one by one, which finds it again
+        self.org.update_caches(OrgEvent.topup_updated, None)
+        self.assertEqual([welcome_topup.pk] * 10, [int(t) for t in self.org.decrement_credits(10)])
+
+    def test_reserve_credits(self):
+        welcome_topup = TopUp.objects.get()
+        self.assertEqual(self.org.get_credits_remaining(), 1000)
+
+        self.assertEqual([], self.org.reserve_credits(0))
+        self.assertEqual([(welcome_topup.pk, 5)], self.org.reserve_credits(5))
+
+        # blocks come from the active topup in a single call
+        with self.assertNumQueries(0):
+            self.assertEqual([(welcome_topup.pk, 500)], self.org.reserve_credits(500))
+
+        self.assertEqual(self.org.get_credits_remaining(), 495)
+
+        # unused credits can be given back
+        self.org.release_credits(welcome_topup.pk, 200)
+        self.assertEqual(self.org.get_credits_remaining(), 695)
+
+        # once no topup has credits left, the rest aren't assigned to any topup
+        TopUp.objects.filter(pk=welcome_topup.pk).update(credits=0)
+        self.org.update_caches(OrgEvent.topup_updated, None)
+
+        self.assertEqual([(None, 10)], self.org.reserve_credits(10))
+
     def test_topups(self):
         contact = self.create_contact("Michael Shumaucker", "+250788123123")
         test_contact = Contact.get_test_contact(self.user)
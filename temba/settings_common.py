@@ -927,6 +927,10 @@ CELERYBEAT_SCHEDULE = {
         'task': 'squash_flowruncounts',
         'schedule': timedelta(seconds=300),
     },
+    "squash-flowpathcounts": {
+        'task': 'squash_flowpathcounts',
+        'schedule': timedelta(seconds=300),
+    },
     "squash-channelcounts": {
         'task': 'squash_channelcounts',
         'schedule': timedelta(seconds=300),
@@ -943,6 +947,14 @@ CELERYBEAT_SCHEDULE = {
         'task': 'squash_contactgroupcounts',
         'schedule': timedelta(seconds=300),
     },
+    "apply-msg-statuses": {
+        'task': 'apply_msg_statuses_task',
+        'schedule': timedelta(seconds=5),
+    },
+    "archive-msgs": {
+        'task': 'archive_msgs_task',
+        'schedule': crontab(hour=3, minute=0),
+    },
 }
 
 # Mapping of task name to task function path, used when CELERY_ALWAYS_EAGER is set to True
@@ -950,6 +962,7 @@ CELERY_TASK_MAP = {
     'send_msg_task': 'temba.channels.tasks.send_msg_task',
     'start_msg_flow_batch': 'temba.flows.tasks.start_msg_flow_batch_task',
     'handle_event_task': 'temba.msgs.tasks.handle_event_task',
+    'create_incoming_task': 'temba.msgs.tasks.create_incoming_task',
 }
 
 # -----------------------------------------------------------------------------------
@@ -1065,6 +1078,26 @@ SEND_WEBHOOKS = False
 #         could cause emails to be sent in test environment
 SEND_EMAILS = False
 
+######
+# Whether channel handlers that support it should only queue incoming messages and return, leaving them to be
+# created in batches by create_incoming_task, which keeps handlers fast during traffic spikes
+STAGE_INCOMING_MSGS = False
+
+######
+# Whether channel handlers that support it should only queue delivery reports and return, leaving them to be applied
+# in bulk by apply_msg_statuses_task, which saves an update of the messages table per report
+STAGE_MSG_STATUSES = False
+
+######
+# How many whole months of messages to keep in the messages table, older months being moved into compressed archives
+# by archive_msgs_task. Set to None to never archive messages.
+ARCHIVE_MSGS_AFTER_MONTHS = None
+
+######
+# How many date range parts message exports are split into, each written by its own task so that big exports can be
+# spread across workers. The last part to finish merges them all into the export file.
+MSG_EXPORT_PARTS = 1
+
 MESSAGE_HANDLERS = ['temba.triggers.handlers.TriggerHandler',
                     'temba.flows.handlers.FlowHandler',
                     'temba.triggers.handlers.CatchAllHandler']
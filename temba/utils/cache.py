@@ -1,9 +1,80 @@
 from __future__ import unicode_literals
 
 import json
+import threading
 
+from contextlib import contextmanager
 from redis_cache import get_redis_connection
 
+# the redis batch for the current thread's unit of work, if there is one
+_redis_batch = threading.local()
+
+
+class RedisBatch(object):
+    """
+    The redis writes and callbacks of a unit of work, which are sent in a single pipeline when it completes
+    """
+    def __init__(self, r):
+        self.pipe = r.pipeline(transaction=False)
+        self.callbacks = []
+
+    def flush(self):
+        if len(self.pipe):
+            self.pipe.execute()
+
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+@contextmanager
+def redis_batch(r=None):
+    """
+    Defers the redis writes made through redis_writes and the callbacks given to after_redis_writes inside this
+    block, until the block exits when they are all sent in a single round trip. Writes made before an error are still
+    sent. Nested blocks are part of the outermost batch.
+
+    Ex: with redis_batch():
+            Msg.process_message(msg)
+    """
+    if getattr(_redis_batch, 'batch', None):
+        yield _redis_batch.batch
+        return
+
+    batch = RedisBatch(r or get_redis_connection())
+    _redis_batch.batch = batch
+    try:
+        yield batch
+    finally:
+        _redis_batch.batch = None
+        batch.flush()
+
+
+@contextmanager
+def redis_writes(r=None):
+    """
+    Provides a pipeline for redis writes whose results aren't needed. Inside a redis_batch this is the batch's
+    pipeline, otherwise it's a new pipeline which is executed when the block exits.
+    """
+    batch = getattr(_redis_batch, 'batch', None)
+    if batch:
+        yield batch.pipe
+    else:
+        pipe = (r or get_redis_connection()).pipeline()
+        yield pipe
+        pipe.execute()
+
+
+def after_redis_writes(callback):
+    """
+    Calls the given callback once the current redis_batch has been sent, or right away if there isn't one
+    """
+    batch = getattr(_redis_batch, 'batch', None)
+    if batch:
+        batch.callbacks.append(callback)
+    else:
+        callback()
+
 
 def get_cacheable(cache_key, cache_ttl, callable, r=None, force_dirty=False):
     """
@@ -61,4 +132,6 @@ def incrby_existing(key, delta, r=None):
           "    redis.call('pexpire', KEYS[1], ttl)\n" \
           "  end\n" \
           "end"
-    r.eval(lua, 1, key, delta)
+
+    with redis_writes(r) as pipe:
+        pipe.eval(lua, 1, key, delta)
@@ -2,8 +2,10 @@ from __future__ import unicode_literals
 
 import csv
 
+from datetime import datetime
 from django.core.files.temp import NamedTemporaryFile
 from xlwt import Workbook
+from zipfile import ZipFile, ZIP_DEFLATED
 
 
 class TableExporter(object):
@@ -67,6 +69,10 @@ class TableExporter(object):
 
             self.sheet_row += 1
 
+            # move finished rows out of memory into xlwt's temporary file
+            if self.sheet_row % 1000 == 0:
+                self.sheet.flush_row_data()
+
     def save_file(self):
         """
         Saves our data to a file, returning the file saved to
@@ -77,3 +83,90 @@ class TableExporter(object):
 
         self.file.flush()
         return self.file
+
+
+class CSVColumn(object):
+    """
+    Stand-in for an xlwt column, CSV files have no column widths so these are just ignored
+    """
+    width = None
+
+
+class CSVSheet(object):
+    """
+    A sheet of a CSVWorkbook which streams its rows to a temporary CSV file as they are completed. Rows must be
+    written in order but cells within the current row can be written in any order and overwritten.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.file = NamedTemporaryFile(delete=True)
+        self.writer = csv.writer(self.file, quoting=csv.QUOTE_ALL)
+
+        self.row_num = None
+        self.row = dict()
+        self.num_cols = 0
+
+    def col(self, index):
+        return CSVColumn()
+
+    def write(self, row, col, value, style=None):
+        if row != self.row_num:
+            if self.row_num is not None and row < self.row_num:
+                raise ValueError("Can't write to row %d of %s after row %d" % (row, self.name, self.row_num))
+
+            self.flush_row_data()
+            self.row_num = row
+
+        self.row[col] = value
+
+    def flush_row_data(self):
+        """
+        Writes out the current row, if there is one
+        """
+        if not self.row:
+            return
+
+        # pad out to the widest row we've seen, normally our header, so every row has the same number of cells
+        self.num_cols = max(self.num_cols, max(self.row.keys()) + 1)
+
+        values = []
+        for col in range(self.num_cols):
+            value = self.row.get(col)
+            if value is None:
+                value = ''
+            elif isinstance(value, datetime):
+                value = value.strftime('%Y-%m-%d %H:%M:%S')
+
+            values.append(unicode(value).encode('utf-8'))
+
+        self.writer.writerow(values)
+        self.row = dict()
+
+    def close(self):
+        self.flush_row_data()
+        self.file.flush()
+
+
+class CSVWorkbook(object):
+    """
+    Drop in replacement for the parts of an xlwt Workbook our exports use, for exports too big for Excel. Each sheet
+    is streamed to its own CSV file as it is written and the sheets are zipped up together when saved, so unlike
+    an xlwt Workbook, memory use doesn't grow with the number of rows.
+    """
+    def __init__(self):
+        self.sheets = []
+
+    def add_sheet(self, name, cell_overwrite_ok=False):
+        sheet = CSVSheet(name)
+        self.sheets.append(sheet)
+        return sheet
+
+    def get_sheet(self, index):
+        return self.sheets[index]
+
+    def save(self, _file):
+        archive = ZipFile(_file, 'w', ZIP_DEFLATED, allowZip64=True)
+        for sheet in self.sheets:
+            sheet.close()
+            archive.write(sheet.file.name, '%s.csv' % sheet.name)
+        archive.close()
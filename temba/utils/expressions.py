@@ -1,7 +1,9 @@
 from __future__ import absolute_import, unicode_literals
 
 import regex
+import threading
 
+from collections import OrderedDict
 from temba_expressions.evaluator import Evaluator, EvaluationStrategy, DEFAULT_FUNCTION_MANAGER
 
 ALLOWED_TOP_LEVELS = ('channel', 'contact', 'date', 'extra', 'flow', 'step')
@@ -10,12 +12,103 @@ evaluator = Evaluator(allowed_top_levels=ALLOWED_TOP_LEVELS)
 
 listing = None  # lazily initialized
 
+# how many compiled templates we keep around, least recently used are discarded first
+COMPILED_TEMPLATE_CACHE_SIZE = 1000
+
+compiled_templates = OrderedDict()
+compiled_templates_lock = threading.Lock()
+
+SIMPLE_VARIABLE_REGEX = regex.compile(r'@(\w+(?:\.\w+)*)', flags=regex.UNICODE | regex.V0)
+
 
 def evaluate_template(template, context, url_encode=False, partial_vars=False):
     strategy = EvaluationStrategy.RESOLVE_AVAILABLE if partial_vars else EvaluationStrategy.COMPLETE
     return evaluator.evaluate_template(template, context, url_encode, strategy)
 
 
+class CompiledTemplate(object):
+    """
+    A template which only contains simple variable references, e.g. "Hi @contact.first_name", split into its literal
+    and variable parts so that it can be evaluated against many contexts without being parsed again
+    """
+    def __init__(self, parts):
+        self.parts = parts
+
+    def evaluate(self, variables):
+        """
+        Evaluates this template against the passed in dict of variables. Returns None if any of our variables doesn't
+        resolve to a string, in which case the full evaluator should be used instead.
+        """
+        output = []
+        for literal, path in self.parts:
+            output.append(literal)
+
+            if path:
+                value = variables
+                for key in path:
+                    if not isinstance(value, dict) or key not in value:
+                        return None
+                    value = value[key]
+
+                if isinstance(value, dict):
+                    value = value.get('__default__')
+
+                if not isinstance(value, basestring):
+                    return None
+
+                output.append(value)
+
+        return ''.join(output)
+
+
+def compile_template(template):
+    """
+    Gets the compiled form of the given template, or None if it contains anything besides simple variable references
+    and so needs the full evaluator. Results are cached by template text.
+    """
+    with compiled_templates_lock:
+        if template in compiled_templates:
+            compiled = compiled_templates.pop(template)
+            compiled_templates[template] = compiled
+            return compiled
+
+    compiled = _compile_template(template)
+
+    with compiled_templates_lock:
+        compiled_templates[template] = compiled
+        while len(compiled_templates) > COMPILED_TEMPLATE_CACHE_SIZE:
+            compiled_templates.popitem(last=False)
+
+    return compiled
+
+
+def _compile_template(template):
+    # escaped prefixes and expressions with functions or operators need the full evaluator
+    if '@@' in template or '@(' in template:
+        return None
+
+    parts = []
+    literal_start = 0
+    for match in SIMPLE_VARIABLE_REGEX.finditer(template):
+        path = match.group(1)
+        keys = path.split('.')
+
+        # as do upper case references and anything that isn't one of our top levels, like an email address
+        if path != path.lower() or keys[0] not in ALLOWED_TOP_LEVELS:
+            return None
+
+        parts.append((template[literal_start:match.start()], keys))
+        literal_start = match.end()
+
+    parts.append((template[literal_start:], None))
+
+    # and so does any other use of our prefix
+    if any(['@' in part[0] for part in parts]):
+        return None
+
+    return CompiledTemplate(parts)
+
+
 def evaluate_template_compat(template, context, url_encode=False):
     """
     Evaluates the given template which may contain old style expressions
@@ -1,6 +1,7 @@
 from redis_cache import get_redis_connection
 from celery import current_app
 from temba.utils import dict_to_json
+from temba.utils.cache import redis_writes, after_redis_writes
 from django.conf import settings
 import json
 import time
@@ -25,25 +26,24 @@ def push_task(org, queue, task_name, args, priority=DEFAULT_PRIORITY):
     # first based on priority, then insertion order.
     score = time.time() + priority
 
-    # push our task onto the right queue and make sure it is in the active list (atomically)
-    with r.pipeline() as pipe:
+    # push our task onto the right queue and make sure it is in the active list, if we're part of a redis batch
+    # this happens when the batch is sent
+    with redis_writes(r) as pipe:
         key = "%s:%d" % (task_name, org if isinstance(org, int) else org.id)
         pipe.zadd(key, dict_to_json(args), score)
 
         # and make sure this key is in our list of queues so this job will get worked on
         pipe.sadd("%s:active" % task_name, key)
-        pipe.execute()
 
-    # if we were given a queue to schedule on, then add this task to celery.
+    # if we were given a queue to schedule on, then add this task to celery once it's actually in redis.
     #
     # note that the task that is fired needs no arguments as it should just use pop_task with the
     # task name to determine what to work on.
     if queue:
         if getattr(settings, 'CELERY_ALWAYS_EAGER', False):
-            task_function = lookup_task_function(task_name)
-            task_function()
+            after_redis_writes(lookup_task_function(task_name))
         else:
-            current_app.send_task(task_name, args=[], kwargs={}, queue=queue)
+            after_redis_writes(lambda: current_app.send_task(task_name, args=[], kwargs={}, queue=queue))
 
 
 def pop_task(task_name):
@@ -81,6 +81,64 @@ def pop_task(task_name):
     return task
 
 
+def pop_tasks(task_name, max_items=10, max_orgs=5):
+    """
+    Pops up to max_items tasks off our queue in a single atomic call, spread across up to max_orgs different org
+    queues. Each org is given a fair share of the batch, with any share it can't use given to the other orgs, and
+    tasks for each org come back in priority order.
+
+    Ex: pop_tasks('send_msg_task', max_items=20, max_orgs=5)
+    <<< [{...}, {...}, ...]
+    """
+    r = get_redis_connection('default')
+
+    active_set = "%s:active" % task_name
+
+    # this lua script takes a fair share of the remaining capacity from each queue, one "round" at a time until we
+    # either fill our batch or run out of queues with tasks, queues which are found to be empty are removed from our
+    # active set as part of the same atomic action
+    lua = "local remaining = tonumber(ARGV[1])\n" \
+          "local queues = {}\n" \
+          "for i = 2, #KEYS do queues[#queues + 1] = KEYS[i] end\n" \
+          "local tasks = {}\n" \
+          "while remaining > 0 and #queues > 0 do\n" \
+          "  local share = math.ceil(remaining / #queues)\n" \
+          "  local live = {}\n" \
+          "  for _, queue in ipairs(queues) do\n" \
+          "    if remaining > 0 then\n" \
+          "      local take = math.min(share, remaining)\n" \
+          "      local vals = redis.call('zrange', queue, 0, take - 1)\n" \
+          "      if #vals > 0 then\n" \
+          "        redis.call('zremrangebyrank', queue, 0, #vals - 1)\n" \
+          "        for _, val in ipairs(vals) do tasks[#tasks + 1] = val end\n" \
+          "        remaining = remaining - #vals\n" \
+          "      end\n" \
+          "      if #vals < take then\n" \
+          "        redis.call('srem', KEYS[1], queue)\n" \
+          "      else\n" \
+          "        live[#live + 1] = queue\n" \
+          "      end\n" \
+          "    end\n" \
+          "  end\n" \
+          "  queues = live\n" \
+          "end\n" \
+          "return tasks"
+
+    # pick the org queues we will work against, these are returned in random order, and if they all turn out to be
+    # empty they'll have been removed from our active set so we try again with others until there are none left
+    queues = r.srandmember(active_set, max_orgs)
+
+    while queues:
+        keys = [active_set] + list(queues)
+        tasks = r.eval(lua, len(keys), *(keys + [max_items]))
+        if tasks:
+            return [json.loads(task) for task in tasks]
+
+        queues = r.srandmember(active_set, max_orgs)
+
+    return []
+
+
 def lookup_task_function(task_name):
     """
     Because Celery doesn't support using send_task() when ALWAYS_EAGER is on and we still want all our queue
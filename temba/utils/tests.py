@@ -4,10 +4,12 @@ from __future__ import absolute_import, unicode_literals
 
 import json
 import pytz
+import time as time_module
 
 from datetime import datetime, time
 from decimal import Decimal
 from django.conf import settings
+from django.core.files.temp import NamedTemporaryFile
 from django.core.paginator import Paginator
 from django.utils import timezone
 from temba_expressions.evaluator import EvaluationContext, DateStyle
@@ -16,13 +18,17 @@ from redis_cache import get_redis_connection
 from temba.contacts.models import Contact
 from temba.tests import TembaTest
 from xlrd import open_workbook
-from .cache import get_cacheable_result, get_cacheable_attr, incrby_existing
+from zipfile import ZipFile
+from .cache import get_cacheable_result, get_cacheable_attr, incrby_existing, redis_batch, redis_writes
+from .cache import after_redis_writes
 from .email import is_valid_address
-from .exporter import TableExporter
+from .exporter import TableExporter, CSVWorkbook
 from .expressions import migrate_template, evaluate_template, evaluate_template_compat, get_function_listing
+from .expressions import compile_template
 from .expressions import _build_function_signature
 from .gsm7 import is_gsm7, replace_non_gsm7_accents
-from .queues import pop_task, push_task, HIGH_PRIORITY, LOW_PRIORITY
+from .queues import pop_task, pop_tasks, push_task, HIGH_PRIORITY, LOW_PRIORITY
+from .throttle import take_token
 from . import format_decimal, slugify_with, str_to_datetime, str_to_time, truncate, random_string, non_atomic_when_eager
 from . import PageableQuery, json_to_dict, dict_to_struct, datetime_to_ms, ms_to_datetime, dict_to_json, str_to_bool
 from . import percentage, datetime_to_json_date, json_date_to_datetime, timezone_to_country_code, non_atomic_gets
@@ -263,6 +269,52 @@ class CacheTest(TembaTest):
         incrby_existing('xxx', -2, r)  # non-existent key
         self.assertIsNone(r.get('xxx'))
 
+    def test_redis_batch(self):
+        r = get_redis_connection()
+        r.set('foo', 10)
+        called = []
+
+        with redis_batch(r):
+            with redis_writes() as pipe:
+                pipe.set('bar', 1)
+
+            incrby_existing('foo', 5)
+            push_task(self.org, None, 'test', dict(task=1))
+            after_redis_writes(lambda: called.append(r.get('bar')))
+
+            # nested batches are part of the outer one
+            with redis_batch():
+                with redis_writes() as pipe:
+                    pipe.set('baz', 2)
+
+            # nothing is written until the batch completes
+            self.assertIsNone(r.get('bar'))
+            self.assertIsNone(r.get('baz'))
+            self.assertEqual(r.get('foo'), '10')
+            self.assertFalse(pop_task('test'))
+            self.assertEqual(called, [])
+
+        self.assertEqual(r.get('bar'), '1')
+        self.assertEqual(r.get('baz'), '2')
+        self.assertEqual(r.get('foo'), '15')
+        self.assertEqual(pop_task('test'), dict(task=1))
+        self.assertEqual(called, ['1'])
+
+        # writes made before an error are still sent
+        with self.assertRaises(ValueError):
+            with redis_batch(r):
+                incrby_existing('foo', 1)
+                raise ValueError("boom")
+
+        self.assertEqual(r.get('foo'), '16')
+
+        # outside of a batch, writes and callbacks happen right away
+        with redis_writes() as pipe:
+            pipe.set('bar', 3)
+
+        after_redis_writes(lambda: called.append(r.get('bar')))
+        self.assertEqual(called, ['1', '3'])
+
 
 class EmailTest(TembaTest):
 
@@ -387,6 +439,73 @@ class QueueTest(TembaTest):
 
         self.assertFalse(pop_task('test'))
 
+    def test_batch_popping(self):
+        self.create_secondary_org()
+
+        # nothing to pop
+        self.assertEqual([], pop_tasks('test'))
+
+        for i in range(6):
+            push_task(self.org, None, 'test', dict(task=i))
+
+        push_task(self.org2, None, 'test', dict(task=10), LOW_PRIORITY)
+        push_task(self.org2, None, 'test', dict(task=11), HIGH_PRIORITY)
+
+        # each org should get a fair share of our batch, in priority order for each org
+        tasks = [t['task'] for t in pop_tasks('test', max_items=4)]
+        self.assertEqual(4, len(tasks))
+        self.assertEqual([0, 1], [t for t in tasks if t < 10])
+        self.assertEqual([11, 10], [t for t in tasks if t >= 10])
+
+        # our second org is now empty so the rest of our first org's tasks fill the batch
+        tasks = [t['task'] for t in pop_tasks('test', max_items=10)]
+        self.assertEqual([2, 3, 4, 5], tasks)
+
+        # both queues should have been removed from our active set
+        self.assertEqual([], pop_tasks('test'))
+        self.assertFalse(get_redis_connection().smembers('test:active'))
+
+        # limit to a single org per batch
+        push_task(self.org, None, 'test', dict(task=1))
+        push_task(self.org2, None, 'test', dict(task=2))
+
+        self.assertEqual(1, len(pop_tasks('test', max_items=10, max_orgs=1)))
+        self.assertEqual(1, len(pop_tasks('test', max_items=10, max_orgs=1)))
+        self.assertEqual([], pop_tasks('test', max_items=10, max_orgs=1))
+
+        # stale queues in our active set don't stop us finding tasks in other queues
+        r = get_redis_connection()
+        r.sadd('test:active', 'test:9998', 'test:9999')
+        push_task(self.org, None, 'test', dict(task=3))
+
+        self.assertEqual([{'task': 3}], pop_tasks('test', max_items=10, max_orgs=1))
+        self.assertFalse(r.smembers('test:active'))
+
+
+class ThrottleTest(TembaTest):
+
+    def test_take_token(self):
+        # no buckets means no throttling
+        self.assertEqual(0, take_token([]))
+
+        # our bucket starts full, so we can take our burst right away
+        self.assertEqual(0, take_token([('test_bucket', 2, 2)]))
+        self.assertEqual(0, take_token([('test_bucket', 2, 2)]))
+
+        # but then we have to wait for it to refill
+        delay = take_token([('test_bucket', 2, 2)])
+        self.assertTrue(0 < delay <= 0.5)
+
+        # tokens are only taken if every bucket has one
+        delay = take_token([('other_bucket', 1, 1), ('test_bucket', 2, 2)])
+        self.assertTrue(0 < delay <= 0.5)
+        self.assertEqual(0, take_token([('other_bucket', 1, 1)]))
+
+        # once refilled we can take a token again
+        with patch('time.time') as mock_time:
+            mock_time.return_value = time_module.time() + 1
+            self.assertEqual(0, take_token([('test_bucket', 2, 2)]))
+
 
 class PageableQueryTest(TembaTest):
     def setUp(self):
@@ -449,6 +568,7 @@ class ExpressionsTest(TembaTest):
                                  joined=datetime(2014, 12, 1, 9, 0, 0, 0, timezone.utc),  # date as datetime
                                  started="1/12/14 9:00")  # date as string
 
+        self.variables = variables
         self.context = EvaluationContext(variables, timezone.utc, DateStyle.DAY_FIRST)
 
     def test_evaluate_template(self):
@@ -562,6 +682,30 @@ class ExpressionsTest(TembaTest):
                           evaluate_template('Hello @(REPT(flow.blank, -2))',
                                             self.context))  # internal function error
 
+    def test_compile_template(self):
+        variables = self.variables
+
+        # templates which need the full evaluator aren't compiled
+        self.assertIsNone(compile_template("Hello @(LOWER(contact.first_name))"))
+        self.assertIsNone(compile_template("Email me at @@nyaruka"))
+        self.assertIsNone(compile_template("Email me at bob@nyaruka.com"))
+        self.assertIsNone(compile_template("Hello @Contact.first_name"))
+        self.assertIsNone(compile_template("Hello @ you"))
+
+        # compiled templates evaluate the same as through the evaluator
+        for template in ("Hello World", "Hi @contact.first_name, how's @flow.water_source?", "@contact", "@flow.blank.",
+                         "@flow.arabic @flow.english"):
+            compiled = compile_template(template)
+            self.assertIsNotNone(compiled)
+            self.assertEqual(evaluate_template(template, self.context)[0], compiled.evaluate(variables))
+
+        # and are cached by their text
+        self.assertIs(compile_template("Hi @contact.first_name"), compile_template("Hi @contact.first_name"))
+
+        # but anything which doesn't resolve to a string needs the full evaluator
+        self.assertIsNone(compile_template("You have @flow.users").evaluate(variables))
+        self.assertIsNone(compile_template("You have @flow.missing").evaluate(variables))
+
     def test_evaluate_template_compat(self):
         # test old style expressions, i.e. @ and with filters
         self.assertEqual(("Hello World Joe Joe", []),
@@ -773,3 +917,38 @@ class TableExporterTest(TembaTest):
 
         self.assertEquals(67000 + 2 - 65536, sheet2.nrows)
         self.assertEquals(32, sheet2.ncols)
+
+
+class CSVWorkbookTest(TembaTest):
+
+    def test_save(self):
+        book = CSVWorkbook()
+        sheet1 = book.add_sheet("Runs")
+        sheet2 = book.add_sheet("Messages")
+        self.assertEqual(book.get_sheet(1), sheet2)
+
+        sheet1.write(0, 0, "Name")
+        sheet1.write(0, 1, "Date")
+        sheet1.col(1).width = 100
+
+        # cells in the current row can be written in any order and overwritten
+        sheet1.write(1, 1, datetime(2016, 4, 1, 10, 30, 0, 123))
+        sheet1.write(1, 0, "Bob")
+        sheet1.write(1, 0, "Renée")
+        sheet1.flush_row_data()
+        sheet1.write(2, 1, None)
+
+        # but rows can't be revisited once we've moved on
+        self.assertRaises(ValueError, sheet1.write, 1, 0, "Jim")
+
+        sheet2.write(0, 0, "Text")
+
+        with NamedTemporaryFile() as temp:
+            book.save(temp)
+            temp.flush()
+
+            archive = ZipFile(temp.name)
+            self.assertEqual(archive.namelist(), ['Runs.csv', 'Messages.csv'])
+            self.assertEqual(archive.read('Runs.csv').decode('utf-8'),
+                             '"Name","Date"\r\n"Renée","2016-04-01 10:30:00"\r\n"",""\r\n')
+            self.assertEqual(archive.read('Messages.csv'), '"Text"\r\n')
@@ -0,0 +1,58 @@
+from __future__ import unicode_literals
+
+import time
+
+from redis_cache import get_redis_connection
+
+
+def take_token(buckets, r=None):
+    """
+    Tries to take a single token from each of the passed in token buckets, each a tuple of (key, rate, burst) where
+    rate is how many tokens are added per second and burst is how many the bucket can hold. Either a token is taken
+    from every bucket and we return 0, or none are taken and we return how many seconds until every bucket will have
+    a token available. This is done in a single atomic call so callers never need to lock or poll.
+
+    Ex: take_token([('channel_tps_12', 5, 5), ('org_tps_3', 20, 20)])
+    <<< 0.2
+    """
+    if not buckets:
+        return 0
+
+    if not r:
+        r = get_redis_connection()
+
+    # refill each bucket for the time since it was last touched, only take tokens if all of them have one, and
+    # otherwise work out the longest we need to wait, which is returned as a string as lua numbers are truncated
+    lua = "local now = tonumber(ARGV[1])\n" \
+          "local tokens = {}\n" \
+          "local wait = 0\n" \
+          "for i, key in ipairs(KEYS) do\n" \
+          "  local rate = tonumber(ARGV[i * 2])\n" \
+          "  local burst = tonumber(ARGV[i * 2 + 1])\n" \
+          "  local bucket = redis.call('hmget', key, 'tokens', 'ts')\n" \
+          "  local available = tonumber(bucket[1])\n" \
+          "  local ts = tonumber(bucket[2])\n" \
+          "  if available == nil or ts == nil then\n" \
+          "    available = burst\n" \
+          "  else\n" \
+          "    available = math.min(burst, available + math.max(0, now - ts) * rate)\n" \
+          "  end\n" \
+          "  tokens[i] = available\n" \
+          "  if available < 1 then wait = math.max(wait, (1 - available) / rate) end\n" \
+          "end\n" \
+          "for i, key in ipairs(KEYS) do\n" \
+          "  local rate = tonumber(ARGV[i * 2])\n" \
+          "  local burst = tonumber(ARGV[i * 2 + 1])\n" \
+          "  local available = tokens[i]\n" \
+          "  if wait == 0 then available = available - 1 end\n" \
+          "  redis.call('hmset', key, 'tokens', tostring(available), 'ts', ARGV[1])\n" \
+          "  redis.call('expire', key, math.ceil(burst / rate) + 1)\n" \
+          "end\n" \
+          "return tostring(wait)"
+
+    keys = [bucket[0] for bucket in buckets]
+    args = ['%f' % time.time()]
+    for key, rate, burst in buckets:
+        args += [rate, max(burst, 1)]
+
+    return float(r.eval(lua, len(keys), *(keys + args)))